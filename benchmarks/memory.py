@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Memory benchmark of the cblaster object model.
+
+This builds a synthetic remote search, i.e. an Identical Protein Groups (IPG) table
+and the Hit objects used to query it, then measures the memory held by the
+Organism objects created by context.parse_IPG_table() using tracemalloc.
+
+As in real IPGs, most members of each group are the same (RefSeq) protein found in
+many genomes, and the rest are distinct (INSDC) proteins.
+
+    $ python benchmarks/memory.py --subjects 1000 --queries 5 --members 100
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from cblaster import context
+from cblaster.classes import Hit
+
+
+def make_search(subjects=1000, queries=5, members=100, genomes=500, seed=0):
+    """Generates a synthetic IPG table and the Hit objects linked to it."""
+    rng = random.Random(seed)
+    hits = [
+        Hit(f"query_{q}", f"WP_{s:09d}.1", 80.0, 90.0, 1e-50, 300.0)
+        for s in range(subjects)
+        for q in range(queries)
+    ]
+    rows = ["Id\tSource\tNucleotide Accession\tStart\tStop\tStrand\tProtein"
+            "\tProtein Name\tOrganism\tStrain\tAssembly"]
+    for s in range(subjects):
+        for m, genome in enumerate(rng.sample(range(genomes), members)):
+            start = rng.randint(0, 10_000_000)
+            refseq = m < members * 0.8
+            rows.append(
+                "\t".join(
+                    [
+                        str(s),
+                        "RefSeq" if refseq else "INSDC",
+                        f"NZ_SCAF{genome:06d}_{s % 50}.1",
+                        str(start),
+                        str(start + 1500),
+                        "+" if s % 2 else "-",
+                        f"WP_{s:09d}.1" if refseq else f"INS{s:06d}_{m}.1",
+                        "protein",
+                        f"Genus species{genome % 20}",
+                        f"strain {genome}",
+                        f"GCF_{genome:09d}.1",
+                    ]
+                )
+            )
+    return rows, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--subjects", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=5)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--genomes", type=int, default=500)
+    args = parser.parse_args()
+
+    rows, hits = make_search(
+        args.subjects, args.queries, args.members, args.genomes
+    )
+    gc.collect()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    organisms = context.parse_IPG_table(rows, hits)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    subjects = [
+        subject
+        for organism in organisms
+        for scaffold in organism.scaffolds.values()
+        for subject in scaffold.subjects
+    ]
+    total_hits = sum(len(subject.hits) for subject in subjects)
+    unique_hits = len({id(hit) for subject in subjects for hit in subject.hits})
+
+    print(f"IPG rows:       {len(rows) - 1}")
+    print(f"Organisms:      {len(organisms)}")
+    print(f"Subjects:       {len(subjects)}")
+    print(f"Hits:           {total_hits} ({unique_hits} distinct objects)")
+    print(f"Retained (MB):  {current / 1024 ** 2:.1f}")
+    print(f"Peak (MB):      {peak / 1024 ** 2:.1f}")
+    print(f"Time (s):       {elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in NCBI server that records and replays BLAST and E-utilities responses.
+
+In record mode, requests are forwarded to the NCBI and each response is saved,
+keyed by the request method, path and parameters. In replay mode, saved responses
+are served without touching the network, with configurable latency and throttling,
+so the remote search pipeline can be benchmarked reproducibly.
+
+    $ python benchmarks/ncbi_server.py record responses.json --port 8000
+    $ cblaster search -m remote -qf query.fasta --ncbi_url http://localhost:8000
+    $ python benchmarks/ncbi_server.py replay responses.json --latency 0.5 --rate 3
+
+Replayed BLAST searches report an RTOE of --rtoe seconds (def. 0), and status
+checks return the last recorded status, so searches complete immediately. Requests
+above --rate per second receive 429 responses with a Retry-After header, as the
+E-utilities do.
+"""
+
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+
+# NCBI host serving each path
+HOSTS = {
+    "/Blast.cgi": "https://blast.ncbi.nlm.nih.gov",
+    "/entrez/": "https://eutils.ncbi.nlm.nih.gov",
+}
+
+# Parameters that do not change the response
+IGNORED = {"api_key", "tool", "email"}
+
+
+def get_host(path):
+    for prefix, host in HOSTS.items():
+        if path.startswith(prefix):
+            return host
+    raise KeyError(path)
+
+
+def parse_form(content_type, body):
+    """Parses URL encoded or multipart form data into (name, value) pairs."""
+    if content_type.startswith("multipart/form-data"):
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+        fields = []
+        for part in body.split(b"--" + boundary.encode())[1:-1]:
+            # Parts are delimited by CRLFs, which are not part of their values
+            part = part[2:] if part.startswith(b"\r\n") else part
+            part = part[:-2] if part.endswith(b"\r\n") else part
+            head, _, value = part.partition(b"\r\n\r\n")
+            name = re.search(rb'name="([^"]*)"', head).group(1)
+            fields.append((name.decode(), value.decode(errors="replace")))
+        return fields
+    return parse_qsl(body.decode(errors="replace"))
+
+
+def request_key(method, path, query, content_type, body):
+    """Builds a key identifying a request by its method, path and parameters."""
+    fields = parse_qsl(query) + parse_form(content_type or "", body)
+    fields = sorted(field for field in fields if field[0] not in IGNORED)
+    text = json.dumps([method, path, fields])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class Throttle:
+    """Allows at most `rate` requests in any one second window."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.times = collections.deque()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            while self.times and now - self.times[0] >= 1:
+                self.times.popleft()
+            if len(self.times) >= self.rate:
+                return False
+            self.times.append(now)
+            return True
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Records or replays responses, depending on the server mode."""
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def send(self, status, body, content_type="text/plain", headers=None):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+        url = urlsplit(self.path)
+        key = request_key(method, url.path, url.query, content_type, body)
+        server = self.server
+
+        if server.mode == "record":
+            response = requests.request(
+                method,
+                get_host(url.path) + self.path,
+                data=body,
+                headers={"Content-Type": content_type} if content_type else None,
+            )
+            record = {
+                "status": response.status_code,
+                "content_type": response.headers.get("Content-Type", "text/plain"),
+                "body": response.text,
+            }
+            with server.lock:
+                server.responses[key] = record
+                server.save()
+        else:
+            if not server.throttle.allow():
+                self.send(429, "Too Many Requests", headers={"Retry-After": "1"})
+                return
+            time.sleep(server.latency)
+            record = server.responses.get(key)
+            if not record:
+                self.send(404, f"No recorded response for {method} {self.path}")
+                return
+            if url.path == "/Blast.cgi" and server.rtoe is not None:
+                record = dict(record)
+                record["body"] = re.sub(
+                    r"RTOE = \d+", f"RTOE = {server.rtoe}", record["body"]
+                )
+        self.send(record["status"], record["body"], record["content_type"])
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        address,
+        path,
+        mode="replay",
+        latency=0,
+        rate=None,
+        rtoe=0,
+        verbose=False,
+    ):
+        super().__init__(address, Handler)
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.throttle = Throttle(rate)
+        self.rtoe = rtoe
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        try:
+            with open(path) as handle:
+                self.responses = json.load(handle)
+        except FileNotFoundError:
+            if mode == "replay":
+                raise
+            self.responses = {}
+
+    def save(self):
+        with open(self.path, "w") as handle:
+            json.dump(self.responses, handle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("responses", help="JSON file of recorded responses")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Delay (s) before each response"
+    )
+    parser.add_argument(
+        "--rate", type=float, help="Maximum requests per second (def. unlimited)"
+    )
+    parser.add_argument(
+        "--rtoe", type=int, default=0, help="RTOE (s) reported for BLAST searches"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Log each request")
+    args = parser.parse_args()
+
+    with Server(
+        ("localhost", args.port),
+        args.responses,
+        mode=args.mode,
+        latency=args.latency,
+        rate=args.rate,
+        rtoe=args.rtoe,
+        verbose=args.verbose,
+    ) as server:
+        print(f"{args.mode.title()}ing NCBI responses at http://localhost:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+"""
+This module provides persistent, on-disk caches for cblaster searches.
+
+Caches are SQLite databases stored in the cblaster cache directory, which is either
+$XDG_CACHE_HOME/cblaster or ~/.cache/cblaster. For example, rows of the Identical
+Protein Groups (IPG) table retrieved from NCBI can be cached so that repeated remote
+searches only send new accessions back to NCBI:
+
+>>> with IPGCache(max_age=30) as cache:
+...     rows, misses = cache.lookup(["WP_012345678.1", "WP_087654321.1"])
+...     cache.update(efetch_IPGs(misses))
+
+Similarly, result tables of local DIAMOND searches can be cached, so that repeated
+searches of the same queries against the same database skip alignment entirely.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+
+from cblaster.helpers import file_hash
+
+
+LOG = logging.getLogger(__name__)
+
+
+def get_cache_dir():
+    """Gets the path to the cblaster cache directory."""
+    root = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(root) / "cblaster"
+
+
+def chunked(iterable, size=500):
+    """Splits a list into chunks of a given size.
+
+    SQLite limits the number of host parameters in a single statement (999 by
+    default), so lookups are done in chunks.
+    """
+    return [iterable[i: i + size] for i in range(0, len(iterable), size)]
+
+
+class IPGCache:
+    """A persistent cache of Identical Protein Group (IPG) table rows.
+
+    Rows are stored per IPG, and every protein_id in an IPG is mapped back to it.
+    This means that a search hitting any member of a previously retrieved IPG can
+    be resolved without querying NCBI. Entries older than `max_age` days are evicted
+    whenever the cache is opened.
+
+    Attributes:
+        path (Path): Path to the SQLite database.
+        max_age (float): Maximum age (days) of cached entries.
+    """
+
+    def __init__(self, path=None, max_age=30):
+        self.path = Path(path) if path else get_cache_dir() / "ipg.sqlite3"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS ipgs (
+                ipg TEXT PRIMARY KEY,
+                rows TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS proteins (
+                protein_id TEXT PRIMARY KEY,
+                ipg TEXT NOT NULL
+            );
+            """
+        )
+        self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def evict(self):
+        """Removes entries older than the maximum age from the cache."""
+        if self.max_age is None:
+            return
+        cutoff = time.time() - self.max_age * 86400
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM ipgs WHERE created < ?", (cutoff,)
+            )
+            if cursor.rowcount:
+                LOG.debug("Evicted %i IPGs from cache", cursor.rowcount)
+                self.connection.execute(
+                    "DELETE FROM proteins WHERE ipg NOT IN (SELECT ipg FROM ipgs)"
+                )
+
+    def lookup(self, ids):
+        """Finds cached IPG table rows for a collection of protein accessions.
+
+        Args:
+            ids (list): NCBI protein accessions.
+        Returns:
+            rows (list): Rows of the IPG table for every IPG found in the cache.
+            misses (list): Accessions that were not found in the cache.
+        """
+        ids = list(dict.fromkeys(ids))
+        found, ipgs = set(), set()
+        for chunk in chunked(ids):
+            cursor = self.connection.execute(
+                "SELECT protein_id, ipg FROM proteins WHERE protein_id IN"
+                f" ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for protein_id, ipg in cursor:
+                found.add(protein_id)
+                ipgs.add(ipg)
+        rows = []
+        for chunk in chunked(list(ipgs)):
+            cursor = self.connection.execute(
+                f"SELECT rows FROM ipgs WHERE ipg IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for (text,) in cursor:
+                rows.extend(text.split("\n"))
+        return rows, [i for i in ids if i not in found]
+
+    def update(self, rows):
+        """Adds rows of an IPG table to the cache.
+
+        Any previously cached rows for the same IPGs are replaced.
+
+        Args:
+            rows (iterable): Rows of an IPG table, e.g. from context.efetch_IPGs().
+        """
+        groups = {}
+        for row in rows:
+            if not row or row.isspace() or row.startswith("Id\tSource"):
+                continue
+            fields = row.strip("\n").split("\t")
+            if len(fields) < 7:
+                continue
+            groups.setdefault(fields[0], []).append(row.strip("\n"))
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ipgs VALUES (?, ?, ?)",
+                [(ipg, "\n".join(group), now) for ipg, group in groups.items()],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO proteins VALUES (?, ?)",
+                [
+                    (protein_id, ipg)
+                    for ipg, group in groups.items()
+                    for protein_id in (row.split("\t")[6] for row in group)
+                    if protein_id
+                ],
+            )
+        LOG.debug("Cached %i IPGs", len(groups))
+
+
+class HitCache:
+    """A persistent cache of local DIAMOND search result tables.
+
+    Tables are keyed on a hash of the query sequences, the identity of the searched
+    DIAMOND database(s), the score thresholds and the maximum number of target
+    sequences per query used in the search. Database files are identified by their
+    checksum, which is memoised against their size and modification time so
+    unchanged databases are not hashed on every search.
+
+    DIAMOND only reports the best `max_targets` targets of each query, so a table
+    from a looser search may have dropped targets that a stricter search would
+    report. Tables are therefore only reused for the exact same search, unless they
+    were searched without a target limit (max_targets=0): such a table contains
+    every row of any stricter search, so it is returned for stricter thresholds and
+    any target limit, and should then be filtered (see local.filter_rows and
+    local.limit_targets). Rows are stored and read back one at a time, so tables
+    never have to be held in memory. Entries older than `max_age` days are evicted
+    whenever the cache is opened.
+
+    >>> with HitCache() as cache:
+    ...     key = cache.key(fasta, ["mydb.dmnd"])
+    ...     rows = cache.lookup(key, min_identity=50, min_coverage=70, max_evalue=0.01)
+
+    Attributes:
+        path (Path): Path to the SQLite database.
+        max_age (float): Maximum age (days) of cached entries.
+    """
+
+    def __init__(self, path=None, max_age=30):
+        self.path = Path(path) if path else get_cache_dir() / "hits.sqlite3"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS hit_tables (
+                id INTEGER PRIMARY KEY,
+                query TEXT NOT NULL,
+                database TEXT NOT NULL,
+                min_identity REAL NOT NULL,
+                min_coverage REAL NOT NULL,
+                max_evalue REAL NOT NULL,
+                max_targets INTEGER NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS hit_tables_search
+                ON hit_tables (query, database);
+            CREATE TABLE IF NOT EXISTS hit_rows (
+                hit_table INTEGER NOT NULL,
+                row TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS hit_rows_table ON hit_rows (hit_table);
+            CREATE TABLE IF NOT EXISTS checksums (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+            """
+        )
+        self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _delete(self, where, parameters):
+        """Deletes the tables matching a WHERE clause, along with their rows."""
+        cursor = self.connection.execute(
+            f"DELETE FROM hit_tables WHERE {where}", parameters
+        )
+        if cursor.rowcount:
+            self.connection.execute(
+                "DELETE FROM hit_rows"
+                " WHERE hit_table NOT IN (SELECT id FROM hit_tables)"
+            )
+        return cursor.rowcount
+
+    def evict(self):
+        """Removes entries older than the maximum age from the cache."""
+        if self.max_age is None:
+            return
+        cutoff = time.time() - self.max_age * 86400
+        with self.connection:
+            count = self._delete("created < ?", (cutoff,))
+            if count:
+                LOG.debug("Evicted %i hit tables from cache", count)
+
+    def checksum(self, path):
+        """Gets the SHA256 checksum of a file, only hashing it if it has changed."""
+        path = Path(path).resolve()
+        stat = path.stat()
+        row = self.connection.execute(
+            "SELECT sha256 FROM checksums WHERE path = ? AND size = ? AND mtime = ?",
+            (str(path), stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row:
+            return row[0]
+        LOG.debug("Computing checksum of %s", path)
+        checksum = file_hash(path)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                (str(path), stat.st_size, stat.st_mtime_ns, checksum),
+            )
+        return checksum
+
+    def key(self, query, databases):
+        """Computes the cache key of a search.
+
+        Args:
+            query (str): Query sequences, in FASTA format.
+            databases (list): Paths to the searched DIAMOND databases.
+        Returns:
+            tuple: Hashes of the query and databases, or None if any database file
+                could not be found (e.g. it was given without the .dmnd extension
+                and does not exist with it either).
+        """
+        checksums = []
+        for database in databases:
+            path = Path(database)
+            if not path.exists():
+                path = Path(f"{database}.dmnd")
+            if not path.exists():
+                LOG.debug("Could not find database %s, not caching hits", database)
+                return None
+            checksums.append(self.checksum(path))
+        return (
+            hashlib.sha256(query.encode()).hexdigest(),
+            hashlib.sha256("\n".join(checksums).encode()).hexdigest(),
+        )
+
+    def lookup(
+        self, key, min_identity=30, min_coverage=50, max_evalue=0.01, max_targets=25
+    ):
+        """Finds a cached result table of a search.
+
+        Args:
+            key (tuple): Cache key of the search, from HitCache.key().
+            min_identity (float): Minimum identity (%) cutoff
+            min_coverage (float): Minimum coverage (%) cutoff
+            max_evalue (float): Maximum e-value threshold
+            max_targets (int): Maximum target sequences per query (0 for no limit)
+        Returns:
+            generator: Rows of the result table, or None if no table of the same
+                search, or of an unlimited search at least as loose, is cached.
+        """
+        thresholds = (min_identity, min_coverage, max_evalue)
+        row = self.connection.execute(
+            "SELECT id FROM hit_tables WHERE query = ? AND database = ? AND ("
+            " (max_targets = 0"
+            " AND min_identity <= ? AND min_coverage <= ? AND max_evalue >= ?)"
+            " OR (max_targets = ?"
+            " AND min_identity = ? AND min_coverage = ? AND max_evalue = ?)"
+            ") ORDER BY created DESC LIMIT 1",
+            (*key, *thresholds, max_targets, *thresholds),
+        ).fetchone()
+        if row is None:
+            return None
+        cursor = self.connection.execute(
+            "SELECT row FROM hit_rows WHERE hit_table = ? ORDER BY rowid", row
+        )
+        return (text for (text,) in cursor)
+
+    def update(
+        self,
+        key,
+        rows,
+        min_identity=30,
+        min_coverage=50,
+        max_evalue=0.01,
+        max_targets=25,
+    ):
+        """Adds the result table of a search to the cache.
+
+        Rows are inserted as they are iterated. Cached tables that are now served by
+        this table (i.e. of the same search or, if this search had no target limit,
+        of any stricter search) are removed.
+
+        Args:
+            key (tuple): Cache key of the search, from HitCache.key().
+            rows (iterable): Rows of the result table.
+            min_identity (float): Minimum identity (%) cutoff
+            min_coverage (float): Minimum coverage (%) cutoff
+            max_evalue (float): Maximum e-value threshold
+            max_targets (int): Maximum target sequences per query (0 for no limit)
+        Returns:
+            int: Number of rows cached.
+        """
+        thresholds = (min_identity, min_coverage, max_evalue)
+        with self.connection:
+            if max_targets:
+                self._delete(
+                    "query = ? AND database = ? AND max_targets = ?"
+                    " AND min_identity = ? AND min_coverage = ? AND max_evalue = ?",
+                    (*key, max_targets, *thresholds),
+                )
+            else:
+                self._delete(
+                    "query = ? AND database = ?"
+                    " AND min_identity >= ? AND min_coverage >= ? AND max_evalue <= ?",
+                    (*key, *thresholds),
+                )
+            table = self.connection.execute(
+                "INSERT INTO hit_tables VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, *thresholds, max_targets, time.time()),
+            ).lastrowid
+            count = self.connection.executemany(
+                "INSERT INTO hit_rows VALUES (?, ?)",
+                ((table, row) for row in rows if row),
+            ).rowcount
+        LOG.debug("Cached hit table with %i rows", count)
+        return count
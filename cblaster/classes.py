@@ -6,15 +6,22 @@ This module stores the classes (Organism, Scaffold, Hit) used in cblaster.
 
 import re
 import json
+import sys
 
+from cblaster import session_io
 from cblaster.formatters import (
-    binary,
-    summary,
     summarise_scaffold,
     summarise_organism,
+    write_binary,
+    write_summary,
 )
 
 
+def intern(value):
+    """Interns a string, so that repeated values share a single object."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
 class Serializer:
     """JSON serialisation mixin class.
 
@@ -22,6 +29,8 @@ class Serializer:
     `from_dict` methods.
     """
 
+    __slots__ = ()
+
     def to_dict(self):
         """Serialises class to dict."""
         raise NotImplementedError
@@ -98,19 +107,89 @@ class Session(Serializer):
 
     @classmethod
     def from_file(cls, file):
+        """Loads a Session from a JSON or binary session file.
+
+        Binary sessions (see session_io) are detected by their magic bytes, and
+        are loaded one organism at a time.
+        """
+        if session_io.is_binary(file):
+            with session_io.SessionReader(file) as reader:
+                return cls(
+                    queries=reader.queries,
+                    sequences=reader.sequences,
+                    params=reader.params,
+                    organisms=[Organism.from_dict(o) for o in reader],
+                )
         with open(file) as fp:
             s = cls.from_json(fp)
         return s
 
+    def to_file(self, file, indent=None):
+        """Writes this Session to a file.
+
+        If the file has the .cbs extension, the Session is written in the binary
+        session format one organism at a time (see session_io). Otherwise, it is
+        written as JSON, along with an index of the byte offsets of each organism
+        and scaffold (see session_io.write_json()).
+        """
+        if str(file).endswith(session_io.EXTENSION):
+            with session_io.SessionWriter(
+                file, self.queries, self.sequences, self.params
+            ) as writer:
+                for organism in self.organisms:
+                    writer.write(organism.to_dict())
+        else:
+            session_io.write_json(
+                file,
+                self.queries,
+                self.sequences,
+                self.params,
+                (organism.to_dict() for organism in self.organisms),
+                indent=indent,
+            )
+
     @classmethod
-    def from_files(cls, files):
-        if len(files) == 1:
-            return cls.from_file(files[0])
-        first, *rest = files
-        s = cls.from_file(first)
-        for f in rest:
-            s += cls.from_file(f)
-        return s
+    def from_files(cls, files, recompute=None):
+        """Loads and merges Sessions from several session files.
+
+        Sessions are loaded one at a time. Organisms with the same name and strain,
+        and scaffolds with the same accession, are merged (see Organism.merge()), so
+        this takes linear time in the total number of organisms.
+
+        Args:
+            files (list): Paths to session files
+            recompute (dict): Keyword arguments for ColumnarSession.filter(). If
+                given, hits are filtered and clusters recomputed once, after merging.
+        Raises:
+            ValueError: Query sequences of the sessions do not match
+        Returns:
+            Session object
+        """
+        merged = None
+        organisms = {}
+        for file in files:
+            session = cls.from_file(file)
+            if merged is None:
+                merged = cls(
+                    queries=session.queries,
+                    sequences=session.sequences,
+                    params=session.params,
+                )
+            elif session.queries != merged.queries:
+                raise ValueError("Query sequences do not match")
+            for organism in session.organisms:
+                key = (organism.name, organism.strain)
+                if key in organisms:
+                    organisms[key].merge(organism)
+                else:
+                    organisms[key] = organism
+        merged.organisms = list(organisms.values())
+        if recompute is not None:
+            from cblaster.columnar import ColumnarSession
+
+            merged = ColumnarSession.from_session(merged).filter(**recompute)
+            merged = merged.to_session()
+        return merged
 
     @classmethod
     def from_dict(cls, d):
@@ -122,23 +201,25 @@ class Session(Serializer):
         )
 
     def format(self, form, fp=None, **kwargs):
-        """Generates a summary table.
+        """Writes a summary table.
+
+        Tables are written to the file handle incrementally (see
+        formatters.write_summary() and formatters.write_binary()).
 
         Args:
             form (str): Type of table to generate ('summary' or 'binary').
-            fp (file handle): File handle to write to.
+            fp (file handle): File handle to write to (default: stdout).
         Raises:
             ValueError: `form` not 'binary' or 'summary'
-        Returns:
-            Summary table.
         """
+        if fp is None:
+            fp = sys.stdout
         if form == "summary":
-            table = summary(self, **kwargs)
+            write_summary(self, fp, **kwargs)
         elif form == "binary":
-            table = binary(self, **kwargs)
+            write_binary(self, fp, **kwargs)
         else:
             raise ValueError("Expected 'summary' or 'binary'")
-        print(table, file=fp)
 
 
 class Organism(Serializer):
@@ -154,8 +235,8 @@ class Organism(Serializer):
     """
 
     def __init__(self, name, strain, scaffolds=None):
-        self.name = name
-        self.strain = strain
+        self.name = intern(name)
+        self.strain = intern(strain)
         self.scaffolds = scaffolds if scaffolds else {}
 
     def __str__(self):
@@ -194,6 +275,17 @@ class Organism(Serializer):
         else:
             return f"{self.name} {self.strain}" if self.strain else self.name
 
+    def merge(self, other):
+        """Merges the scaffolds of another Organism into this one.
+
+        Scaffolds with the same accession are merged (see Scaffold.merge()).
+        """
+        for accession, scaffold in other.scaffolds.items():
+            if accession in self.scaffolds:
+                self.scaffolds[accession].merge(scaffold)
+            else:
+                self.scaffolds[accession] = scaffold
+
     def to_dict(self):
         return {
             "name": self.name,
@@ -243,14 +335,85 @@ class Scaffold(Serializer):
             query_sequence_order (list): list of sequences of the order in the query file, is
             only provided if the query has a meningfull order (gbk, embl files).
         """
-        for subjects in subject_lists:
-            indices = [self.subjects.index(subject) for subject in subjects]
+        # Subjects are matched by identity first, since comparing Subject objects
+        # (see Subject.__eq__) is expensive
+        positions = {id(subject): i for i, subject in enumerate(self.subjects)}
+        self.add_cluster_indices(
+            [
+                [
+                    positions[id(subject)]
+                    if id(subject) in positions
+                    else self.subjects.index(subject)
+                    for subject in subjects
+                ]
+                for subjects in subject_lists
+            ],
+            query_sequence_order=query_sequence_order,
+        )
+
+    def add_cluster_indices(self, index_lists, query_sequence_order=None):
+        """Add clusters to this scaffold from the indices of their subjects
+
+        After clusters are added they are sorted based on score
+
+        Args:
+            index_lists (list): a list of lists of indices of Subject objects in
+            this scaffold that form clusters, e.g. from context.find_cluster_indices()
+            query_sequence_order (list): list of sequences of the order in the query file, is
+            only provided if the query has a meningfull order (gbk, embl files).
+        """
+        for indices in index_lists:
             cluster = Cluster(
-                indices, subjects, query_sequence_order=query_sequence_order
+                list(indices),
+                [self.subjects[i] for i in indices],
+                query_sequence_order=query_sequence_order,
             )
             self.clusters.append(cluster)
         self.clusters.sort(key=lambda x: x.score, reverse=True)
 
+    def merge(self, other):
+        """Merges the subjects and clusters of another Scaffold into this one.
+
+        Subjects with the same name and location are merged, keeping hits against
+        any queries not already hit. Clusters of the other Scaffold are added unless
+        they contain the same subjects as an existing cluster. Clusters are not
+        recomputed, so merged clusters may overlap.
+        """
+        positions = {
+            (subject.name, subject.start, subject.end, subject.strand): i
+            for i, subject in enumerate(self.subjects)
+        }
+        mapping = []
+        for subject in other.subjects:
+            key = (subject.name, subject.start, subject.end, subject.strand)
+            if key in positions:
+                existing = self.subjects[positions[key]]
+                queries = {hit.query for hit in existing.hits}
+                existing.hits.extend(
+                    hit for hit in subject.hits if hit.query not in queries
+                )
+            else:
+                positions[key] = len(self.subjects)
+                self.subjects.append(subject)
+            mapping.append(positions[key])
+
+        seen = {tuple(cluster.indices) for cluster in self.clusters}
+        for cluster in other.clusters:
+            indices = [mapping[i] for i in cluster.indices]
+            if tuple(indices) in seen:
+                continue
+            seen.add(tuple(indices))
+            self.clusters.append(
+                Cluster(
+                    indices,
+                    [self.subjects[i] for i in indices],
+                    score=cluster.score,
+                    start=cluster.start,
+                    end=cluster.end,
+                )
+            )
+        self.clusters.sort(key=lambda x: x.score, reverse=True)
+
     def summary(self, hide_headers=False, delimiter=None, decimals=4):
         return summarise_scaffold(
             self, decimals=decimals, hide_headers=hide_headers, delimiter=delimiter,
@@ -285,6 +448,8 @@ class Cluster(Serializer):
         end (int): The end coordinate of the cluster on the parent scaffold
     """
 
+    __slots__ = ("indices", "subjects", "score", "start", "end")
+
     def __init__(
         self,
         indices=None,
@@ -378,14 +543,19 @@ class Subject(Serializer):
         start (int): Start of sequence on parent scaffold.
         end (int): End of sequence on parent scaffold.
         strand (str): Strandedness of the sequence ('+' or '-').
+
+    Hit objects may be shared between Subject objects (see
+    context.parse_IPG_table), so should be treated as immutable.
     """
 
+    __slots__ = ("hits", "name", "ipg", "start", "end", "strand")
+
     def __init__(
         self, hits=None, name=None, ipg=None, start=None, end=None, strand=None
     ):
         self.hits = hits if hits else []
         self.ipg = ipg
-        self.name = name
+        self.name = intern(name)
         self.start = int(start) if start is not None else None
         self.end = int(end) if end is not None else None
         self.strand = strand
@@ -451,13 +621,15 @@ class Hit(Serializer):
         bitscore (float): Bitscore of hit.
     """
 
+    __slots__ = ("query", "subject", "identity", "coverage", "evalue", "bitscore")
+
     def __init__(self, query, subject, identity, coverage, evalue, bitscore):
-        self.query = query
+        self.query = intern(query)
 
         if "gb" in subject or "ref" in subject:
             subject = re.search(r"\|([A-Za-z0-9\._]+)\|", subject).group(1)
 
-        self.subject = subject
+        self.subject = intern(subject)
         self.bitscore = float(bitscore)
         self.identity = float(identity)
         self.coverage = float(coverage)
@@ -482,7 +654,9 @@ class Hit(Serializer):
 
     def copy(self, **kwargs):
         """Creates a copy of this Hit with any additional args."""
-        copy = Hit(**self.__dict__)
+        copy = Hit.__new__(Hit)
+        for key in self.__slots__:
+            setattr(copy, key, getattr(self, key))
         for key, val in kwargs.items():
             setattr(copy, key, val)
         return copy
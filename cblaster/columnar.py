@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+"""
+This module provides a columnar representation of cblaster search sessions.
+
+Instead of nested Organism, Scaffold, Subject and Hit objects, a ColumnarSession
+stores each level of a Session as NumPy arrays, with every row linked to its parent
+by index. Hits (query index, subject index, identity, coverage, evalue, bitscore)
+are stored in subject order, and subjects (scaffold index, start, end, strand) in
+scaffold order.
+
+Filtering a session with new thresholds is then a vectorised mask over the hit
+table, and cluster detection a scan over subjects sorted by scaffold and start:
+
+>>> columns = ColumnarSession.from_session(session)
+>>> filtered = columns.filter(min_identity=50, gap=10000)
+>>> session = filtered.to_session()
+
+Conversion to and from Session objects is lossless, so the filtered session can be
+passed to formatters, plotting, etc. as usual.
+"""
+
+import logging
+
+import numpy as np
+
+from cblaster.classes import Cluster, Hit, Organism, Scaffold, Session, Subject
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ColumnarSession:
+    """A cblaster search Session stored as NumPy arrays.
+
+    Attributes:
+        queries (list): Names of query sequences.
+        sequences (dict): Query sequences.
+        params (dict): Search parameters.
+        query_names (list): Names of queries referenced by hit_query; these are the
+            session queries followed by any other queries found in hits.
+        organism_name (list): Name of each organism.
+        organism_strain (list): Strain of each organism.
+        scaffold_organism (np.ndarray): Organism index of each scaffold.
+        scaffold_accession (list): Accession of each scaffold.
+        subject_scaffold (np.ndarray): Scaffold index of each subject.
+        subject_start (np.ndarray): Start of each subject.
+        subject_end (np.ndarray): End of each subject.
+        subject_strand (np.ndarray): Strand of each subject, as an index into strands.
+        strands (list): Distinct strand values, e.g. ["+", "-"].
+        subject_name (list): Name of each subject.
+        subject_ipg (list): IPG of each subject.
+        hit_subject (np.ndarray): Subject index of each hit.
+        hit_query (np.ndarray): Query index (into query_names) of each hit.
+        hit_name (list): Subject name stored on each hit.
+        hit_identity (np.ndarray): Identity (%) of each hit.
+        hit_coverage (np.ndarray): Coverage (%) of each hit.
+        hit_evalue (np.ndarray): E-value of each hit.
+        hit_bitscore (np.ndarray): Bitscore of each hit.
+        cluster_scaffold (np.ndarray): Scaffold index of each cluster.
+        cluster_score (np.ndarray): Score of each cluster.
+        cluster_start (np.ndarray): Start of each cluster.
+        cluster_end (np.ndarray): End of each cluster.
+        cluster_offsets (np.ndarray): Offsets of each cluster in cluster_indices.
+        cluster_indices (np.ndarray): Indices of cluster subjects, relative to the
+            first subject on their scaffold (i.e. as in Cluster.indices).
+    """
+
+    def __init__(self, **columns):
+        for key, value in columns.items():
+            setattr(self, key, value)
+
+    def copy(self, **columns):
+        """Creates a copy of this ColumnarSession, replacing any given columns."""
+        return ColumnarSession(**{**self.__dict__, **columns})
+
+    @property
+    def scaffold_offsets(self):
+        """Index of the first subject of each scaffold, and the total subjects."""
+        counts = np.bincount(
+            self.subject_scaffold, minlength=len(self.scaffold_accession)
+        )
+        return np.concatenate([[0], np.cumsum(counts)])
+
+    @classmethod
+    def from_session(cls, session):
+        """Builds a ColumnarSession from a Session object."""
+        query_names = list(session.queries)
+        query_index = {}
+        for i, query in enumerate(query_names):
+            query_index.setdefault(query, i)
+
+        organism_name, organism_strain = [], []
+        scaffold_organism, scaffold_accession = [], []
+        subject_scaffold, subject_start, subject_end, subject_strand = [], [], [], []
+        subject_name, subject_ipg, strands = [], [], {}
+        hit_subject, hit_query, hit_name, hit_scores = [], [], [], []
+        cluster_scaffold, cluster_scores, cluster_indices = [], [], []
+        cluster_offsets = [0]
+
+        for organism in session.organisms:
+            organism_name.append(organism.name)
+            organism_strain.append(organism.strain)
+            for scaffold in organism.scaffolds.values():
+                scaffold_index = len(scaffold_accession)
+                scaffold_organism.append(len(organism_name) - 1)
+                scaffold_accession.append(scaffold.accession)
+                for subject in scaffold.subjects:
+                    subject_index = len(subject_name)
+                    subject_scaffold.append(scaffold_index)
+                    subject_start.append(subject.start)
+                    subject_end.append(subject.end)
+                    subject_strand.append(
+                        strands.setdefault(subject.strand, len(strands))
+                    )
+                    subject_name.append(subject.name)
+                    subject_ipg.append(subject.ipg)
+                    for hit in subject.hits:
+                        if hit.query not in query_index:
+                            query_index[hit.query] = len(query_names)
+                            query_names.append(hit.query)
+                        hit_subject.append(subject_index)
+                        hit_query.append(query_index[hit.query])
+                        hit_name.append(hit.subject)
+                        hit_scores.append(
+                            (hit.identity, hit.coverage, hit.evalue, hit.bitscore)
+                        )
+                for cluster in scaffold.clusters:
+                    cluster_scaffold.append(scaffold_index)
+                    cluster_scores.append((cluster.score, cluster.start, cluster.end))
+                    cluster_indices.extend(cluster.indices)
+                    cluster_offsets.append(len(cluster_indices))
+
+        hit_scores = np.array(hit_scores, dtype=float).reshape(-1, 4)
+        cluster_scores = np.array(cluster_scores, dtype=float).reshape(-1, 3)
+
+        return cls(
+            queries=session.queries,
+            sequences=session.sequences,
+            params=session.params,
+            query_names=query_names,
+            organism_name=organism_name,
+            organism_strain=organism_strain,
+            scaffold_organism=np.array(scaffold_organism, dtype=np.int64),
+            scaffold_accession=scaffold_accession,
+            subject_scaffold=np.array(subject_scaffold, dtype=np.int64),
+            subject_start=np.array(subject_start, dtype=np.int64),
+            subject_end=np.array(subject_end, dtype=np.int64),
+            subject_strand=np.array(subject_strand, dtype=np.int8),
+            strands=list(strands),
+            subject_name=subject_name,
+            subject_ipg=subject_ipg,
+            hit_subject=np.array(hit_subject, dtype=np.int64),
+            hit_query=np.array(hit_query, dtype=np.int64),
+            hit_name=hit_name,
+            hit_identity=hit_scores[:, 0],
+            hit_coverage=hit_scores[:, 1],
+            hit_evalue=hit_scores[:, 2],
+            hit_bitscore=hit_scores[:, 3],
+            cluster_scaffold=np.array(cluster_scaffold, dtype=np.int64),
+            cluster_score=cluster_scores[:, 0],
+            cluster_start=cluster_scores[:, 1].astype(np.int64),
+            cluster_end=cluster_scores[:, 2].astype(np.int64),
+            cluster_offsets=np.array(cluster_offsets, dtype=np.int64),
+            cluster_indices=np.array(cluster_indices, dtype=np.int64),
+        )
+
+    def to_session(self):
+        """Builds a Session object from this ColumnarSession."""
+        hit_offsets = np.searchsorted(
+            self.hit_subject, np.arange(len(self.subject_name) + 1)
+        )
+        scaffold_offsets = self.scaffold_offsets
+        cluster_bounds = np.searchsorted(
+            self.cluster_scaffold, np.arange(len(self.scaffold_accession) + 1)
+        )
+        queries = self.query_names
+        identity = self.hit_identity.tolist()
+        coverage = self.hit_coverage.tolist()
+        evalue = self.hit_evalue.tolist()
+        bitscore = self.hit_bitscore.tolist()
+        hit_query = self.hit_query.tolist()
+        starts = self.subject_start.tolist()
+        ends = self.subject_end.tolist()
+        strands = self.subject_strand.tolist()
+
+        organisms = [
+            Organism(name, strain)
+            for name, strain in zip(self.organism_name, self.organism_strain)
+        ]
+        for s, (o, accession) in enumerate(
+            zip(self.scaffold_organism.tolist(), self.scaffold_accession)
+        ):
+            first, last = scaffold_offsets[s], scaffold_offsets[s + 1]
+            subjects = [
+                Subject(
+                    hits=[
+                        Hit(
+                            queries[hit_query[h]],
+                            self.hit_name[h],
+                            identity[h],
+                            coverage[h],
+                            evalue[h],
+                            bitscore[h],
+                        )
+                        for h in range(hit_offsets[i], hit_offsets[i + 1])
+                    ],
+                    name=self.subject_name[i],
+                    ipg=self.subject_ipg[i],
+                    start=starts[i],
+                    end=ends[i],
+                    strand=self.strands[strands[i]],
+                )
+                for i in range(first, last)
+            ]
+            clusters = []
+            for c in range(cluster_bounds[s], cluster_bounds[s + 1]):
+                indices = self.cluster_indices[
+                    self.cluster_offsets[c]: self.cluster_offsets[c + 1]
+                ].tolist()
+                clusters.append(
+                    Cluster(
+                        indices=indices,
+                        subjects=[subjects[i] for i in indices],
+                        score=float(self.cluster_score[c]),
+                        start=int(self.cluster_start[c]),
+                        end=int(self.cluster_end[c]),
+                    )
+                )
+            organisms[o].scaffolds[accession] = Scaffold(
+                accession, subjects=subjects, clusters=clusters
+            )
+
+        return Session(
+            queries=self.queries,
+            sequences=self.sequences,
+            params=self.params,
+            organisms=organisms,
+        )
+
+    def hit_mask(self, min_identity=30, min_coverage=50, max_evalue=0.01):
+        """Finds hits surpassing score thresholds.
+
+        Returns:
+            np.ndarray: Boolean mask over the hit table.
+        """
+        return (
+            (self.hit_identity > min_identity)
+            & (self.hit_coverage > min_coverage)
+            & (self.hit_evalue < max_evalue)
+        )
+
+    def filter(
+        self,
+        min_identity=30,
+        min_coverage=50,
+        max_evalue=0.01,
+        gap=20000,
+        unique=3,
+        min_hits=3,
+        require=None,
+        deduplicate_organisms=False,
+    ):
+        """Filters this session with new thresholds.
+
+        This gives the same result as context.filter_session(), but returns a new
+        ColumnarSession rather than modifying this one.
+
+        Returns:
+            ColumnarSession: Session containing only hits surpassing the thresholds,
+                and the clusters they form.
+        """
+        if unique < 0 or min_hits < 0 or gap < 0:
+            raise ValueError("Expected positive integer")
+        mask = self.hit_mask(min_identity, min_coverage, max_evalue)
+        filtered = self.copy(
+            hit_subject=self.hit_subject[mask],
+            hit_query=self.hit_query[mask],
+            hit_name=[name for name, keep in zip(self.hit_name, mask) if keep],
+            hit_identity=self.hit_identity[mask],
+            hit_coverage=self.hit_coverage[mask],
+            hit_evalue=self.hit_evalue[mask],
+            hit_bitscore=self.hit_bitscore[mask],
+        )
+        clusters = filtered.find_clusters(
+            gap=gap, unique=unique, min_hits=min_hits, require=require
+        )
+        clusters = filtered.deduplicate(clusters, across=deduplicate_organisms)
+        return filtered.copy(**clusters)
+
+    def find_clusters(self, gap=20000, unique=3, min_hits=3, require=None):
+        """Finds clusters of subjects on each scaffold.
+
+        Subjects with hits are sorted by scaffold and start, then split wherever a
+        subject starts more than gap bp past the furthest end of the subjects before
+        it (i.e. the same rule as context.find_clusters()). The subject count,
+        unique queries and required queries of each run are then counted with
+        bincounts over the hit table.
+
+        Returns:
+            dict: Cluster columns (see ColumnarSession), sorted by scaffold then by
+                descending score.
+        """
+        total_subjects = len(self.subject_name)
+        total_scaffolds = len(self.scaffold_accession)
+        total_queries = len(self.query_names)
+        scaffold_offsets = self.scaffold_offsets
+
+        # Only subjects with hits can form clusters
+        active = np.flatnonzero(
+            np.bincount(self.hit_subject, minlength=total_subjects) > 0
+        )
+        scaffolds = self.subject_scaffold[active]
+        active_counts = np.bincount(scaffolds, minlength=total_scaffolds)
+        order = active[np.lexsort((self.subject_start[active], scaffolds))]
+        scaffolds = self.subject_scaffold[order]
+
+        # Offset coordinates per scaffold so a running maximum of subject ends never
+        # carries over from one scaffold to the next
+        span = int(self.subject_end.max(initial=0)) + gap + 1
+        starts = self.subject_start[order] + scaffolds * span
+        ends = self.subject_end[order] + scaffolds * span
+        border = np.maximum.accumulate(ends)
+        breaks = np.ones(len(order), dtype=bool)
+        breaks[1:] = (starts[1:] > border[:-1] + gap) | (scaffolds[1:] != scaffolds[:-1])
+        run = np.cumsum(breaks) - 1
+        total_runs = int(run[-1]) + 1 if len(run) else 0
+
+        # Map each subject to its run, then count subjects and queries per run
+        subject_run = np.full(total_subjects, -1, dtype=np.int64)
+        subject_run[order] = run
+        hit_run = subject_run[self.hit_subject]
+        pairs = np.unique(hit_run * total_queries + self.hit_query)
+        unique_queries = np.bincount(pairs // total_queries, minlength=total_runs)
+        sizes = np.bincount(run, minlength=total_runs)
+        satisfied = (sizes >= min_hits) & (unique_queries >= unique)
+        if require:
+            for query in set(require):
+                if query not in self.query_names:
+                    satisfied[:] = False
+                    break
+                index = self.query_names.index(query)
+                present = np.zeros(total_runs, dtype=bool)
+                present[pairs[pairs % total_queries == index] // total_queries] = True
+                satisfied &= present
+
+        # Scaffolds with less subjects with hits than unique, or just one subject
+        # with hits, are never clustered by context.filter_session()
+        valid = (active_counts >= unique) & (active_counts != 1)
+        run_scaffold = scaffolds[breaks]
+        satisfied &= valid[run_scaffold]
+
+        # Best hit (first hit with the highest bitscore) of every subject
+        best_bitscore = np.full(total_subjects, -np.inf)
+        np.maximum.at(best_bitscore, self.hit_subject, self.hit_bitscore)
+        is_best = self.hit_bitscore == best_bitscore[self.hit_subject]
+        best_subjects, first = np.unique(self.hit_subject[is_best], return_index=True)
+        best_query = np.full(total_subjects, -1, dtype=np.int64)
+        best_query[best_subjects] = self.hit_query[is_best][first]
+        synteny = bool(self.queries)
+        best_bitscore = best_bitscore.tolist()
+        best_query = best_query.tolist()
+        session_queries = len(self.queries)
+
+        run_starts = np.flatnonzero(breaks).tolist() + [len(order)]
+        order = order.tolist()
+        clusters = [[] for _ in range(total_scaffolds)]
+        for r in np.flatnonzero(satisfied).tolist():
+            subjects = order[run_starts[r]: run_starts[r + 1]]
+            scaffold = int(run_scaffold[r])
+            synteny_score = 0
+            if synteny:
+                positions = [best_query[i] for i in subjects]
+                if any(position >= session_queries for position in positions):
+                    raise ValueError("Hit query not found in session queries")
+                synteny_score = sum(
+                    1 for a, b in zip(positions, positions[1:]) if abs(a - b) == 1
+                )
+            bitscore = sum(best_bitscore[i] for i in subjects)
+            score = bitscore / 10000 + len(subjects) + synteny_score
+            clusters[scaffold].append(
+                (
+                    score,
+                    [i - scaffold_offsets[scaffold] for i in subjects],
+                    int(self.subject_start[subjects[0]]),
+                    int(self.subject_end[subjects[-1]]),
+                )
+            )
+
+        return self._cluster_columns(
+            (scaffold, cluster)
+            for scaffold, found in enumerate(clusters)
+            for cluster in sorted(found, key=lambda c: c[0], reverse=True)
+        )
+
+    def deduplicate(self, clusters, across=False):
+        """Removes duplicate clusters, as in context.deduplicate().
+
+        Args:
+            clusters (dict): Cluster columns, e.g. from find_clusters().
+            across (bool): Also remove clusters identical to those in previous
+                organisms.
+        Returns:
+            dict: Cluster columns without duplicate clusters.
+        """
+        scaffold_offsets = self.scaffold_offsets
+        scaffold_organism = self.scaffold_organism.tolist()
+        offsets = clusters["cluster_offsets"].tolist()
+        indices = clusters["cluster_indices"].tolist()
+        keep = []
+        seen, pending = set(), []
+        organism = current = None
+        for c, scaffold in enumerate(clusters["cluster_scaffold"].tolist()):
+            if scaffold != current:
+                # Clusters are only compared to those on earlier scaffolds
+                seen.update(pending)
+                pending, current = [], scaffold
+                if not across and scaffold_organism[scaffold] != organism:
+                    seen, organism = set(), scaffold_organism[scaffold]
+            first = scaffold_offsets[scaffold]
+            ipgs = tuple(
+                self.subject_ipg[first + i] for i in indices[offsets[c]: offsets[c + 1]]
+            )
+            signature = ipgs if all(ipgs) else None
+            keep.append(signature is None or signature not in seen)
+            if signature:
+                pending.append(signature)
+
+        return self._cluster_columns(
+            (
+                scaffold,
+                (
+                    clusters["cluster_score"][c],
+                    indices[offsets[c]: offsets[c + 1]],
+                    clusters["cluster_start"][c],
+                    clusters["cluster_end"][c],
+                ),
+            )
+            for c, scaffold in enumerate(clusters["cluster_scaffold"].tolist())
+            if keep[c]
+        )
+
+    @staticmethod
+    def _cluster_columns(clusters):
+        """Builds cluster columns from (scaffold, (score, indices, start, end))."""
+        scaffolds, scores, starts, ends, indices = [], [], [], [], []
+        offsets = [0]
+        for scaffold, (score, cluster, start, end) in clusters:
+            scaffolds.append(scaffold)
+            scores.append(score)
+            starts.append(start)
+            ends.append(end)
+            indices.extend(cluster)
+            offsets.append(len(indices))
+        return dict(
+            cluster_scaffold=np.array(scaffolds, dtype=np.int64),
+            cluster_score=np.array(scores, dtype=float),
+            cluster_start=np.array(starts, dtype=np.int64),
+            cluster_end=np.array(ends, dtype=np.int64),
+            cluster_offsets=np.array(offsets, dtype=np.int64),
+            cluster_indices=np.array(indices, dtype=np.int64),
+        )
@@ -27,64 +27,134 @@ objects linking them to the query sequences.
 """
 
 
+import bisect
 import logging
 from collections import defaultdict, namedtuple
-from itertools import combinations, product
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from operator import attrgetter
 from functools import partial
 
 import requests
 import numpy as np
 
-from cblaster import database
-from cblaster.classes import Organism, Scaffold, Subject
+from cblaster import database, helpers
+from cblaster.classes import Cluster, Organism, Scaffold, Subject, intern
 
 
 LOG = logging.getLogger(__name__)
 
 
-def efetch_IPGs(ids, output_handle=None):
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?"
+
+# Minimum total subjects for clusters to be found in a process pool; below this,
+# starting the pool and copying organisms to it costs more than it saves
+POOL_MIN_SUBJECTS = 50000
+
+
+def efetch_IPG_chunk(ids, api_key=None, limiter=None):
+    """Queries the Identical Protein Groups (IPG) resource for a single chunk of IDs.
+
+    Args:
+        ids (list): Valid NCBI sequence identifiers (at most 10000).
+        api_key (str): NCBI API key.
+        limiter (helpers.RateLimiter): Shared rate limiter to wait on before sending
+            the request, and before each retry.
+    Raises:
+        requests.HTTPError: Received bad status code from NCBI.
+    Returns:
+        IPG table text returned by NCBI.
+    """
+    params = {
+        "db": "protein",
+        "rettype": "ipg",
+        "retmode": "text",
+        "retmax": 10000,
+    }
+    if api_key:
+        params["api_key"] = api_key
+
+    response = helpers.get_client().post(
+        helpers.ncbi_url(EFETCH_URL),
+        params=params,
+        data={"id": ",".join(ids)},
+        limiter=limiter,
+    )
+
+    if response.status_code != 200:
+        raise requests.HTTPError(
+            f"Error fetching sequences from NCBI [code {response.status_code}]."
+        )
+
+    return response.text
+
+
+def efetch_IPGs(
+    ids,
+    output_handle=None,
+    api_key=None,
+    max_workers=3,
+    requests_per_second=None,
+    cache=None,
+):
     """Queries the Identical Protein Groups (IPG) resource for given IDs.
 
     The NCBI caps Efetch requests at 10000 maximum returned records (retmax=10000)
-    so this function splits the supplied IDs into chunks of 10000 and queries NCBI
-    individually for each chunk.
+    so this function splits the supplied IDs into chunks of 10000. Chunks are fetched
+    concurrently by a pool of worker threads, which share a rate limiter to stay under
+    the E-utilities usage limits (3 requests per second, or 10 with an API key).
+
+    If a cache is given, any IDs belonging to previously retrieved IPGs are served
+    from it, only the remaining IDs are sent to NCBI, and the cache is then updated
+    with the new results.
 
     Args:
         ids (list): Valid NCBI sequence identifiers.
         output_handle (file handle): File handle to write to.
+        api_key (str): NCBI API key.
+        max_workers (int): Maximum number of concurrent requests.
+        requests_per_second (float): Maximum request rate. If not given, this is
+            determined by whether an API key is provided.
+        cache (cache.IPGCache): Persistent cache of IPG table rows.
     Returns:
-        List of rows from resulting IPG table, split by newline.
+        Iterator of rows from resulting IPG table, split by newline.
     """
 
+    cached = []
+    if cache:
+        cached, ids = cache.lookup(ids)
+        LOG.info("Found %i cached IPG rows, fetching %i new IDs", len(cached), len(ids))
+
     # Split into chunks since retmax=10000
     chunks = [ids[i: i + 10000] for i in range(0, len(ids), 10000)]
 
-    table = ""
-    for ix, chunk in enumerate(chunks, 1):
-        response = requests.post(
-            "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?",
-            params={
-                "db": "protein",
-                "rettype": "ipg",
-                "retmode": "text",
-                "retmax": 10000,
-            },
-            data={"id": ",".join(chunk)},
-        )
+    if not requests_per_second:
+        requests_per_second = 10 if api_key else 3
 
-        if response.status_code != 200:
-            raise requests.HTTPError(
-                f"Error fetching sequences from NCBI [code {response.status_code}]."
-            )
+    fetch = partial(
+        efetch_IPG_chunk,
+        api_key=api_key,
+        limiter=helpers.RateLimiter(requests_per_second),
+    )
 
-        table += response.text
+    LOG.debug("Fetching %i IPG chunks with %i workers", len(chunks), max_workers)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        tables = list(pool.map(fetch, chunks))
+
+    rows = [table.split("\n") for table in tables]
+
+    if cache:
+        cache.update(row for table in rows for row in table)
+
+    if cached:
+        rows.insert(0, cached)
+        tables.insert(0, "\n".join(cached) + "\n")
 
     if output_handle:
         LOG.info("Writing IPG table to %s", output_handle.name)
-        output_handle.write(table)
+        output_handle.writelines(tables)
 
-    return table.split("\n")
+    return (row for table in rows for row in table)
 
 
 def parse_IP_groups(results):
@@ -178,6 +248,10 @@ def parse_IPG_table(results, hits):
     # Parse IPGs from the table
     groups = parse_IP_groups(results)
 
+    # Copies of each Hit are shared between Subjects with the same protein ID, e.g.
+    # a RefSeq WP_ protein found in many genomes
+    copies = {}
+
     seen = set()
     organisms = defaultdict(dict)
     for ipg in list(groups):
@@ -218,8 +292,14 @@ def parse_IPG_table(results, hits):
                 organisms[org][st].scaffolds[acc] = Scaffold(acc)
 
             # Copy the original Hit object and add contextual information
+            hits = []
+            for hit in hit_list:
+                key = (id(hit), entry.protein_id)
+                if key not in copies:
+                    copies[key] = hit.copy(subject=intern(entry.protein_id))
+                hits.append(copies[key])
             subject = Subject(
-                hits=[hit.copy(subject=entry.protein_id) for hit in hit_list],
+                hits=hits,
                 name=entry.protein_id,
                 ipg=ipg,
                 end=int(entry.end),
@@ -236,52 +316,46 @@ def parse_IPG_table(results, hits):
     ]
 
 
-def find_identifier(qualifiers):
-    """Finds an identifier from a dictionary of feature qualifiers.
-
-    This function selects for the following fields in decreasing order:
-    protein_id, locus_tag, ID and Gene. This should cover most cases where CDS
-    features do not have protein ID's.
-
-    Args:
-        qualifiers (dict): Feature qualifiers parsed with genome2json.
-    Returns:
-        Identifier, if found, otherwise None.
-    """
-    for field in ("protein_id", "locus_tag", "ID", "Gene"):
-        try:
-            return qualifiers[field]
-        except KeyError:
-            pass
-    return None
-
-
 def query_local_DB(hits, database):
-    """Build Organisms/Scaffolds using database.DB instance.
+    """Build Organisms/Scaffolds using a cblaster database.
 
-    This function essentially mirrors parse_IPG_table, but is adapted to the JSON
-    database created using cblaster makedb. Protein headers in the DIAMOND database
+    This function essentially mirrors parse_IPG_table, but is adapted to the databases
+    created using cblaster makedb. Protein headers in the DIAMOND database
     follow the form "i_j_k" where i, j and k refer to the database indexes of organisms,
     scaffolds and proteins, respectively. For example, >2_56_123 refers to the 123rd
     protein of the 56th scaffold of the 2nd organism in the database. Context of each
     hit is found by directly accessing those indices in the database, and then
     Organism, Scaffold and Subject objects are generated as in parse_IPG_table.
 
+    Hits are consumed as they are iterated, so a stream of hits from a running search
+    (see local.search()) is looked up in the database while the search continues.
+    Each protein is looked up on the first hit against it, and later hits against
+    the same protein are added to its Subject.
+
     Args:
-        hits (list): Hit objects created during cblaster search.
-        database (database.DB): cblaster database object.
+        hits (iterable): Hit objects created during cblaster search.
+        database (database.Database): cblaster database object, either a JSON
+            Database or an indexed DatabaseIndex.
     Returns:
         Organism objects containing hits sorted into genomic scaffolds.
     """
 
     organisms = defaultdict(dict)
 
-    # Form non-redundant dictionary of hits. Each key will become a unique Subject.
-    hit_dict = defaultdict(list)
-    for hit in hits:
-        hit_dict[hit.subject].append(hit)
+    # Subjects keyed by hit header, i.e. one per unique protein. Proteins that
+    # could not be looked up are kept as None, so they are only reported once
+    subjects = {}
+    total = 0
+    for total, hit in enumerate(hits, 1):
+        hit_index = hit.subject
+        if hit_index in subjects:
+            subject = subjects[hit_index]
+            if subject:
+                hit.subject = subject.name
+                subject.hits.append(hit)
+            continue
+        subjects[hit_index] = None
 
-    for hit_index, hits in hit_dict.items():
         # Hit headers should follow form "i_j_k", where i, j and k refer to the
         # database indexes of organisms, scaffolds and proteins, respectively.
         # e.g. >2_56_123 => 123rd protein of 56th scaffold of the 2nd organism
@@ -289,15 +363,14 @@ def query_local_DB(hits, database):
             i, j, k = [int(index) for index in hit_index.split("_")]
         except ValueError:
             LOG.exception("Hit has malformed header")
+            continue
 
-        organism = database.organisms[i]
-        scaffold = organism.scaffolds[j]
-        protein = scaffold.features[k]
+        protein = database.lookup(i, j, k)
 
         # For brevity...
-        org = organism.name
-        st = organism.strain
-        sc = scaffold.accession
+        org = protein.organism
+        st = protein.strain
+        sc = protein.scaffold
 
         # Instantiate new Organism/Scaffold objects on first encounter
         if st not in organisms[org]:
@@ -306,24 +379,25 @@ def query_local_DB(hits, database):
             organisms[org][st].scaffolds[sc] = Scaffold(sc)
 
         # Want to report just protein ID, not lineage
-        identifier = find_identifier(protein.qualifiers)
-        if not identifier:
-            LOG.warning("Could not find identifier for hit %, skipping", hit.subject)
+        if not protein.identifier:
+            LOG.warning("Could not find identifier for hit %s, skipping", hit_index)
             continue
-        for hit in hits:
-            hit.subject = identifier
+        hit.subject = protein.identifier
 
         # Save genomic location on the Hit instance
         subject = Subject(
-            name=identifier,
-            hits=hits,
-            start=protein.location.min(),
-            end=protein.location.max(),
-            strand=protein.location.strand
+            name=protein.identifier,
+            hits=[hit],
+            start=protein.start,
+            end=protein.end,
+            strand=protein.strand
         )
+        subjects[hit_index] = subject
 
         organisms[org][st].scaffolds[sc].subjects.append(subject)
 
+    LOG.info("Found %i hits meeting score thresholds", total)
+
     return [
         organism
         for strains in organisms.values()
@@ -345,17 +419,21 @@ def cluster_satisfies_conditions(cluster, require=None, unique=3, minimum=3):
     )
 
 
-def find_clusters(subjects, require=None, unique=3, min_hits=3, gap=20000):
-    """Finds clusters of Hit objects matching user thresholds.
+def find_cluster_indices(subjects, require=None, unique=3, min_hits=3, gap=20000):
+    """Finds clusters of Subject objects matching user thresholds.
+
+    Clusters are given as the positions of their Subjects in the subjects list, so
+    they can be added to a Scaffold without searching for each Subject (see
+    Scaffold.add_cluster_indices()).
 
     Args:
-        hits (list): Collection of Hit objects to find clusters in.
+        subjects (list): Collection of Subject objects to find clusters in.
         require (list): Names of query sequences that must be represented in a cluster.
         unique (int): Unique query sequence threshold.
         min_hits (int): Minimum number of hits in a hit cluster.
         gap (int): Maximum intergenic distance (bp) between any two hits in a cluster.
     Returns:
-        Clusters of Hit objects.
+        Clusters, as lists of indices of Subject objects in subjects.
     """
     if unique < 0 or min_hits < 0 or gap < 0:
         raise ValueError("Expected positive integer")
@@ -367,12 +445,12 @@ def find_clusters(subjects, require=None, unique=3, min_hits=3, gap=20000):
 
     if total_subjects == 1:
         if unique == 1 or min_hits == 1:
-            return [subjects]
+            return [[0]]
         return []
 
-    sorted_subjects = sorted(subjects, key=attrgetter("start"))
-    first = sorted_subjects.pop(0)
-    group, border = [first], first.end
+    order = sorted(range(total_subjects), key=lambda i: subjects[i].start)
+    first = order.pop(0)
+    group, border = [first], subjects[first].end
 
     rules_satisfied = partial(
         cluster_satisfies_conditions,
@@ -381,18 +459,41 @@ def find_clusters(subjects, require=None, unique=3, min_hits=3, gap=20000):
         minimum=min_hits
     )
 
-    for subject in sorted_subjects:
+    for index in order:
+        subject = subjects[index]
         if subject.start <= border + gap:
-            group.append(subject)
+            group.append(index)
             border = max(border, subject.end)
         else:
-            if rules_satisfied(group):
+            if rules_satisfied([subjects[i] for i in group]):
                 yield group
-            group, border = [subject], subject.end
-    if rules_satisfied(group):
+            group, border = [index], subject.end
+    if rules_satisfied([subjects[i] for i in group]):
         yield group
 
 
+def find_clusters(subjects, require=None, unique=3, min_hits=3, gap=20000):
+    """Finds clusters of Hit objects matching user thresholds.
+
+    Args:
+        hits (list): Collection of Hit objects to find clusters in.
+        require (list): Names of query sequences that must be represented in a cluster.
+        unique (int): Unique query sequence threshold.
+        min_hits (int): Minimum number of hits in a hit cluster.
+        gap (int): Maximum intergenic distance (bp) between any two hits in a cluster.
+    Returns:
+        Clusters of Hit objects.
+    """
+    for indices in find_cluster_indices(
+        subjects,
+        require=require,
+        unique=unique,
+        min_hits=min_hits,
+        gap=gap,
+    ):
+        yield [subjects[i] for i in indices]
+
+
 def clusters_are_identical(one, two):
     """Tests if two collections of Subject objects are identical.
 
@@ -409,22 +510,47 @@ def clusters_are_identical(one, two):
     return True
 
 
-def deduplicate(organism):
+def cluster_signature(cluster):
+    """Gets a hashable signature of a cluster, i.e. the IPGs of its Subjects in order.
+
+    Clusters with the same signature are identical as in clusters_are_identical().
+    If any Subject has no IPG, None is returned, since that cluster cannot be
+    identical to any other.
+    """
+    ipgs = tuple(subject.ipg for subject in cluster)
+    return ipgs if all(ipgs) else None
+
+
+def deduplicate(organism, seen=None):
     """Removes any duplicate clusters within an Organism.
 
     Some redundancy is unavoidable due to duplicate entries on NCBI. This function
     attempts to remedy this partially by searching for identical clusters within a
     single, unique Organism. Clusters are compared from start to finish, and are tagged
     for removal if every Subject is of the same IPG for the length of the clusters.
+    Of identical clusters, only those on the first scaffold they occur on are kept.
+
+    Clusters are reduced to their signature (see cluster_signature()), so this is a
+    single pass over the clusters of the organism rather than a comparison of every
+    pair of clusters on every pair of scaffolds.
+
+    Args:
+        organism (Organism): Organism to deduplicate.
+        seen (set): Signatures of clusters in previously deduplicated organisms.
+            Clusters identical to these are also removed, and the signatures of this
+            organism are added, so passing the same set when deduplicating each
+            organism removes duplicate clusters across organisms and strains.
     """
-    remove = defaultdict(list)
-    for scafA, scafB in combinations(organism.scaffolds.values(), 2):
-        for one, two in product(scafA.clusters, scafB.clusters):
-            if clusters_are_identical(one, two):
-                remove[scafB.accession].append(two)
-    for accession, clusters in remove.items():
-        scaffold = organism.scaffolds[accession]
-        scaffold.clusters = [c for c in scaffold.clusters if c not in clusters]
+    if seen is None:
+        seen = set()
+    for scaffold in organism.scaffolds.values():
+        signatures = [cluster_signature(cluster) for cluster in scaffold.clusters]
+        scaffold.clusters = [
+            cluster
+            for cluster, signature in zip(scaffold.clusters, signatures)
+            if signature is None or signature not in seen
+        ]
+        seen.update(signature for signature in signatures if signature)
 
 
 def find_clusters_in_organism(
@@ -434,18 +560,25 @@ def find_clusters_in_organism(
     gap=20000,
     require=None,
     remote=True,
-    query_sequence_order=None
+    query_sequence_order=None,
+    seen=None,
 ):
-    """Runs find_clusters() on all scaffolds in an organism."""
+    """Runs find_clusters() on all scaffolds in an organism.
+
+    If remote is True, duplicate clusters are then removed (see deduplicate()), also
+    removing any identical to the cluster signatures in seen.
+    """
     for scaffold in organism.scaffolds.values():
-        clusters = find_clusters(
+        clusters = find_cluster_indices(
             scaffold.subjects,
             unique=unique,
             min_hits=min_hits,
             gap=gap,
             require=require,
         )
-        scaffold.add_clusters(clusters, query_sequence_order=query_sequence_order)
+        scaffold.add_cluster_indices(
+            clusters, query_sequence_order=query_sequence_order
+        )
         LOG.debug(
             "Organism: %s, Scaffold: %s, Clusters: %i",
             organism.full_name,
@@ -453,7 +586,89 @@ def find_clusters_in_organism(
             len(scaffold.clusters),
         )
     if remote:
-        deduplicate(organism)
+        deduplicate(organism, seen=seen)
+
+
+def _find_cluster_scores(
+    task, unique=3, min_hits=3, gap=20000, require=None, query_sequence_order=None
+):
+    """Finds the clusters of an (index, Organism) pair in a worker process.
+
+    Only the indices and scores of each cluster are returned, so the parent process
+    can add the clusters to its own Organism, keeping its Subject and Hit objects
+    (and the sharing of Hit objects between them), rather than replacing it with
+    the worker's copy.
+    """
+    index, organism = task
+    scaffolds = []
+    for scaffold in organism.scaffolds.values():
+        scaffold.clusters = []
+        scaffold.add_cluster_indices(
+            find_cluster_indices(
+                scaffold.subjects,
+                unique=unique,
+                min_hits=min_hits,
+                gap=gap,
+                require=require,
+            ),
+            query_sequence_order=query_sequence_order,
+        )
+        scaffolds.append(
+            [(cluster.indices, cluster.score) for cluster in scaffold.clusters]
+        )
+    return index, scaffolds
+
+
+def find_clusters_in_organisms(organisms, cpus=1, **kwargs):
+    """Runs find_clusters_in_organism() on every organism.
+
+    If cpus > 1 and the organisms have at least POOL_MIN_SUBJECTS subjects in total,
+    organisms are clustered in a pool of worker processes instead. Each organism is
+    sent to a worker on its own, largest first, so workers only hold copies of the
+    organisms they are working on. Workers send back the indices and scores of each
+    cluster, which are added to the given organisms (see _find_cluster_scores()).
+    Duplicate clusters are then removed in this process.
+
+    Args:
+        organisms (list): Organism objects to find clusters in.
+        cpus (int): Number of processes to use.
+        **kwargs: Arguments passed to find_clusters_in_organism(), except seen.
+    Returns:
+        list: The given Organism objects, with clusters.
+    """
+    sizes = [
+        sum(len(scaffold.subjects) for scaffold in organism.scaffolds.values())
+        for organism in organisms
+    ]
+    if cpus <= 1 or len(organisms) <= 1 or sum(sizes) < POOL_MIN_SUBJECTS:
+        for organism in organisms:
+            find_clusters_in_organism(organism, **kwargs)
+        return organisms
+
+    remote = kwargs.pop("remote", True)
+    order = sorted(range(len(organisms)), key=lambda i: sizes[i], reverse=True)
+    LOG.debug("Clustering %i organisms in %i processes", len(organisms), cpus)
+    with Pool(cpus) as pool:
+        for index, scaffolds in pool.imap_unordered(
+            partial(_find_cluster_scores, **kwargs),
+            ((i, organisms[i]) for i in order),
+        ):
+            for scaffold, clusters in zip(
+                organisms[index].scaffolds.values(), scaffolds
+            ):
+                scaffold.clusters.extend(
+                    Cluster(
+                        indices,
+                        [scaffold.subjects[i] for i in indices],
+                        score=score,
+                    )
+                    for indices, score in clusters
+                )
+                scaffold.clusters.sort(key=lambda x: x.score, reverse=True)
+    if remote:
+        for organism in organisms:
+            deduplicate(organism)
+    return organisms
 
 
 def filter_session(
@@ -465,11 +680,18 @@ def filter_session(
     unique=3,
     min_hits=3,
     require=None,
+    deduplicate_organisms=False,
 ):
     """Filter a Session object with new thresholds.
 
+    Subjects left without hits are kept, but cannot be part of clusters (as in
+    ColumnarSession.filter()), so they never bridge the gap between other
+    Subjects. If deduplicate_organisms is True, clusters identical to a cluster in
+    a previous organism are also removed (see deduplicate()).
+
     This function is destructive!
     """
+    seen = set() if deduplicate_organisms else None
     for organism in session.organisms:
         for scaffold in organism.scaffolds.values():
             for subject in scaffold.subjects:
@@ -482,16 +704,20 @@ def filter_session(
                         and hit.evalue < max_evalue
                     )
                 ]
-            clusters = find_clusters(
-                scaffold.subjects,
-                gap=gap,
-                min_hits=min_hits,
-                require=require,
-                unique=unique,
-            )
+            active = [i for i, subject in enumerate(scaffold.subjects) if subject.hits]
+            clusters = [
+                [active[i] for i in indices]
+                for indices in find_cluster_indices(
+                    [scaffold.subjects[i] for i in active],
+                    gap=gap,
+                    min_hits=min_hits,
+                    require=require,
+                    unique=unique,
+                )
+            ]
             scaffold.clusters = []
-            scaffold.add_clusters(clusters, query_sequence_order=session.queries)
-        deduplicate(organism)
+            scaffold.add_cluster_indices(clusters, query_sequence_order=session.queries)
+        deduplicate(organism, seen=seen)
 
 
 def calculate_gne(session):
@@ -515,27 +741,218 @@ def calculate_gne(session):
     )
 
 
+def _query_mask(subject, bits, min_identity, min_coverage, max_evalue):
+    """Builds a bit mask of queries hit by a Subject, as filtered in filter_session."""
+    mask = 0
+    for hit in subject.hits:
+        if (
+            hit.identity > min_identity
+            and hit.coverage > min_coverage
+            and hit.evalue < max_evalue
+        ):
+            mask |= bits[hit.query]
+    return mask
+
+
+def sweep_neighbourhood(
+    session,
+    gaps,
+    min_identity=30,
+    min_coverage=50,
+    max_evalue=0.01,
+    unique=3,
+    min_hits=3,
+    require=None,
+):
+    """Computes cluster statistics of a Session for many gap values in one pass.
+
+    This gives the same results as calling filter_session() and calculate_gne() for
+    each gap value, but without re-clustering the session every time. Subjects on each
+    scaffold are sorted once, and the intergenic distance preceding each Subject (i.e.
+    from the furthest end of any previous Subject) is computed. A Subject joins the
+    cluster before it whenever this distance is within the gap, so clusters for
+    increasing gap values can be built by merging adjacent segments in order of
+    their preceding distance, like a union-find.
+
+    Segments are scored against the clustering thresholds as they are merged, and
+    de-duplicated within each organism as in deduplicate(), i.e. a cluster is
+    discarded if an identical (by IPG) cluster exists on an earlier scaffold.
+    Subjects without hits passing the score thresholds are skipped, as in
+    filter_session().
+
+    Args:
+        session (Session): cblaster Session object. This is not modified.
+        gaps (list): Maximum intergenic distance (bp) values to compute.
+        min_identity (float): Minimum identity (%) cutoff.
+        min_coverage (float): Minimum coverage (%) cutoff.
+        max_evalue (float): Maximum e-value threshold.
+        unique (int): Unique query sequence threshold.
+        min_hits (int): Minimum number of hits in a hit cluster.
+        require (list): Names of query sequences that must be represented in a cluster.
+    Returns:
+        List of (clusters, mean size, median size) tuples for each gap value.
+    """
+    if unique < 0 or min_hits < 0 or any(gap < 0 for gap in gaps):
+        raise ValueError("Expected positive integer")
+
+    bits = defaultdict(lambda: 1 << len(bits))
+    require_mask = 0
+    for query in require or []:
+        require_mask |= bits[query]
+
+    # Flattened subject coordinates and IPGs, sorted per scaffold. Segments (i.e.
+    # candidate clusters) are stored by the indices of their first and last Subject
+    starts, ends, ipgs, untagged = [], [], [], [0]
+    seg_start, seg_end, seg_mask, seg_owner = {}, {}, {}, {}
+    events = []
+
+    for org_index, organism in enumerate(session.organisms):
+        for rank, scaffold in enumerate(organism.scaffolds.values()):
+            thresholds = (min_identity, min_coverage, max_evalue)
+            masks = [
+                (subject, _query_mask(subject, bits, *thresholds))
+                for subject in sorted(scaffold.subjects, key=attrgetter("start"))
+            ]
+            masks = [(subject, mask) for subject, mask in masks if mask]
+            if len(masks) < unique or len(masks) <= 1:
+                continue
+            border = None
+            for subject, mask in masks:
+                index = len(starts)
+                if border is not None:
+                    events.append((subject.start - border, index))
+                    border = max(border, subject.end)
+                else:
+                    border = subject.end
+                starts.append(subject.start)
+                ends.append(subject.end)
+                ipgs.append(subject.ipg)
+                untagged.append(untagged[-1] + (not subject.ipg))
+                seg_start[index] = seg_end[index] = index
+                seg_mask[index] = mask
+                seg_owner[index] = (org_index, rank)
+    events.sort()
+
+    def satisfies(first, last):
+        mask = seg_mask[first]
+        return (
+            last - first + 1 >= min_hits
+            and bin(mask).count("1") >= unique
+            and mask & require_mask == require_mask
+        )
+
+    # Sizes of surviving clusters, kept sorted for the median
+    sizes, total_size = [], 0
+    groups = defaultdict(lambda: defaultdict(list))
+    active = {}
+
+    def include(first):
+        nonlocal total_size
+        size = active[first][2]
+        bisect.insort(sizes, size)
+        total_size += size
+
+    def exclude(first):
+        nonlocal total_size
+        size = active[first][2]
+        del sizes[bisect.bisect_left(sizes, size)]
+        total_size -= size
+
+    def add(first, last):
+        org_index, rank = seg_owner[first]
+        if untagged[last + 1] - untagged[first]:
+            key = None
+        else:
+            key = (org_index, tuple(ipgs[first: last + 1]))
+        active[first] = (key, rank, ends[last] - starts[first])
+        if not key:
+            include(first)
+            return
+        group = groups[key]
+        lowest = min(group) if group else None
+        group[rank].append(first)
+        if lowest is None or rank == lowest:
+            include(first)
+        elif rank < lowest:
+            for other in group[lowest]:
+                exclude(other)
+            include(first)
+
+    def remove(first):
+        key, rank, _ = active[first]
+        if not key:
+            exclude(first)
+            del active[first]
+            return
+        group = groups[key]
+        lowest = min(group)
+        group[rank].remove(first)
+        if rank == lowest:
+            exclude(first)
+        del active[first]
+        if not group[rank]:
+            del group[rank]
+            if not group:
+                del groups[key]
+            elif rank == lowest:
+                for other in group[min(group)]:
+                    include(other)
+
+    for first in seg_end:
+        if satisfies(first, first):
+            add(first, first)
+
+    results = [None] * len(gaps)
+    events = iter(events)
+    event = next(events, None)
+    for order, gap in sorted(enumerate(gaps), key=lambda pair: pair[1]):
+        while event and event[0] <= gap:
+            right = event[1]
+            left, last = seg_start.pop(right - 1), seg_end.pop(right)
+            for first in (left, right):
+                if first in active:
+                    remove(first)
+            seg_mask[left] |= seg_mask.pop(right)
+            seg_end[left], seg_start[last] = last, left
+            if satisfies(left, last):
+                add(left, last)
+            event = next(events, None)
+        total = len(sizes)
+        if not total:
+            results[order] = (0, 0, 0)
+            continue
+        middle = total // 2
+        if total % 2:
+            median = sizes[middle]
+        else:
+            median = (sizes[middle - 1] + sizes[middle]) / 2
+        results[order] = (total, total_size / total, int(median))
+    return results
+
+
 def estimate_neighbourhood(session, max_gap=100000, samples=100, scale="linear"):
-    """Estimate gene neighbourhood of a cblaster session."""
+    """Estimate gene neighbourhood of a cblaster session.
+
+    Clusters are computed for each gap value using the default filter_session()
+    thresholds, in a single pass using sweep_neighbourhood().
+    """
     if scale == "linear":
         space = np.linspace(0, max_gap, num=samples)
     elif scale == "log":
         space = np.geomspace(1, max_gap, num=samples)
     else:
         raise ValueError("Invalid scale specified, expected 'linear' or 'log'")
-    results = []
-    for value in space:
-        value = int(value)
-        filter_session(session, gap=value)
-        clusters, means, medians = calculate_gne(session)
-        result = {
-            "gap": value,
+    gaps = [int(value) for value in space]
+    results = sweep_neighbourhood(session, gaps)
+    return [
+        {
+            "gap": gap,
             "means": means,
             "medians": medians,
             "clusters": clusters,
         }
-        results.append(result)
-    return results
+        for gap, (clusters, means, medians) in zip(gaps, results)
+    ]
 
 
 def search(
@@ -546,7 +963,11 @@ def search(
     require=None,
     json_db=None,
     ipg_file=None,
-    query_sequence_order=None
+    query_sequence_order=None,
+    api_key=None,
+    ipg_cache=None,
+    deduplicate_organisms=False,
+    cpus=1,
 ):
     """Gets the genomic context for a collection of Hit objects.
 
@@ -563,7 +984,8 @@ def search(
     ... )
 
     Args:
-        hits (list): Collection of Hit objects to find clusters in.
+        hits (iterable): Collection of Hit objects to find clusters in. Hits are
+            looked up in json_db as they are iterated (see query_local_DB()).
         require (list): Names of query sequences that must be represented in a cluster.
         unique (int): Unique query sequence threshold.
         min_hits (int): Minimum number of hits in a hit cluster.
@@ -571,30 +993,46 @@ def search(
         json_db (str): Path to a JSON database created with cblaster makedb.
         query_sequence_order (list): list of sequences of the order in the query file, is
         only provided if the query has a meningfull order (gbk, embl files).
+        api_key (str): NCBI API key, used to raise the E-utilities request rate.
+        ipg_cache (cache.IPGCache): Persistent cache of IPG table rows.
+        deduplicate_organisms (bool): Remove clusters identical to a cluster in
+            another organism or strain, as well as within each organism.
+        cpus (int): Number of processes to use when finding clusters (only used for
+            large searches, see find_clusters_in_organisms()).
     Returns:
         Dictionary of Organism objects keyed on species name.
     """
     if json_db:
-        LOG.info("Loading JSON database: %s", json_db)
-        db = database.Database.from_json(json_db)
-        organisms = query_local_DB(hits, db)
+        with database.load(json_db) as db:
+            organisms = query_local_DB(hits, db)
     else:
+        hits = list(hits)
+        LOG.info("Found %i hits meeting score thresholds", len(hits))
         rows = efetch_IPGs(
             [hit.subject for hit in hits],
-            output_handle=ipg_file
+            output_handle=ipg_file,
+            api_key=api_key,
+            cache=ipg_cache,
         )
         organisms = parse_IPG_table(rows, hits)
 
     LOG.info("Searching for clustered hits across %i organisms", len(organisms))
-    for organism in organisms:
-        find_clusters_in_organism(
-            organism,
-            unique=unique,
-            min_hits=min_hits,
-            gap=gap,
-            require=require,
-            remote=json_db is None,
-            query_sequence_order=query_sequence_order
-        )
+    organisms = find_clusters_in_organisms(
+        organisms,
+        cpus=cpus,
+        unique=unique,
+        min_hits=min_hits,
+        gap=gap,
+        require=require,
+        remote=json_db is None,
+        query_sequence_order=query_sequence_order,
+    )
+
+    # Organisms are deduplicated independently above, so duplicates across
+    # organisms are removed afterwards, in order
+    if deduplicate_organisms and json_db is None:
+        seen = set()
+        for organism in organisms:
+            deduplicate(organism, seen=seen)
 
     return organisms
@@ -1,11 +1,23 @@
 """
 This module handles creation of local JSON databases for non-NCBI lookups.
+
+Alongside the JSON database, cblaster makedb writes a SQLite index storing only the
+fields needed to place hits in their genomic context (organism, strain, scaffold,
+identifier and location of each protein). Lookups against the index do not require
+loading the full database into memory.
 """
 
 import json
 import logging
+import os
+import shutil
+import sqlite3
 import subprocess
+import time
 
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
 
 import g2j
@@ -16,6 +28,13 @@ from cblaster import helpers
 LOG = logging.getLogger("cblaster")
 
 
+# Genomic context of a single protein in a cblaster database
+Protein = namedtuple(
+    "Protein",
+    ["organism", "strain", "scaffold", "identifier", "start", "end", "strand"],
+)
+
+
 def parse_gff(gff_handle, fasta_handle=None):
     """Parses a GFF file using genome2json.
 
@@ -46,6 +65,123 @@ def parse_gff(gff_handle, fasta_handle=None):
     return organism
 
 
+def parse_file(path):
+    """Parses a GenBank or GFF3 file to a genome2json Organism.
+
+    Returns:
+        Organism object, or None if the file extension was not recognised.
+    """
+    with open(path) as handle:
+        if any(key in handle.name for key in ["gb", "gbk", "genbank"]):
+            return genbank.parse(handle, feature_types=["CDS"])
+        if any(key in handle.name for key in ["gff", "gff3"]):
+            return parse_gff(handle)
+    return None
+
+
+def _timed_parse_file(path):
+    """Parses a file with parse_file(), also returning the time taken (seconds)."""
+    start = time.perf_counter()
+    organism = parse_file(path)
+    return organism, time.perf_counter() - start
+
+
+def write_fasta_records(handle, i, organism):
+    """Writes proteins of an Organism to indexed FASTA format.
+
+    Headers follow the form "i_j_k", where i, j and k are the indices of the organism,
+    scaffold and protein, respectively. Proteins without translations are skipped.
+
+    Returns:
+        int: Total number of residues written.
+    """
+    translations = [
+        (j, k, feature.qualifiers["translation"])
+        for j, scaffold in enumerate(organism.scaffolds)
+        for k, feature in enumerate(scaffold.features)
+        if "translation" in feature.qualifiers
+    ]
+    handle.write(
+        "".join(
+            f">{i}_{j}_{k}\n{translation}\n" for j, k, translation in translations
+        )
+    )
+    return sum(len(translation) for _, _, translation in translations)
+
+
+def _imap_bounded(pool, func, items, window):
+    """Maps func over items in a process pool, keeping at most window tasks in flight.
+
+    Unlike Pool.imap(), workers cannot run ahead of the consumer, so at most window
+    results are held in memory at any time. Results are yielded in order.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def parse_files(files, cpus=1):
+    """Parses a collection of GenBank/GFF3 files, yielding Organisms in file order.
+
+    If cpus > 1, files are parsed in a pool of worker processes. Organisms are still
+    yielded in the same order as the given files, so organism indices (i.e. the i
+    in i_j_k FASTA headers) do not depend on which worker finishes first. At most
+    2 * cpus files are parsed ahead of the consumer. Files with unrecognised
+    extensions are skipped.
+
+    Args:
+        files (list): Paths to GenBank or GFF3 files.
+        cpus (int): Number of worker processes to use.
+    Yields:
+        Tuples of file path and genome2json Organism object.
+    """
+    LOG.info("Parsing %i files using %i cpus...", len(files), cpus)
+    total_size, total_time, start = 0, 0, time.perf_counter()
+    if cpus > 1:
+        pool = Pool(cpus)
+        results = _imap_bounded(pool, _timed_parse_file, files, 2 * cpus)
+    else:
+        pool = None
+        results = map(_timed_parse_file, files)
+    try:
+        for index, (file, (organism, elapsed)) in enumerate(zip(files, results), 1):
+            if not organism:
+                LOG.warning(
+                    "%i. %s: expected GenBank (.gb, .gbk or .genbank) or"
+                    " GFF3 (.gff, .gff3) file extensions. Skipping...",
+                    index,
+                    file,
+                )
+                continue
+            size = os.path.getsize(file) / 1e6
+            total_size += size
+            total_time += elapsed
+            LOG.info(
+                "%i. %s (%.2f MB in %.2fs, %.2f MB/s)",
+                index,
+                file,
+                size,
+                elapsed,
+                size / elapsed if elapsed else 0,
+            )
+            yield file, organism
+    finally:
+        if pool:
+            pool.terminate()
+    wall = time.perf_counter() - start
+    LOG.info(
+        "Parsed %.2f MB in %.2fs (%.2f MB/s per cpu, %.2f MB/s overall)",
+        total_size,
+        wall,
+        total_size / total_time if total_time else 0,
+        total_size / wall if wall else 0,
+    )
+
+
 class Database:
     """A cblaster database.
 
@@ -57,53 +193,71 @@ class Database:
         self.organisms = organisms if organisms else []
 
     def __iter__(self):
-        return iter(self.organisms)
+        # Organisms replaced when appending to a database are left as None, so the
+        # remaining organisms keep their indices
+        return (organism for organism in self.organisms if organism is not None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Does nothing; the JSON database is held entirely in memory."""
+
+    def lookup(self, i, j, k):
+        """Gets the genomic context of a protein by its database indices.
+
+        Args:
+            i (int): Index of the organism.
+            j (int): Index of the scaffold in the organism.
+            k (int): Index of the protein on the scaffold.
+        Returns:
+            Protein namedtuple.
+        """
+        organism = self.organisms[i]
+        if organism is None:
+            raise KeyError(f"Organism {i} was removed from the database")
+        scaffold = organism.scaffolds[j]
+        feature = scaffold.features[k]
+        return Protein(
+            organism.name,
+            organism.strain,
+            scaffold.accession,
+            helpers.find_identifier(feature.qualifiers),
+            feature.location.min(),
+            feature.location.max(),
+            feature.location.strand,
+        )
 
     def write_fasta(self, handle):
         """Formats organisms in the database to indexed FASTA format.
         Builds FASTA of each organism, then writes to given handle.
         """
         for i, organism in enumerate(self.organisms):
-            fasta = ""
-            for j, scaffold in enumerate(organism.scaffolds):
-                for k, feature in enumerate(scaffold.features):
-                    try:
-                        sequence = feature.qualifiers["translation"]
-                    except KeyError:
-                        continue
-                    fasta += f">{i}_{j}_{k}\n{sequence}\n"
-            handle.write(fasta)
+            if organism is not None:
+                write_fasta_records(handle, i, organism)
 
     @classmethod
-    def from_files(cls, files):
+    def from_files(cls, files, cpus=1):
         """Builds a new Database from a collection of GenBank files.
 
         For example:
 
         >>> db = Database.from_files(['path/to/file.gbk', 'path/to/file.gbk'])
 
-        Only CDS features are parsed.
+        Only CDS features are parsed. Files are parsed in parallel when cpus > 1,
+        see parse_files().
         """
-        organisms = []
-        LOG.info("Parsing %i files...", len(files))
-        for index, file in enumerate(files, 1):
-            with open(file) as handle:
-                LOG.info("%i. %s", index, file)
-                if any(key in handle.name for key in ["gb", "gbk", "genbank"]):
-                    organism = genbank.parse(handle, feature_types=["CDS"])
-                elif any(key in handle.name for key in ["gff", "gff3"]):
-                    organism = parse_gff(handle)
-                else:
-                    LOG.warning(
-                        "Expected GenBank (.gb, .gbk or .genbank) or"
-                        " GFF3 (.gff, .gff3) file extensions. Skipping..."
-                    )
-                organisms.append(organism)
-        return cls(organisms)
+        return cls([organism for _, organism in parse_files(files, cpus=cpus)])
 
     def to_list(self):
         """Serialises all organisms in this database to dict."""
-        return [organism.to_dict() for organism in self]
+        return [
+            None if organism is None else organism.to_dict()
+            for organism in self.organisms
+        ]
 
     def to_json(self, handle, indent=None):
         """Writes database to file in JSON format."""
@@ -114,9 +268,18 @@ class Database:
         """Load a Database from JSON."""
         with open(json_file) as handle:
             js = json.load(handle)
-        organisms = [g2j.classes.Organism.from_dict(d) for d in js]
+        organisms = [
+            None if d is None else g2j.classes.Organism.from_dict(d) for d in js
+        ]
         return cls(organisms)
 
+    def to_index(self, path):
+        """Writes the database index to a SQLite file."""
+        with DatabaseIndex.create(path) as index:
+            for i, organism in enumerate(self.organisms):
+                if organism is not None:
+                    index.add_organism(i, organism)
+
     def makedb(self, name):
         """Convenience function to write FASTA and generate diamond DB"""
         fasta = f"{name}.faa"
@@ -125,18 +288,573 @@ class Database:
         diamond_makedb(fasta, name)
 
 
+class DatabaseIndex:
+    """An indexed lookup table of the proteins in a cblaster database.
+
+    Proteins are keyed on the same i, j and k indices used in the headers of the
+    DIAMOND database (see Database.write_fasta), so the context of any hit can be
+    found directly without loading the JSON database:
+
+    >>> with DatabaseIndex("mydb.sqlite3") as index:
+    ...     index.lookup(2, 56, 123)
+    Protein(organism=..., strain=..., scaffold=..., identifier=..., ...)
+
+    Only proteins written to the FASTA file (i.e. with translations) are stored.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS organisms (
+            organism INTEGER PRIMARY KEY,
+            name TEXT,
+            strain TEXT
+        );
+        CREATE TABLE IF NOT EXISTS scaffolds (
+            organism INTEGER,
+            scaffold INTEGER,
+            accession TEXT,
+            PRIMARY KEY (organism, scaffold)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS proteins (
+            organism INTEGER,
+            scaffold INTEGER,
+            protein INTEGER,
+            identifier TEXT,
+            start INTEGER,
+            end INTEGER,
+            strand TEXT,
+            PRIMARY KEY (organism, scaffold, protein)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def create(cls, path):
+        """Creates a new, empty index, replacing any existing file at path."""
+        path = Path(path)
+        if path.exists():
+            path.unlink()
+        return cls(path)
+
+    def add_organism(self, i, organism):
+        """Adds a genome2json Organism to the index with organism index i."""
+        scaffolds, proteins = [], []
+        for j, scaffold in enumerate(organism.scaffolds):
+            scaffolds.append((i, j, scaffold.accession))
+            for k, feature in enumerate(scaffold.features):
+                if "translation" not in feature.qualifiers:
+                    continue
+                proteins.append(
+                    (
+                        i,
+                        j,
+                        k,
+                        helpers.find_identifier(feature.qualifiers),
+                        feature.location.min(),
+                        feature.location.max(),
+                        feature.location.strand,
+                    )
+                )
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO organisms VALUES (?, ?, ?)",
+                (i, organism.name, organism.strain),
+            )
+            self.connection.executemany(
+                "INSERT INTO scaffolds VALUES (?, ?, ?)", scaffolds
+            )
+            self.connection.executemany(
+                "INSERT INTO proteins VALUES (?, ?, ?, ?, ?, ?, ?)", proteins
+            )
+
+    def remove_organism(self, i):
+        """Removes the organism with index i from the index."""
+        with self.connection:
+            for table in ("organisms", "scaffolds", "proteins"):
+                self.connection.execute(f"DELETE FROM {table} WHERE organism = ?", (i,))
+
+    def lookup(self, i, j, k):
+        """Gets the genomic context of a protein by its database indices.
+
+        Args:
+            i (int): Index of the organism.
+            j (int): Index of the scaffold in the organism.
+            k (int): Index of the protein on the scaffold.
+        Raises:
+            KeyError: No protein with these indices in the index.
+        Returns:
+            Protein namedtuple.
+        """
+        row = self.connection.execute(
+            "SELECT o.name, o.strain, s.accession, p.identifier, p.start, p.end,"
+            " p.strand FROM proteins p"
+            " JOIN scaffolds s ON s.organism = p.organism AND s.scaffold = p.scaffold"
+            " JOIN organisms o ON o.organism = p.organism"
+            " WHERE p.organism = ? AND p.scaffold = ? AND p.protein = ?",
+            (i, j, k),
+        ).fetchone()
+        if not row:
+            raise KeyError(f"No protein {i}_{j}_{k} in database index")
+        return Protein(*row)
+
+
+def load(path):
+    """Loads a cblaster database for hit context lookups.
+
+    If a SQLite index exists next to the given JSON database (or the index itself is
+    given), it is used instead of loading the JSON database.
+
+    Args:
+        path (str): Path to a JSON database or its SQLite index.
+    Returns:
+        DatabaseIndex, or Database if no index was found.
+    """
+    path = Path(path)
+    index = path if path.suffix == ".sqlite3" else path.with_suffix(".sqlite3")
+    if index.exists():
+        LOG.info("Loading database index: %s", index)
+        return DatabaseIndex(index)
+    LOG.info("Loading JSON database: %s", path)
+    return Database.from_json(path)
+
+
+def read_manifest(name):
+    """Reads the manifest of a database.
+
+    The manifest records the path, content hash, organism index and number of
+    protein residues of every file added to the database, as well as the total
+    number of organisms written to the JSON database (i.e. the index of the next
+    organism to be added) and the total number of residues in the DIAMOND
+    database(s). Indices of organisms whose files were later changed are listed as
+    stale.
+
+    Raises:
+        FileNotFoundError: The database has no manifest.
+    """
+    path = f"{name}.manifest.json"
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"Database {name} has no manifest ({path}). Databases built with older"
+            " versions of cblaster have no manifest, and have to be rebuilt with"
+            " cblaster makedb (without --append)"
+        ) from None
+
+
+def write_manifest(name, manifest, path=None):
+    """Writes the manifest of a database, optionally to a different path."""
+    with open(path or f"{name}.manifest.json", "w") as handle:
+        json.dump(manifest, handle, indent=2)
+
+
+def remove_fasta_records(path, indices, output=None):
+    """Removes all proteins of the given organism indices from a database FASTA file.
+
+    If output is given, the remaining proteins are written there instead, and the
+    original file is left unchanged.
+    """
+    prefixes = tuple(f">{i}_" for i in indices)
+    temporary = output or f"{path}.tmp"
+    with open(path) as source, open(temporary, "w") as target:
+        skip = False
+        for line in source:
+            if line.startswith(">"):
+                skip = bool(prefixes) and line.startswith(prefixes)
+            if not skip:
+                target.write(line)
+    if not output:
+        os.replace(temporary, path)
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """Generates the JSON text of each element of a JSON array file, one at a time.
+
+    Only one element is held in memory at a time, so the organisms of a JSON database
+    can be copied without loading the whole database.
+
+    Raises:
+        ValueError: The file is not a complete JSON array.
+    """
+    decoder = json.JSONDecoder()
+    error = f"{path} is not a complete JSON array"
+    with open(path) as handle:
+        buffer = ""
+
+        def more():
+            nonlocal buffer
+            # Read at least as much again as is buffered, so parsing large elements
+            # is not quadratic in their size
+            chunk = handle.read(max(chunk_size, len(buffer)))
+            buffer += chunk
+            return bool(chunk)
+
+        def token():
+            nonlocal buffer
+            buffer = buffer.lstrip()
+            while not buffer:
+                if not more():
+                    raise ValueError(error)
+                buffer = buffer.lstrip()
+            return buffer[0]
+
+        if token() != "[":
+            raise ValueError(error)
+        buffer = buffer[1:]
+        if token() == "]":
+            return
+        while True:
+            token()
+            while True:
+                try:
+                    _, end = decoder.raw_decode(buffer)
+                    break
+                except json.JSONDecodeError:
+                    if not more():
+                        raise ValueError(error)
+            yield buffer[:end]
+            buffer = buffer[end:]
+            separator = token()
+            buffer = buffer[1:]
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(error)
+
+
+def shard_name(name, shard):
+    """Gets the name (i.e. path without extensions) of a database shard."""
+    return f"{name}.shard{shard}"
+
+
+def _read_database_manifest(database):
+    """Reads the manifest of a DIAMOND database, or returns an empty dict."""
+    name = str(database)
+    if name.endswith(".dmnd"):
+        name = name[:-5]
+    try:
+        return read_manifest(name)
+    except FileNotFoundError:
+        return {}
+
+
+def get_shards(database):
+    """Gets the DIAMOND databases to search for a (possibly sharded) database.
+
+    Shards are read from the database manifest. If the database has no manifest, or
+    was not built with shards, the database itself is returned.
+
+    Args:
+        database (str): Path to a DIAMOND database, with or without .dmnd extension.
+    Returns:
+        list: Paths to the DIAMOND database of each shard.
+    """
+    shards = _read_database_manifest(database).get("shards")
+    if not shards:
+        return [database]
+    name = str(database)
+    if name.endswith(".dmnd"):
+        name = name[:-5]
+    return [f"{shard_name(name, shard['shard'])}.dmnd" for shard in shards]
+
+
+def get_dbsize(database):
+    """Gets the total number of residues in a (possibly sharded) database.
+
+    Shards are searched as separate DIAMOND databases, so this has to be passed to
+    DIAMOND (--dbsize) for E-values to be computed against the whole database.
+
+    Args:
+        database (str): Path to a DIAMOND database, with or without .dmnd extension.
+    Returns:
+        int: Total residues, or None if not recorded in the database manifest.
+    """
+    return _read_database_manifest(database).get("residues")
+
+
+class StagedFiles:
+    """Temporary files that are moved into place together once all are written.
+
+    Files are staged under temporary paths (by default, the path with a .tmp
+    suffix). commit() moves every staged file to its final path, with the file
+    staged last moved last; any staged files left when the context exits (i.e.
+    if an error occurred before commit()) are removed.
+
+    >>> with StagedFiles() as staged:
+    ...     with open(staged.stage("db.json"), "w") as handle:
+    ...         ...
+    ...     staged.commit()
+    """
+
+    def __init__(self):
+        self.paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for temporary in self.paths.values():
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def __getitem__(self, path):
+        return self.paths[path]
+
+    def stage(self, path, temporary=None):
+        """Stages a file, returning the temporary path to write it to."""
+        self.paths.pop(path, None)
+        self.paths[path] = temporary or f"{path}.tmp"
+        return self.paths[path]
+
+    def commit(self):
+        """Moves every staged file to its final path."""
+        for path, temporary in self.paths.items():
+            os.replace(temporary, path)
+        self.paths = {}
+
+
+def copy_json_organisms(path, handle, manifest):
+    """Copies the organisms of a JSON database to a handle, without the closing ].
+
+    Organisms listed as stale in the manifest are written as null, so the remaining
+    organisms keep their indices.
+
+    Raises:
+        ValueError: The JSON database does not match its manifest.
+    """
+    stale = set(manifest["stale"])
+    count = 0
+    for i, text in enumerate(iter_json_array(path)):
+        if i > 0:
+            handle.write(", ")
+        handle.write("null" if i in stale else text)
+        count += 1
+    if count != manifest["organisms"]:
+        raise ValueError(
+            f"{path} has {count} organisms, but its manifest lists"
+            f" {manifest['organisms']}; rebuild the database"
+        )
+
+
+def makedb(files, name, cpus=1, indent=None, append=False, shards=1):
+    """Builds cblaster databases from a collection of GenBank/GFF3 files.
+
+    This writes the FASTA file (name.faa), JSON database (name.json), database
+    index (name.sqlite3) and manifest (name.manifest.json), then builds the DIAMOND
+    database (name.dmnd). Genomes are streamed through this pipeline one at a time:
+    each is parsed, written to every output file, then released. Peak memory is
+    therefore bounded by the largest genomes being parsed at once, rather than by
+    the size of the whole database.
+
+    If shards is greater than 1, organisms are split into that many contiguous
+    ranges of organism indices, each written to its own FASTA file and DIAMOND
+    database (name.shardN.faa and name.shardN.dmnd) instead. The ranges are recorded
+    in the manifest, so local searches against name.dmnd can search every shard.
+    The total number of residues is also recorded, so E-values of each shard search
+    are computed against the size of the whole database (see get_dbsize()).
+    The JSON database and index are shared by all shards.
+
+    If append is True, the files are added to an existing database instead. Files
+    are compared to the manifest by path and content hash, and only new or changed
+    files are parsed. New organisms are given the next free indices, so headers of
+    existing proteins are never renumbered. Proteins of changed files are removed
+    from the FASTA file and index under their old indices, and their organisms are
+    replaced by null in the JSON database (since organisms are looked up by
+    position). The DIAMOND database is then rebuilt from the extended FASTA file,
+    without re-parsing unchanged genomes. When appending to a sharded database, new
+    organisms are written to new shards, and only new shards or those containing
+    changed files are rebuilt.
+
+    Every file is written to a temporary file first (see StagedFiles), and the
+    temporary files only replace the database once all of them have been built, so
+    an error part way through leaves an existing database unchanged.
+
+    Args:
+        files (list): Paths to GenBank or GFF3 files.
+        name (str): Name (i.e. path without extensions) of the databases.
+        cpus (int): Number of processes to use when parsing files.
+        indent (int): Total spaces to indent the JSON database.
+        append (bool): Add files to an existing database.
+        shards (int): Number of shards to split the DIAMOND database into.
+    Raises:
+        FileNotFoundError: Tried to append to a database without a manifest.
+        ValueError: Tried to append shards to an unsharded database.
+    """
+    fasta = f"{name}.faa"
+
+    if append:
+        manifest = read_manifest(name)
+        manifest.setdefault("shards", [])
+        LOG.info("Appending to database %s (%i organisms)", name, manifest["organisms"])
+        if shards > 1 and manifest["organisms"] and not manifest["shards"]:
+            raise ValueError(f"Cannot append shards to unsharded database {name}")
+    else:
+        manifest = {"organisms": 0, "stale": [], "files": [], "shards": []}
+    sharded = shards > 1 or bool(manifest["shards"])
+
+    # Compare files to manifest, find any new or changed files
+    current = {entry["path"]: entry for entry in manifest["files"]}
+    hashes, new, stale = {}, [], []
+    for file in files:
+        path = str(Path(file).resolve())
+        hashes[file] = helpers.file_hash(file)
+        entry = current.get(path)
+        if not entry:
+            new.append(file)
+        elif entry["sha256"] == hashes[file]:
+            LOG.info("Skipping unchanged file: %s", file)
+        else:
+            new.append(file)
+            LOG.info("File has changed since it was added: %s", file)
+            stale.append(entry["index"])
+            manifest["files"].remove(entry)
+            del current[path]
+
+    if append and not new:
+        LOG.info("No new or changed files, database is up to date")
+        return
+
+    # Shards that need their DIAMOND database (re)built
+    rebuild = set()
+    manifest["stale"].extend(stale)
+
+    # Every output file is written to a temporary file, and only moved into place
+    # once the whole database has been built, so if anything fails part way (e.g. a
+    # malformed genome file, or DIAMOND) an existing database is left untouched
+    with StagedFiles() as staged:
+        if sharded:
+            for shard in manifest["shards"]:
+                indices = [i for i in stale if shard["start"] <= i < shard["end"]]
+                if indices:
+                    path = f"{shard_name(name, shard['shard'])}.faa"
+                    LOG.info("Removing %i stale organisms from %s", len(indices), path)
+                    remove_fasta_records(path, indices, output=staged.stage(path))
+                    rebuild.add(shard["shard"])
+            # Number of organisms per shard; the last shard may be smaller, and files
+            # that cannot be parsed are skipped, so this is an upper bound
+            size = -(-len(new) // max(shards, 1))
+            LOG.info(
+                "Writing FASTA files with database sequences: %s", name + ".shard*.faa"
+            )
+            fasta_handle = None
+        else:
+            if append:
+                if stale:
+                    LOG.info("Removing %i stale organisms from %s", len(stale), fasta)
+                remove_fasta_records(fasta, stale, output=staged.stage(fasta))
+            LOG.info("Writing FASTA file with database sequences: %s", fasta)
+            fasta_handle = open(staged.stage(fasta), "a" if append else "w")
+
+        LOG.info("Writing JSON database: %s", name + ".json")
+        LOG.info("Writing database index: %s", name + ".sqlite3")
+        json_handle = open(staged.stage(f"{name}.json"), "w")
+        json_handle.write("[")
+        if append:
+            copy_json_organisms(f"{name}.json", json_handle, manifest)
+            shutil.copyfile(f"{name}.sqlite3", staged.stage(f"{name}.sqlite3"))
+            index = DatabaseIndex(staged[f"{name}.sqlite3"])
+        else:
+            index = DatabaseIndex.create(staged.stage(f"{name}.sqlite3"))
+
+        try:
+            with json_handle, index:
+                for i in stale:
+                    index.remove_organism(i)
+                for position, (file, organism) in enumerate(
+                    parse_files(new, cpus=cpus)
+                ):
+                    i = manifest["organisms"]
+                    if sharded and position % size == 0:
+                        if fasta_handle:
+                            fasta_handle.close()
+                        shard = {"shard": len(manifest["shards"]), "start": i, "end": i}
+                        manifest["shards"].append(shard)
+                        rebuild.add(shard["shard"])
+                        path = f"{shard_name(name, shard['shard'])}.faa"
+                        fasta_handle = open(staged.stage(path), "w")
+                    residues = write_fasta_records(fasta_handle, i, organism)
+                    if i > 0:
+                        json_handle.write(", ")
+                    json.dump(organism.to_dict(), json_handle, indent=indent)
+                    index.add_organism(i, organism)
+                    manifest["files"].append(
+                        {
+                            "path": str(Path(file).resolve()),
+                            "sha256": hashes[file],
+                            "index": i,
+                            "residues": residues,
+                        }
+                    )
+                    manifest["organisms"] += 1
+                    if sharded:
+                        shard["end"] = manifest["organisms"]
+                json_handle.write("]")
+        finally:
+            if fasta_handle:
+                fasta_handle.close()
+
+        # Databases built before residues were recorded cannot be given a total
+        residues = [entry.get("residues") for entry in manifest["files"]]
+        manifest["residues"] = None if None in residues else sum(residues)
+
+        if sharded:
+            names = [shard_name(name, shard) for shard in sorted(rebuild)]
+            LOG.info(
+                "Building %i DIAMOND database shards: %s", len(names), ", ".join(names)
+            )
+        else:
+            names = [name]
+            LOG.info("Building DIAMOND database: %s", name + ".dmnd")
+
+        # DIAMOND databases are built from the staged FASTA files under temporary
+        # names (i.e. name.tmp.dmnd). Shards are independent, so their DIAMOND
+        # databases are built concurrently
+        with ThreadPoolExecutor(max_workers=max(1, cpus)) as executor:
+            futures = []
+            for database in names:
+                staged.stage(f"{database}.dmnd", f"{database}.tmp.dmnd")
+                futures.append(
+                    executor.submit(
+                        diamond_makedb, staged[f"{database}.faa"], f"{database}.tmp"
+                    )
+                )
+            for future in futures:
+                future.result()
+
+        LOG.info("Writing database manifest: %s", name + ".manifest.json")
+        path = f"{name}.manifest.json"
+        write_manifest(name, manifest, path=staged.stage(path))
+        staged.commit()
+
+
 def diamond_makedb(fasta, name):
     """Builds a DIAMOND database from JSON.
 
     Args:
         fasta (str): Path to FASTA file containing protein sequences.
         name (str): Name for DIAMOND database.
+    Raises:
+        subprocess.CalledProcessError: DIAMOND exited with a non-zero status
     """
     diamond = helpers.get_program_path(["diamond", "diamond-aligner"])
     subprocess.run(
         [diamond, "makedb", "--in", fasta, "--db", name],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
+        check=True,
     )
 
 
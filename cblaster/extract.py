@@ -8,7 +8,8 @@ import logging
 import re
 
 
-from cblaster.classes import Session
+from cblaster import session_io
+from cblaster.classes import Organism, Session
 from cblaster.helpers import efetch_sequences
 
 
@@ -100,6 +101,43 @@ def format_records(records, delimiter=None, to_fasta=False, name_only=False):
     )
 
 
+def load_session(path, organisms=None, scaffolds=None):
+    """Loads a session, skipping organisms and scaffolds excluded by filters.
+
+    If the session is binary or has a JSON index (see session_io), only organisms
+    matching the organism patterns and scaffolds named in the scaffold filters are
+    read from the file. Otherwise, the whole session is loaded.
+
+    Args:
+        path (str): Path to session file
+        organisms (list): Organism filtering regular expressions
+        scaffolds (list): Scaffold names and ranges
+    Returns:
+        Session object
+    """
+    reader = session_io.open_indexed(path) if organisms or scaffolds else None
+    if not reader:
+        return Session.from_file(path)
+    patterns = parse_organisms(organisms) if organisms else None
+    accessions = set(parse_scaffolds(scaffolds)) if scaffolds else None
+    with reader:
+        selected = []
+        for i, entry in enumerate(reader.index):
+            if patterns and not organism_matches(entry["name"], patterns):
+                continue
+            if accessions and accessions.isdisjoint(entry["scaffolds"]):
+                continue
+            organism = reader.read_organism(i, accessions=accessions)
+            selected.append(Organism.from_dict(organism))
+        LOG.info("Read %i of %i organisms using index", len(selected), len(reader))
+        return Session(
+            queries=reader.queries,
+            sequences=reader.sequences,
+            params=reader.params,
+            organisms=selected,
+        )
+
+
 def extract_records(
     session,
     in_cluster=True,
@@ -172,8 +210,7 @@ def extract(
     """
     LOG.info("Starting cblaster extraction")
     LOG.info("Loading session from: %s", session)
-    with open(session) as fp:
-        session = Session.from_json(fp)
+    session = load_session(session, organisms=organisms, scaffolds=scaffolds)
 
     LOG.info("Extracting subject sequences matching filters")
     records = extract_records(
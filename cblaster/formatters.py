@@ -1,8 +1,15 @@
 """cblaster result formatters."""
 
 
+import io
+
 from operator import attrgetter
 
+import numpy as np
+
+
+BINARY_BLOCK_ROWS = 1000
+
 
 def get_maximum_row_lengths(rows):
     """Finds the longest lengths of fields per column in a collection of rows."""
@@ -56,16 +63,133 @@ def get_cell_values(queries, subjects, key=len, attr=None):
         key (callable): Some callable that takes a list and produces a value.
         attr (str): A Hit attribute to calculate values with in key function.
     """
-    result = [0] * len(queries)
-    for index, query in enumerate(queries):
-        values = [
-            getattr(hit, attr) if attr else hit
-            for subject in subjects
-            for hit in subject.hits
-            if hit.query == query
-        ]
-        result[index] = key(values)
-    return result
+    buckets = {query: [] for query in queries}
+    for subject in subjects:
+        for hit in subject.hits:
+            if hit.query in buckets:
+                buckets[hit.query].append(getattr(hit, attr) if attr else hit)
+    return [key(buckets[query]) for query in queries]
+
+
+def _bucket_hits(queries, clusters, attr=None):
+    """Collects the matrix cell and attribute value of every hit in clusters.
+
+    Returns:
+        Flat cell indices (cluster * total queries + query) and attribute values
+        (None if attr is None) of each hit whose query is in queries.
+    """
+    columns = {query: index for index, query in enumerate(queries)}
+    total = len(queries)
+    cells, values = [], []
+    for row, cluster in enumerate(clusters):
+        offset = row * total
+        for subject in cluster.subjects:
+            for hit in subject.hits:
+                column = columns.get(hit.query)
+                if column is None:
+                    continue
+                cells.append(offset + column)
+                if attr:
+                    values.append(getattr(hit, attr))
+    return (
+        np.array(cells, dtype=np.int64),
+        np.array(values, dtype=float) if attr else None,
+    )
+
+
+def binary_matrix(queries, clusters, key=len, attr="identity", counts=False):
+    """Computes the binary table cell values of many clusters at once.
+
+    Hits are bucketed by cluster and query index in a single pass, then reduced
+    column-wise with NumPy. Cells without hits are 0. Key functions other than len,
+    max and sum fall back to get_cell_values() for each cluster.
+
+    Args:
+        queries (list): Names of query sequences (matrix columns).
+        clusters (list): Cluster objects (matrix rows).
+        key (callable): len, max, sum or some callable that takes a list.
+        attr (str): A Hit attribute to calculate values with in key function.
+        counts (bool): Also return the number of hits in each cell.
+    Returns:
+        NumPy array of shape (clusters, queries), and the hit counts if counts=True.
+    """
+    clusters = list(clusters)
+    shape = (len(clusters), len(queries))
+    size = shape[0] * shape[1]
+    if key not in (len, max, sum):
+        matrix = np.array(
+            [get_cell_values(queries, c.subjects, key=key, attr=attr) for c in clusters]
+        ).reshape(shape)
+        if counts:
+            cells, _ = _bucket_hits(queries, clusters)
+            return matrix, np.bincount(cells, minlength=size).reshape(shape)
+        return matrix
+    cells, values = _bucket_hits(queries, clusters, None if key is len else attr)
+    total = np.bincount(cells, minlength=size)
+    if key is len:
+        matrix = total
+    elif key is sum:
+        matrix = np.bincount(cells, weights=values, minlength=size)
+    else:
+        matrix = np.full(size, -np.inf)
+        np.maximum.at(matrix, cells, values)
+        matrix[total == 0] = 0
+    if counts:
+        return matrix.reshape(shape), total.reshape(shape)
+    return matrix.reshape(shape)
+
+
+def write_matrix(session, path, key=len, attr="identity", sparse=False):
+    """Writes the binary table of a Session as a NumPy .npz matrix file.
+
+    Rows are clusters and columns are queries. Row labels are stored in the
+    organisms, scaffolds, starts and ends arrays, and column labels in queries.
+    Dense matrices are stored in the matrix array. Sparse matrices are stored in
+    coordinate (COO) format, which can be loaded by scipy.sparse.load_npz():
+
+    >>> matrix = scipy.sparse.load_npz("matrix.npz")
+    >>> labels = numpy.load("matrix.npz")["organisms"]
+
+    Args:
+        session (Session): cblaster Session object
+        path (str): Path to the .npz file
+        key (callable): Key function used to calculate cell values
+        attr (str): Hit attribute used to calculate cell values
+        sparse (bool): Only store non-empty cells
+    """
+    rows = [
+        (organism.full_name, accession, cluster)
+        for organism in session.organisms
+        for accession, scaffold in organism.scaffolds.items()
+        for cluster in scaffold.clusters
+    ]
+    matrix, counts = binary_matrix(
+        session.queries,
+        (cluster for *_, cluster in rows),
+        key=key,
+        attr=attr,
+        counts=True,
+    )
+    labels = dict(
+        queries=np.array(session.queries, dtype=str),
+        organisms=np.array([name for name, _, _ in rows], dtype=str),
+        scaffolds=np.array([accession for _, accession, _ in rows], dtype=str),
+        starts=np.array([cluster.start for *_, cluster in rows], dtype=np.int64),
+        ends=np.array([cluster.end for *_, cluster in rows], dtype=np.int64),
+    )
+    if sparse:
+        row, col = np.nonzero(counts)
+        np.savez_compressed(
+            path,
+            format="coo",
+            shape=np.array(matrix.shape),
+            row=row,
+            col=col,
+            data=matrix[row, col],
+            **labels,
+        )
+    else:
+        np.savez_compressed(path, matrix=matrix, **labels)
 
 
 def set_decimals(value, decimals=4):
@@ -82,33 +206,158 @@ def binary(
     attr="identity",
     decimals=4
 ):
-    """Generates a binary summary table from a Session object."""
-    rows = [
-        [
-            organism.full_name,
-            accession,
-            str(cluster[0].start),
-            str(cluster[-1].end),
-            *[
-                set_decimals(value)
-                for value in get_cell_values(
-                    session.queries,
-                    cluster,
-                    key=key,
-                    attr=attr
-                )
+    """Generates a binary summary table from a Session object.
+
+    See write_binary() for arguments; this returns the table as a string.
+    """
+    handle = io.StringIO()
+    write_binary(
+        session,
+        handle,
+        hide_headers=hide_headers,
+        delimiter=delimiter,
+        key=key,
+        attr=attr,
+        decimals=decimals,
+    )
+    return handle.getvalue()[:-1]
+
+
+def _binary_rows(matrix, counts, key, block_size):
+    """Yields the rows of a binary table matrix as lists of Python numbers.
+
+    The matrix is converted block_size rows at a time, so the whole table is never
+    held as Python objects at once.
+    """
+    for start in range(0, matrix.shape[0], block_size):
+        values = matrix[start : start + block_size].tolist()
+        if key in (max, sum):
+            # Empty cells are written as in get_cell_values(), i.e. sum([]) == 0
+            total = counts[start : start + block_size].tolist()
+            values = [
+                [value if count else 0 for value, count in zip(row, row_counts)]
+                for row, row_counts in zip(values, total)
             ]
-        ]
+        yield from values
+
+
+def _binary_widths(session, values, headers=None):
+    """Computes the column widths of a human-readable binary table.
+
+    Cell values are compared as numbers; only the smallest and largest value in each
+    column (separately for integer and decimal values) need to be formatted, since
+    formatted values cannot be shorter than those of smaller magnitude.
+    """
+    if headers:
+        widths = [len(header) for header in headers]
+    else:
+        widths = [0] * (len(session.queries) + 4)
+    bounds = {}
+    clusters = (
+        (organism, accession, cluster)
         for organism in session.organisms
         for accession, scaffold in organism.scaffolds.items()
         for cluster in scaffold.clusters
-    ]
-    if not hide_headers:
-        rows.insert(0, ["Organism", "Scaffold", "Start", "End", *session.queries])
-    if not delimiter:
+    )
+    for (organism, accession, cluster), row in zip(clusters, values):
+        widths[0] = max(widths[0], len(organism.full_name))
+        widths[1] = max(widths[1], len(accession))
+        widths[2] = max(widths[2], len(str(cluster.start)))
+        widths[3] = max(widths[3], len(str(cluster.end)))
+        for index, value in enumerate(row, 4):
+            bound = (index, isinstance(value, int))
+            low, high = bounds.get(bound, (value, value))
+            bounds[bound] = (min(low, value), max(high, value))
+    for (index, _), (low, high) in bounds.items():
+        widths[index] = max(
+            widths[index],
+            len(set_decimals(low)),
+            len(set_decimals(high)),
+        )
+    return widths
+
+
+def write_binary(
+    session,
+    handle,
+    hide_headers=False,
+    delimiter=None,
+    key=len,
+    attr="identity",
+    decimals=4,
+):
+    """Writes a binary summary table of a Session to a file handle.
+
+    Cell values of every cluster are computed at once (see binary_matrix()), then
+    converted in blocks of rows (see _binary_rows()), and rows are formatted and
+    written one at a time. For the human-readable layout, column widths are first
+    computed from the cell values (see _binary_widths()) rather than from
+    formatted rows.
+
+    Args:
+        session (Session): cblaster Session object
+        handle (file handle): File handle to write to
+        hide_headers (bool): Hide column headers
+        delimiter (str): Delimiter between columns; if None, the table is padded
+            to be human-readable
+        key (callable): Key function used to calculate cell values
+        attr (str): Hit attribute used to calculate cell values
+        decimals (int): Total decimal places in cell values
+    """
+    matrix, counts = binary_matrix(
+        session.queries,
+        (
+            cluster
+            for organism in session.organisms
+            for scaffold in organism.scaffolds.values()
+            for cluster in scaffold.clusters
+        ),
+        key=key,
+        attr=attr,
+        counts=True,
+    )
+    headers = ["Organism", "Scaffold", "Start", "End", *session.queries]
+    if delimiter:
+        widths = None
+    else:
         delimiter = "  "
-        rows = humanise(rows)
-    return "\n".join(delimiter.join(row) for row in rows)
+        widths = _binary_widths(
+            session,
+            _binary_rows(matrix, counts, key, BINARY_BLOCK_ROWS),
+            headers=None if hide_headers else headers,
+        )
+
+    def write_row(row):
+        if widths:
+            row = [f"{field:{width}}" for field, width in zip(row, widths)]
+        handle.write(delimiter.join(row))
+
+    rows = 0
+    if not hide_headers:
+        write_row(headers)
+        rows += 1
+    clusters = (
+        (organism, accession, cluster)
+        for organism in session.organisms
+        for accession, scaffold in organism.scaffolds.items()
+        for cluster in scaffold.clusters
+    )
+    for (organism, accession, cluster), row in zip(
+        clusters, _binary_rows(matrix, counts, key, BINARY_BLOCK_ROWS)
+    ):
+        if rows:
+            handle.write("\n")
+        write_row(
+            [
+                organism.full_name,
+                accession,
+                str(cluster.start),
+                str(cluster.end),
+                *[set_decimals(value) for value in row],
+            ]
+        )
+        rows += 1
+    handle.write("\n")
 
 
 def _summarise(
@@ -211,6 +460,45 @@ def summary(session, hide_headers=False, delimiter=None, decimals=4):
     )
 
 
+def write_summary(session, handle, hide_headers=False, delimiter=None, decimals=4):
+    """Writes a summary table of a Session to a file handle.
+
+    The output is the same as printing summary(), but each cluster table is
+    formatted and written separately, so only one is held in memory at a time.
+
+    Args:
+        session (Session): cblaster Session object
+        handle (file handle): File handle to write to
+        hide_headers (bool): Hide column headers in cluster tables
+        delimiter (str): Delimiter between columns; if None, cluster tables are
+            padded to be human-readable
+        decimals (int): Total decimal places in hit scores
+    """
+    handle.write(generate_header_string("cblaster search", "=") + "\n")
+    organisms = (o for o in session.organisms if o.total_hit_clusters > 0)
+    for i, organism in enumerate(organisms):
+        if i > 0:
+            handle.write("\n\n\n")
+        handle.write(generate_header_string(organism.full_name, "=") + "\n")
+        scaffolds = (s for s in organism.scaffolds.values() if s.clusters)
+        for j, scaffold in enumerate(scaffolds):
+            if j > 0:
+                handle.write("\n\n")
+            handle.write(generate_header_string(scaffold.accession) + "\n")
+            for k, cluster in enumerate(scaffold.clusters):
+                if k > 0:
+                    handle.write("\n\n")
+                handle.write(
+                    summarise_cluster(
+                        cluster,
+                        decimals=decimals,
+                        hide_headers=hide_headers,
+                        delimiter=delimiter,
+                    )
+                )
+    handle.write("\n")
+
+
 def summarise_gne(data, hide_headers=False, delimiter=None, decimals=4):
     rows = []
     hdrs = ["Gap", "Means", "Medians", "Clusters"]
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 
+import hashlib
+import os
+import random
 import shutil
 import requests
 import logging
+import threading
+import time
 
 import g2j
 from g2j import genbank
@@ -11,11 +16,18 @@ from g2j import genbank
 from cblaster import embl
 
 from pathlib import Path
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from urllib3.exceptions import NewConnectionError
 
 
 LOG = logging.getLogger(__name__)
 
+# Base URL replacing the NCBI hosts in requests, e.g. of a local stand-in server
+# (see benchmarks/ncbi_server.py); set with set_ncbi_url()
+NCBI_URL = os.environ.get("CBLASTER_NCBI_URL")
+
 
 def get_program_path(aliases):
     """Get programs path given a list of program names.
@@ -34,6 +46,240 @@ def get_program_path(aliases):
     raise ValueError(f"Failed to find {aliases} on system $PATH!")
 
 
+class RateLimiter:
+    """Spaces out calls across threads to stay under a maximum rate.
+
+    Each call to wait() blocks until the next free slot, such that no more than
+    `rate` calls are let through per second, e.g. to respect NCBI E-utilities
+    limits (3 requests per second, or 10 with an API key).
+
+    >>> limiter = RateLimiter(3)
+    >>> limiter.wait()  # returns immediately
+    >>> limiter.wait()  # returns after ~0.33s
+    """
+
+    def __init__(self, rate):
+        if rate is not None and rate <= 0:
+            raise ValueError("Expected positive rate")
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """Blocks until a call is permitted."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HTTPClient:
+    """Pooled HTTP client with retries, used for all NCBI requests.
+
+    Connections are kept alive in a pool shared by all threads. Connection errors
+    and responses with a status in RETRY_STATUSES are retried up to `retries`
+    times. Each retry waits for the time given in a Retry-After header if there is
+    one, and otherwise for a random time of up to backoff * 2 ** attempt seconds
+    (i.e. exponential backoff with full jitter), capped at max_backoff seconds.
+    If every attempt fails, the last response is returned (or the last connection
+    error is raised), so callers can check status codes as before.
+
+    Requests that are not idempotent (e.g. submitting a BLAST search, which would
+    queue a duplicate search) are only retried if they could not have reached the
+    server, i.e. on 429 responses and on errors while connecting. Timeouts and 5xx
+    responses are not retried, since the request may already have been accepted.
+
+    The number of requests, retries and failures, and the total time spent waiting
+    for responses, are counted per endpoint (URL path); see stats().
+
+    >>> client = get_client()
+    >>> response = client.get("https://blast.ncbi.nlm.nih.gov/Blast.cgi", params=...)
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self, retries=5, backoff=1, max_backoff=60, pool_size=10, timeout=(10, 600)
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._stats = defaultdict(
+            lambda: {"requests": 0, "retries": 0, "failures": 0, "seconds": 0.0}
+        )
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, response=None):
+        """Computes the time (s) to wait before retrying a request."""
+        retry_after = response is not None and response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    date = parsedate_to_datetime(retry_after)
+                    delay = date.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = self.backoff
+            return min(max(delay, 0), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _not_sent(error):
+        """Tests if a request failed while connecting, i.e. before it was sent."""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        if isinstance(error, requests.Timeout):
+            return False
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+    def _count(self, endpoint, seconds, retry=False, failure=False):
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+            stats["retries"] += retry
+            stats["failures"] += failure
+
+    def request(self, method, url, idempotent=True, limiter=None, **kwargs):
+        """Sends a request, retrying on connection errors and retryable statuses.
+
+        Args:
+            method (str): HTTP method, e.g. 'GET'
+            url (str): Request URL
+            idempotent (bool): The request can safely be sent more than once
+            limiter (RateLimiter): Shared rate limiter to wait on before every
+                attempt, so retries also count towards the request rate
+            **kwargs: Keyword arguments passed to requests.Session.request()
+        Returns:
+            requests.Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = urlsplit(url).path
+        for attempt in range(self.retries + 1):
+            if limiter:
+                limiter.wait()
+            start = time.perf_counter()
+            response, error = None, None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                error = exception
+            failed = error is not None or response.status_code in self.RETRY_STATUSES
+            self._count(
+                endpoint,
+                time.perf_counter() - start,
+                retry=attempt > 0,
+                failure=failed,
+            )
+            if not failed:
+                return response
+            if idempotent:
+                retry = True
+            elif error:
+                retry = self._not_sent(error)
+            else:
+                retry = response.status_code == 429
+            if not retry or attempt == self.retries:
+                if error:
+                    raise error
+                return response
+            delay = self.delay(attempt, response)
+            LOG.warning(
+                "Request to %s failed (%s), retrying in %.1fs [%i/%i]",
+                endpoint,
+                error or f"status {response.status_code}",
+                delay,
+                attempt + 1,
+                self.retries,
+            )
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """Gets request counts and mean latency (s) of each endpoint."""
+        with self._lock:
+            return {
+                endpoint: {
+                    **stats,
+                    "mean_seconds": stats["seconds"] / stats["requests"],
+                }
+                for endpoint, stats in self._stats.items()
+            }
+
+    def log_stats(self):
+        """Logs request counts and latencies of each endpoint."""
+        for endpoint, stats in sorted(self.stats().items()):
+            LOG.info(
+                "%s: %i requests (%i retries, %i failed), mean latency %.2fs",
+                endpoint,
+                stats["requests"],
+                stats["retries"],
+                stats["failures"],
+                stats["mean_seconds"],
+            )
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """Gets the shared HTTPClient, creating it on first use."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = HTTPClient()
+        return _CLIENT
+
+
+def set_ncbi_url(url=None):
+    """Sets the base URL used in place of NCBI hosts (None to use the NCBI)."""
+    global NCBI_URL
+    NCBI_URL = url.rstrip("/") if url else None
+    if NCBI_URL:
+        LOG.info("Sending NCBI requests to %s", NCBI_URL)
+
+
+def ncbi_url(url):
+    """Rewrites an NCBI URL to use the base URL set with set_ncbi_url().
+
+    The path and query are kept, so one server can stand in for every NCBI host:
+
+    >>> set_ncbi_url("http://localhost:8000")
+    >>> ncbi_url("https://blast.ncbi.nlm.nih.gov/Blast.cgi")
+    'http://localhost:8000/Blast.cgi'
+    """
+    if not NCBI_URL:
+        return url
+    parts = urlsplit(url)
+    return NCBI_URL + parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+def file_hash(path):
+    """Computes the SHA256 hash of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def form_command(parameters):
     """Flatten a dictionary to create a command list for use in subprocess.run()"""
     command = [] if "args" not in parameters else parameters.pop("args")
@@ -111,6 +357,26 @@ def _extract_sequences_from_organism(organism):
     return sequences
 
 
+def find_identifier(qualifiers):
+    """Finds an identifier from a dictionary of feature qualifiers.
+
+    This function selects for the following fields in decreasing order:
+    protein_id, locus_tag, ID and Gene. This should cover most cases where CDS
+    features do not have protein ID's.
+
+    Args:
+        qualifiers (dict): Feature qualifiers parsed with genome2json.
+    Returns:
+        Identifier, if found, otherwise None.
+    """
+    for field in ("protein_id", "locus_tag", "ID", "Gene"):
+        try:
+            return qualifiers[field]
+        except KeyError:
+            pass
+    return None
+
+
 def parse_fasta_file(path):
     with open(path) as fp:
         sequences = parse_fasta(fp)
@@ -127,8 +393,8 @@ def efetch_sequences_request(headers):
     Returns:
         requests.models.Response: Response returned by requests library.
     """
-    response = requests.post(
-        "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?",
+    response = get_client().post(
+        ncbi_url("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?"),
         params={"db": "protein", "rettype": "fasta"},
         files={"id": ",".join(headers)},
     )
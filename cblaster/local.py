@@ -4,42 +4,167 @@
 import logging
 import subprocess
 import os
+import threading
 
-from tempfile import NamedTemporaryFile as NTF
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import attrgetter
+from tempfile import NamedTemporaryFile as NTF, TemporaryFile
 
 from cblaster import helpers
 from cblaster.classes import Hit
+from cblaster.database import get_dbsize, get_shards
 
 
 LOG = logging.getLogger(__name__)
 
 
+def iter_hits(results, min_identity=30, min_coverage=50, max_evalue=0.01):
+    """Generates Hit objects from rows of a BLAST/DIAMOND result table.
+
+    Rows are consumed one at a time, and Hit objects are only created for rows that
+    pass the score thresholds. This means results can be streamed directly from a
+    running search (i.e. from diamond()) without holding the full table in memory.
+
+    Arguments:
+        results (iterable): Results returned by diamond() or blastp()
+        min_identity (float): Minimum identity (%) cutoff
+        min_coverage (float): Minimum coverage (%) cutoff
+        max_evalue (float): Maximum e-value threshold
+    Yields:
+        Hit: Hit objects representing hits that surpass scoring thresholds
+    """
+    for row in results:
+        if not row:
+            continue
+        fields = row.split("\t")
+        if (
+            float(fields[2]) > min_identity
+            and float(fields[3]) > min_coverage
+            and float(fields[4]) < max_evalue
+        ):
+            yield Hit(*fields)
+
+
+def filter_rows(rows, min_identity=30, min_coverage=50, max_evalue=0.01):
+    """Filters rows of a DIAMOND result table by score thresholds.
+
+    Thresholds are inclusive, as in DIAMOND's --id, --query-cover and --evalue
+    options, so filtering a table from a looser search gives the same table as
+    searching with these thresholds.
+    """
+    for row in rows:
+        if not row:
+            continue
+        fields = row.split("\t")
+        if (
+            float(fields[2]) >= min_identity
+            and float(fields[3]) >= min_coverage
+            and float(fields[4]) <= max_evalue
+        ):
+            yield row
+
+
 def parse(results, min_identity=30, min_coverage=50, max_evalue=0.01):
     """Parse a string containing results of a BLAST/DIAMOND search.
 
     Arguments:
-        results (list): Results returned by diamond() or blastp()
+        results (iterable): Results returned by diamond() or blastp()
         min_identity (float): Minimum identity (%) cutoff
         min_coverage (float): Minimum coverage (%) cutoff
         max_evalue (float): Maximum e-value threshold
+    Raises:
+        SystemExit: No hits surpassed the scoring thresholds
     Returns:
         list: Hit objects representing hits that surpass scoring thresholds
     """
-    hits = []
-    for row in results[:-1]:
-        hit = Hit(*row.split("\t"))
-        if (
-            hit.identity > min_identity
-            and hit.coverage > min_coverage
-            and hit.evalue < max_evalue
-        ):
-            hits.append(hit)
+    hits = list(
+        iter_hits(
+            results,
+            min_identity=min_identity,
+            min_coverage=min_coverage,
+            max_evalue=max_evalue,
+        )
+    )
     if len(hits) == 0:
         raise SystemExit("No results found")
     return hits
 
 
-def diamond(fasta, database, max_evalue=0.01, min_identity=30, min_coverage=50, cpus=1):
+def group_queries(hits):
+    """Orders hits by query, in order of first appearance.
+
+    Hits of each query keep their relative order. This is used to merge the hits of
+    several tables (e.g. of database shards), so hits of each query are consecutive
+    as in a single DIAMOND table (see limit_targets()).
+    """
+    order = {}
+    return sorted(hits, key=lambda hit: order.setdefault(hit.query, len(order)))
+
+
+def limit_targets(hits, max_targets=25):
+    """Keeps the best scoring hits (by bitscore) of each query.
+
+    This applies DIAMOND's --max-target-seqs limit to hits that were not found in a
+    single search, e.g. hits filtered from a cached table of a search without a
+    target limit. Hits of each query must be consecutive, as in a DIAMOND table
+    (see group_queries()); they are buffered one query at a time, and yielded in
+    their original order once the next query is reached.
+
+    Arguments:
+        hits (iterable): Hit objects, with at most one hit per query and subject
+        max_targets (int): Maximum hits per query (0 for no limit)
+    Yields:
+        Hit: Remaining Hit objects
+    """
+    if not max_targets:
+        yield from hits
+        return
+    for _, group in groupby(hits, key=attrgetter("query")):
+        group = list(group)
+        if len(group) > max_targets:
+            best = sorted(range(len(group)), key=lambda i: -group[i].bitscore)
+            keep = set(best[:max_targets])
+            group = [hit for index, hit in enumerate(group) if index in keep]
+        yield from group
+
+
+def require_hits(hits):
+    """Yields hits, exiting if there were none once they are exhausted.
+
+    Raises:
+        SystemExit: No hits surpassed the scoring thresholds
+    """
+    total = 0
+    for total, hit in enumerate(hits, 1):
+        yield hit
+    if total == 0:
+        raise SystemExit("No results found")
+
+
+def write_rows(rows, handle, lock=None):
+    """Writes rows of a result table to a file handle as they are iterated.
+
+    A lock can be given when several tables are written to the same handle at once,
+    e.g. when searching database shards concurrently, so rows are not interleaved.
+    """
+    lock = lock or threading.Lock()
+    for row in rows:
+        with lock:
+            handle.write(f"{row}\n")
+        yield row
+
+
+def diamond(
+    fasta,
+    database,
+    max_evalue=0.01,
+    min_identity=30,
+    min_coverage=50,
+    cpus=1,
+    max_targets=25,
+    dbsize=None,
+):
     """Launch a local DIAMOND search against a database.
 
     Arguments:
@@ -49,8 +174,14 @@ def diamond(fasta, database, max_evalue=0.01, min_identity=30, min_coverage=50,
         min_identity (float): Minimum identity (%) cutoff
         min_coverage (float): Minimum coverage (%) cutoff
         cpus (int): Number of CPU threads for DIAMOND to use
-    Returns:
-        list: Rows from DIAMOND search result table (split by newline)
+        max_targets (int): Maximum target sequences reported per query (0 for no
+            limit). DIAMOND's own default is 25.
+        dbsize (int): Effective database size (residues) used to compute E-values,
+            i.e. the size of the whole database when searching one of its shards
+    Raises:
+        subprocess.CalledProcessError: DIAMOND exited with a non-zero status
+    Yields:
+        str: Rows from DIAMOND search result table, as they are produced
     """
     diamond = helpers.get_program_path(["diamond", "diamond-aligner"])
     LOG.debug("diamond path: %s", diamond)
@@ -73,19 +204,25 @@ def diamond(fasta, database, max_evalue=0.01, min_identity=30, min_coverage=50,
         "--threads": str(cpus),
         "--query-cover": str(min_coverage),
         "--max-hsps": "1",
+        "--max-target-seqs": str(max_targets),
     }
+    if dbsize:
+        parameters["--dbsize"] = str(dbsize)
 
     command = helpers.form_command(parameters)
     LOG.debug("Parameters: %s", command)
 
-    results = subprocess.run(
+    with subprocess.Popen(
         command,
         stderr=subprocess.DEVNULL,
         stdout=subprocess.PIPE,
-        check=True
-    )
+        universal_newlines=True,
+    ) as process:
+        for line in process.stdout:
+            yield line.rstrip("\n")
 
-    return results.stdout.decode().split("\n")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
 
 def search(
@@ -94,43 +231,151 @@ def search(
     query_file=None,
     query_ids=None,
     blast_file=None,
-    **kwargs,
+    min_identity=30,
+    min_coverage=50,
+    max_evalue=0.01,
+    cpus=1,
+    cache=None,
+    max_targets=25,
 ):
     """Launch a new BLAST search using either DIAMOND or command-line BLASTp (remote).
 
     Arguments:
-        database (str): Path to DIAMOND database
+        database (str): Path to DIAMOND database, or a sharded database
         sequences (dict): Query sequences
         query_file (str): Path to FASTA file containing query sequences
         query_ids (list): NCBI sequence accessions
         blast_file (TextIOWrapper): file blast results are written to
+        min_identity (float): Minimum identity (%) cutoff
+        min_coverage (float): Minimum coverage (%) cutoff
+        max_evalue (float): Maximum e-value threshold
+        cpus (int): Total number of CPU threads for DIAMOND to use
+        cache (HitCache): Cache of previous search results
+        max_targets (int): Maximum target sequences per query (0 for no limit)
     Raises:
         ValueError: No value given for query_file or query_ids
+        SystemExit: No hits surpassed the scoring thresholds (once the returned hits
+            are exhausted)
     Returns:
-        list: Parsed rows with hits from DIAMOND results table
+        generator: Hit objects with hits from DIAMOND results table. Hits from an
+            unsharded database are yielded as DIAMOND produces them, so they can be
+            consumed before the search has finished.
     """
     if query_file:
-        table = diamond(query_file, database, **kwargs)
+        query = None
+        if cache:
+            with open(query_file) as handle:
+                query = handle.read()
     else:
         if not sequences:
             sequences = helpers.get_sequences(query_ids=query_ids)
+        query = helpers.sequences_to_fasta(sequences)
 
-        # delete=False since you cannot open tempfiles twice in Windows
-        # see: https://stackoverflow.com/questions/46497842/passing-namedtemporaryfile-to-a-subprocess-on-windows
-        fasta = NTF("w", delete=False)
-        text = helpers.sequences_to_fasta(sequences)
-        try:
-            with fasta:
-                fasta.write(text)
-            table = diamond(fasta.name, database, **kwargs)
-        finally:
-            os.unlink(fasta.name)
+    # Sharded databases (see database.makedb) are searched one DIAMOND process per
+    # shard, dividing the CPU threads between concurrent searches. E-values of each
+    # shard are computed against the size of the whole database, and the target
+    # limit is applied again to the merged hits, so results match an unsharded
+    # search (the hit table written to blast_file has the rows of every shard)
+    shards = get_shards(database)
+    dbsize = None
+    if len(shards) > 1:
+        dbsize = get_dbsize(database)
+        if not dbsize:
+            LOG.warning(
+                "Database size is not recorded in the manifest of %s, so E-values"
+                " are computed per shard; rebuild the database to fix this",
+                database,
+            )
+    thresholds = dict(
+        min_identity=min_identity,
+        min_coverage=min_coverage,
+        max_evalue=max_evalue,
+    )
 
-    results = parse(table)
+    key = cache.key(query, shards) if cache else None
+    cached = cache.lookup(key, max_targets=max_targets, **thresholds) if key else None
+    if cached is not None:
+        LOG.info("Found cached DIAMOND results, skipping search")
+        table = filter_rows(cached, **thresholds)
+        if blast_file:
+            LOG.info("Writing DIAMOND hit table to %s", blast_file.name)
+            table = write_rows(table, blast_file)
+        # Tables cached from sharded searches are not grouped by query
+        hits = group_queries(iter_hits(table, **thresholds))
+        return require_hits(limit_targets(hits, max_targets))
 
+    workers = max(1, min(len(shards), cpus))
+    threads = max(1, cpus // workers)
+    if len(shards) > 1:
+        LOG.info(
+            "Searching %i database shards (%i at a time, %i threads each)",
+            len(shards),
+            workers,
+            threads,
+        )
     if blast_file:
         LOG.info("Writing DIAMOND hit table to %s", blast_file.name)
-        blast = "\n".join(results)
-        blast_file.write(blast)
+    lock = threading.Lock()
+    spool_lock = threading.Lock()
+
+    def search_shard(shard, fasta, spool):
+        table = diamond(
+            fasta,
+            shard,
+            cpus=threads,
+            max_targets=max_targets,
+            dbsize=dbsize,
+            **thresholds,
+        )
+        if blast_file:
+            table = write_rows(table, blast_file, lock=lock)
+        if spool:
+            table = write_rows(table, spool, lock=spool_lock)
+        return iter_hits(table, **thresholds)
+
+    def search_shards():
+        if query_file:
+            fasta = None
+        else:
+            # delete=False since you cannot open tempfiles twice in Windows
+            # see: https://stackoverflow.com/questions/46497842/passing-namedtemporaryfile-to-a-subprocess-on-windows
+            fasta = NTF("w", delete=False)
+            with fasta:
+                fasta.write(query)
+
+        # Rows are spooled to a temporary file for the cache as they are parsed, and
+        # only added to the cache once every search has finished successfully
+        spool = TemporaryFile("w+") if key else None
+
+        # Rows are parsed as DIAMOND produces them, so the DIAMOND query file must
+        # not be removed until every table has been fully consumed
+        path = query_file or fasta.name
+        try:
+            if len(shards) == 1:
+                yield from search_shard(shards[0], path, spool)
+            else:
+                # Hits of every shard are needed to apply the target limit
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    tables = list(
+                        executor.map(
+                            lambda shard: list(search_shard(shard, path, spool)),
+                            shards,
+                        )
+                    )
+                hits = group_queries(hit for hits in tables for hit in hits)
+                yield from limit_targets(hits, max_targets)
+            if spool:
+                spool.seek(0)
+                cache.update(
+                    key,
+                    (line.rstrip("\n") for line in spool),
+                    max_targets=max_targets,
+                    **thresholds,
+                )
+        finally:
+            if fasta:
+                os.unlink(fasta.name)
+            if spool:
+                spool.close()
 
-    return results
+    return require_hits(search_shards())
@@ -8,6 +8,7 @@ from pathlib import Path
 
 
 from cblaster import (
+    cache,
     context,
     database,
     helpers,
@@ -18,7 +19,7 @@ from cblaster import (
 )
 from cblaster.classes import Session
 from cblaster.plot import plot_session, plot_gne
-from cblaster.formatters import summarise_gne
+from cblaster.formatters import summarise_gne, write_matrix
 
 
 logging.basicConfig(
@@ -29,19 +30,12 @@ logging.basicConfig(
 LOG = logging.getLogger(__name__)
 
 
-def makedb(genbanks, filename, indent=None):
-    """Generate JSON and diamond databases."""
+def makedb(genbanks, filename, indent=None, cpus=1, append=False, shards=1):
+    """Generate JSON, SQLite index and diamond databases."""
     LOG.info("Starting cblaster makedb")
-    db = database.Database.from_files(genbanks)
-
-    LOG.info("Writing FASTA file with database sequences: %s", filename + ".faa")
-    LOG.info("Building DIAMOND database: %s", filename + ".dmnd")
-    db.makedb(filename)
-
-    LOG.info("Building JSON database: %s", filename + ".json")
-    with open(f"{filename}.json", "w") as handle:
-        db.to_json(handle, indent=indent)
-
+    database.makedb(
+        genbanks, filename, cpus=cpus, indent=indent, append=append, shards=shards
+    )
     LOG.info("Done.")
 
 
@@ -59,8 +53,7 @@ def gne(
     """Estimate gene neighbourhood."""
     LOG.info("Starting cblaster gene neighbourhood estimation")
     LOG.info("Loading session from: %s", session)
-    with open(session) as fp:
-        session = Session.from_json(fp)
+    session = Session.from_file(session)
 
     LOG.info("Computing gene neighbourhood statistics")
     results = context.estimate_neighbourhood(
@@ -106,6 +99,8 @@ def cblaster(
     binary_key=len,
     binary_attr="identity",
     binary_decimals=4,
+    binary_matrix=None,
+    binary_sparse=False,
     rid=None,
     require=None,
     session_file=None,
@@ -115,6 +110,15 @@ def cblaster(
     blast_file=None,
     ipg_file=None,
     hitlist_size=None,
+    max_targets=25,
+    api_key=None,
+    ncbi_url=None,
+    ipg_cache=True,
+    ipg_cache_age=30,
+    cpus=1,
+    hit_cache=True,
+    hit_cache_age=30,
+    deduplicate_organisms=False,
 ):
     """Run cblaster.
 
@@ -143,36 +147,58 @@ def cblaster(
         binary_key (str): Key function used in binary table (len, max or sum)
         binary_attr (str): Hit attribute used for calculating cell values in binary table
         binary_decimals (int): Total decimal places in cell values in binary table
+        binary_matrix (str): Path to NumPy matrix file of binary table cell values
+        binary_sparse (bool): Write the binary table matrix in sparse format
         rid (str): NCBI BLAST search request identifier (RID)
         require (list): Query sequences that must be in hit clusters
         session_file (str): Path to cblaster session JSON file
         indent (int): Total spaces to indent JSON files
         plot (str): Path to cblaster plot HTML file
         recompute (str): Path to recomputed session JSON file
+        max_targets (int): Maximum target sequences per query in local searches
+        api_key (str): NCBI API key used for E-utilities requests
+        ncbi_url (str): Base URL to send NCBI requests to instead of the NCBI
+        ipg_cache (str): Path to IPG cache database (True for default, False to disable)
+        ipg_cache_age (float): Maximum age (days) of cached IPG entries
+        cpus (int): Number of DIAMOND threads in local searches, and of processes
+            used to find clusters in large searches (see
+            context.find_clusters_in_organisms())
+        hit_cache (str): Path to hit table cache database (True for default, False
+            to disable)
+        hit_cache_age (float): Maximum age (days) of cached hit tables
+        deduplicate_organisms (bool): Remove duplicate clusters across organisms
     Returns:
         Session: cblaster search Session object
     """
 
+    if ncbi_url:
+        helpers.set_ncbi_url(ncbi_url)
+
     if session_file and all(Path(sf).exists() for sf in session_file):
         LOG.info("Loading session(s) %s", session_file)
-        session = Session.from_files(session_file)
-
+        filters = None
         if recompute:
             LOG.info("Filtering session with new thresholds")
-            context.filter_session(
-                session,
-                min_identity,
-                min_coverage,
-                max_evalue,
-                gap,
-                unique,
-                min_hits,
-                require,
+            filters = dict(
+                min_identity=min_identity,
+                min_coverage=min_coverage,
+                max_evalue=max_evalue,
+                gap=gap,
+                unique=unique,
+                min_hits=min_hits,
+                require=require,
+                deduplicate_organisms=deduplicate_organisms,
             )
+        session = Session.from_files(session_file, recompute=filters)
+
+        # File matching the Session, used to cache plot data
+        saved_file = session_file[0] if len(session_file) == 1 else None
+        if recompute:
+            saved_file = None
             if recompute is not True:
                 LOG.info("Writing recomputed session to %s", recompute)
-                with open(recompute, "w") as fp:
-                    session.to_json(fp, indent=indent)
+                session.to_file(recompute, indent=indent)
+                saved_file = recompute
     else:
         session = Session(
             queries=query_ids if query_ids else [],
@@ -198,56 +224,93 @@ def cblaster(
         if json_db:
             session.params["json_db"] = json_db
 
-        if mode == "local":
-            LOG.info("Starting cblaster in local mode")
-            results = local.search(
-                database,
-                sequences=session.sequences,
-                min_identity=min_identity,
-                min_coverage=min_coverage,
-                max_evalue=max_evalue,
-                blast_file=blast_file,
+        if mode == "local" and hit_cache:
+            hit_cache = cache.HitCache(
+                None if hit_cache is True else hit_cache,
+                max_age=hit_cache_age,
             )
-        elif mode == "remote":
-            LOG.info("Starting cblaster in remote mode")
-            if entrez_query:
-                session.params["entrez_query"] = entrez_query
-            rid, results = remote.search(
-                sequences=session.sequences,
-                rid=rid,
-                database=database,
-                min_identity=min_identity,
-                min_coverage=min_coverage,
-                max_evalue=max_evalue,
-                entrez_query=entrez_query,
-                blast_file=blast_file,
-                hitlist_size=hitlist_size,
+            LOG.info("Using hit table cache: %s", hit_cache.path)
+        else:
+            hit_cache = None
+        if mode == "remote" and not json_db and ipg_cache:
+            ipg_cache = cache.IPGCache(
+                None if ipg_cache is True else ipg_cache,
+                max_age=ipg_cache_age,
             )
-            session.params["rid"] = rid
+            LOG.info("Using IPG cache: %s", ipg_cache.path)
+        else:
+            ipg_cache = None
+
+        # Local hits are streamed from DIAMOND into the context lookup, so the hit
+        # cache is kept open until they have all been consumed. Caches are closed
+        # even if the search fails
+        try:
+            if mode == "local":
+                LOG.info("Starting cblaster in local mode")
+                results = local.search(
+                    database,
+                    sequences=session.sequences,
+                    min_identity=min_identity,
+                    min_coverage=min_coverage,
+                    max_evalue=max_evalue,
+                    blast_file=blast_file,
+                    cpus=cpus,
+                    cache=hit_cache,
+                    max_targets=max_targets,
+                )
+            elif mode == "remote":
+                LOG.info("Starting cblaster in remote mode")
+                if entrez_query:
+                    session.params["entrez_query"] = entrez_query
+                rid, results = remote.search(
+                    sequences=session.sequences,
+                    rid=rid,
+                    database=database,
+                    min_identity=min_identity,
+                    min_coverage=min_coverage,
+                    max_evalue=max_evalue,
+                    entrez_query=entrez_query,
+                    blast_file=blast_file,
+                    hitlist_size=hitlist_size,
+                )
+                session.params["rid"] = rid
+
+            LOG.info("Fetching genomic context of hits")
+
+            query_sequence_order = list(session.sequences.keys()) \
+                if any(query_file.endswith(ext) for ext in (".gbk", ".gb", ".genbank", ".gbff", ".embl", ".emb"))\
+                else None
+
+            session.organisms = context.search(
+                results,
+                unique=unique,
+                min_hits=min_hits,
+                gap=gap,
+                require=require,
+                json_db=json_db,
+                ipg_file=ipg_file,
+                query_sequence_order=query_sequence_order,
+                api_key=api_key,
+                ipg_cache=ipg_cache,
+                deduplicate_organisms=deduplicate_organisms,
+                cpus=cpus,
+            )
+        finally:
+            if hit_cache:
+                hit_cache.close()
+            if ipg_cache:
+                ipg_cache.close()
 
-        LOG.info("Found %i hits meeting score thresholds", len(results))
-        LOG.info("Fetching genomic context of hits")
-
-        query_sequence_order = list(session.sequences.keys()) \
-            if any(query_file.endswith(ext) for ext in (".gbk", ".gb", ".genbank", ".gbff", ".embl", ".emb"))\
-            else None
-        session.organisms = context.search(
-            results,
-            unique=unique,
-            min_hits=min_hits,
-            gap=gap,
-            require=require,
-            json_db=json_db,
-            ipg_file=ipg_file,
-            query_sequence_order=query_sequence_order
-        )
+        helpers.get_client().log_stats()
 
         if session_file:
             LOG.info("Writing current search session to %s", session_file[0])
             if len(session_file) > 1:
                 LOG.warning("Multiple session files specified, using first")
-            with open(session_file[0], "w") as fp:
-                session.to_json(fp, indent=indent)
+            session.to_file(session_file[0], indent=indent)
+            saved_file = session_file[0]
+        else:
+            saved_file = None
 
     if binary:
         LOG.info("Writing binary summary table to %s", binary)
@@ -261,6 +324,16 @@ def cblaster(
             decimals=binary_decimals,
         )
 
+    if binary_matrix:
+        LOG.info("Writing binary table matrix to %s", binary_matrix)
+        write_matrix(
+            session,
+            binary_matrix,
+            key=binary_key,
+            attr=binary_attr,
+            sparse=binary_sparse,
+        )
+
     LOG.info("Writing summary to %s", "stdout" if output == sys.stdout else output)
     results = session.format(
         "summary",
@@ -272,7 +345,7 @@ def cblaster(
 
     if plot:
         plot = None if plot is True else plot
-        plot_session(session, output=plot)
+        plot_session(session, output=plot, session_file=saved_file)
 
     LOG.info("Done.")
     return session
@@ -286,7 +359,14 @@ def main():
         LOG.setLevel(logging.DEBUG)
 
     if args.subcommand == "makedb":
-        makedb(args.genbanks, args.filename, args.indent)
+        makedb(
+            args.genbanks,
+            args.filename,
+            args.indent,
+            cpus=args.cpus,
+            append=args.append,
+            shards=args.shards,
+        )
 
     elif args.subcommand == "search":
         cblaster(
@@ -313,6 +393,8 @@ def main():
             binary_key=args.binary_key,
             binary_attr=args.binary_attr,
             binary_decimals=args.binary_decimals,
+            binary_matrix=args.binary_matrix,
+            binary_sparse=args.binary_sparse,
             rid=args.rid,
             session_file=args.session_file,
             indent=args.indent,
@@ -321,6 +403,15 @@ def main():
             blast_file=args.blast_file,
             ipg_file=args.ipg_file,
             hitlist_size=args.hitlist_size,
+            max_targets=args.max_targets,
+            api_key=args.api_key,
+            ncbi_url=args.ncbi_url,
+            ipg_cache=args.ipg_cache,
+            ipg_cache_age=args.ipg_cache_age,
+            cpus=args.cpus,
+            hit_cache=args.hit_cache,
+            hit_cache_age=args.hit_cache_age,
+            deduplicate_organisms=args.deduplicate_organisms,
         )
 
     elif args.subcommand == "gui":
@@ -20,7 +20,33 @@ def add_makedb_subparser(subparsers):
     makedb.add_argument(
         "filename",
         help="Name to use when building JSON/diamond databases (with extensions"
-        " .json and .dmnd, respectively)",
+        " .json and .dmnd, respectively). A database index is also written"
+        " (with extension .sqlite3)",
+    )
+    makedb.add_argument(
+        "-c",
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of CPUs to use when parsing genome files (def. 1)",
+    )
+    makedb.add_argument(
+        "-a",
+        "--append",
+        action="store_true",
+        help="Add genome files to an existing database. Only files that are new"
+        " or have changed since they were added are parsed, and existing proteins"
+        " keep their database indices",
+    )
+    makedb.add_argument(
+        "-sh",
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of shards to split the DIAMOND database into (def. 1). Each"
+        " shard is written to its own FASTA file and DIAMOND database (with"
+        " extensions .shardN.faa and .shardN.dmnd), and shards are searched"
+        " concurrently in local searches",
     )
 
 
@@ -112,6 +138,19 @@ def add_binary_arguments(group):
         help="Total decimal places to use when printing score values",
         default=4,
     )
+    group.add_argument(
+        "-bmx",
+        "--binary_matrix",
+        help="Write binary table cell values as a NumPy matrix (.npz) file, with"
+        " clusters as rows and queries as columns",
+    )
+    group.add_argument(
+        "-bsp",
+        "--binary_sparse",
+        action="store_true",
+        help="Write --binary_matrix as a sparse matrix, readable with"
+        " scipy.sparse.load_npz()",
+    )
 
 
 def add_output_group(search):
@@ -160,12 +199,25 @@ def add_searching_group(search):
         " DIAMOND database (if 'local' is passed to --mode) or a valid NCBI"
         " database name (def. nr)",
     )
+    group.add_argument(
+        "-c",
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of CPUs to use (def. 1). This is used in two ways: as the"
+        " number of DIAMOND threads in local searches (divided between shards when"
+        " searching a sharded database), and, in any search, as the number of"
+        " processes used to find clusters once the search has finished. Clusters are"
+        " only found in parallel in large searches (at least 50000 hit proteins),"
+        " and each process holds a copy of the organisms it is clustering",
+    )
     group.add_argument(
         "-jdb",
         "--json_db",
         help="Path to local JSON database created using cblaster makedb. If this"
         " argument is provided, genomic context will be fetched from this database"
-        " instead of through NCBI IPG.",
+        " instead of through NCBI IPG. If the database index (.sqlite3) created"
+        " alongside it exists, it is used instead of loading the JSON database.",
     )
     group.add_argument(
         "-eq",
@@ -186,7 +238,9 @@ def add_searching_group(search):
         "--session_file",
         nargs="*",
         help="Load session from JSON. If the specified file does not exist, "
-        "the results of the new search will be saved to this file.",
+        "the results of the new search will be saved to this file. Sessions saved"
+        " with the .cbs extension are written in a compressed binary format, which"
+        " is faster to load; either format is detected automatically when loading.",
     )
     group.add_argument(
         "-rcp",
@@ -197,7 +251,8 @@ def add_searching_group(search):
         help="Recompute previous search session using new thresholds. The filtered"
         " session will be written to the file specified by this argument. If this"
         " argument is specified with no value, the session will be filtered but"
-        " not saved (e.g. for plotting purposes).",
+        " not saved (e.g. for plotting purposes). Files with the .cbs extension"
+        " are written in the binary session format.",
     )
     group.add_argument(
         "-hs",
@@ -207,6 +262,66 @@ def add_searching_group(search):
         help="Maximum total hits to save in a BLAST search (def. 5000). Setting"
         " this value too low may result in missed hits/clusters."
     )
+    group.add_argument(
+        "-mt",
+        "--max_targets",
+        type=int,
+        default=25,
+        help="Maximum target sequences reported per query in local DIAMOND searches"
+        " (def. 25, as in DIAMOND; 0 for no limit). Setting this value too low may"
+        " result in missed hits/clusters.",
+    )
+    group.add_argument(
+        "-ak",
+        "--api_key",
+        help="NCBI API key. Raises the rate limit on IPG requests from 3 to 10"
+        " requests per second. This is only used if 'remote' is passed to --mode.",
+    )
+    group.add_argument(
+        "--ncbi_url",
+        help="Base URL to send NCBI BLAST and E-utilities requests to instead of the"
+        " NCBI, e.g. a local stand-in server (def. $CBLASTER_NCBI_URL if set)",
+    )
+    group.add_argument(
+        "--ipg_cache",
+        default=True,
+        help="Path to the IPG cache database. Genomic context retrieved from the NCBI"
+        " is saved here, and reused in later remote searches"
+        " (def. ~/.cache/cblaster/ipg.sqlite3)",
+    )
+    group.add_argument(
+        "--ipg_cache_age",
+        type=float,
+        default=30,
+        help="Maximum age (days) of entries in the IPG cache (def. 30)",
+    )
+    group.add_argument(
+        "--no_ipg_cache",
+        dest="ipg_cache",
+        action="store_false",
+        help="Do not use the IPG cache",
+    )
+    group.add_argument(
+        "--hit_cache",
+        default=True,
+        help="Path to the hit table cache database. Results of local DIAMOND"
+        " searches are saved here, and reused when the same queries are searched"
+        " against an unchanged database with the same thresholds, or with stricter"
+        " thresholds if the cached search had no target limit (--max_targets 0)"
+        " (def. ~/.cache/cblaster/hits.sqlite3)",
+    )
+    group.add_argument(
+        "--hit_cache_age",
+        type=float,
+        default=30,
+        help="Maximum age (days) of entries in the hit table cache (def. 30)",
+    )
+    group.add_argument(
+        "--no_hit_cache",
+        dest="hit_cache",
+        action="store_false",
+        help="Do not use the hit table cache",
+    )
 
 
 def add_clustering_group(search):
@@ -240,6 +355,14 @@ def add_clustering_group(search):
         nargs="+",
         help="Names of query sequences that must be represented in a hit cluster",
     )
+    group.add_argument(
+        "-do",
+        "--deduplicate_organisms",
+        action="store_true",
+        help="Remove clusters that are identical (i.e. every subject is of the same"
+        " IPG) to a cluster in another organism or strain, keeping only the first."
+        " By default, duplicate clusters are only removed within each organism",
+    )
 
 
 def add_filtering_group(search):
@@ -2,21 +2,40 @@ import http.server
 import socketserver
 import webbrowser
 import json
-import shutil
+import gzip
+import math
 import logging
+import os
 
 from functools import partial
 from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
 
+import numpy as np
 import scipy
 from scipy.cluster.hierarchy import linkage
+from scipy.cluster.vq import vq
 
 from cblaster.classes import Session
-from cblaster.helpers import get_project_root
+from cblaster.helpers import file_hash, get_project_root
 
 
 LOG = logging.getLogger(__name__)
 
+# Maximum number of distinct rows given to Ward linkage; above this, rows are
+# first grouped into LINKAGE_GROUPS by k-means (see generate_linkage_matrix())
+LINKAGE_LIMIT = 5000
+LINKAGE_GROUPS = 1000
+
+# Heatmap rows per page served by the plot server (see paginate())
+PAGE_SIZE = 100
+
+# Sessions with more clusters than this are better served than saved as HTML
+STATIC_LIMIT = 10000
+
+# Version of the plot data layout; cached plot data of other versions is ignored
+PAYLOAD_VERSION = 1
+
 
 def transform_linkage_matrix(matrix):
     """Converts SciPy linkage matrix to D3 hierarchical format."""
@@ -28,6 +47,9 @@ def transform_linkage_matrix(matrix):
     for index in range(total):
         hierarchy[index] = {"name": index}
 
+    if total == 1:
+        return hierarchy[0]
+
     for index, (one, two, distance, count) in enumerate(matrix):
         one = int(one)
         two = int(two)
@@ -41,14 +63,102 @@ def transform_linkage_matrix(matrix):
     return hierarchy[new]
 
 
-def generate_linkage_matrix(array):
-    """Generate a normalised linkage matrix from a given array."""
-    array = [
-        [cell["value"] for cell in cells]
-        for cells in array
-    ]
-    matrix = linkage(array, "ward")
-    matrix[:, 2] /= matrix[:, 2].max()
+def link_groups(groups, total):
+    """Links the members of each group together at distance 0.
+
+    Members are linked pairwise in rounds, so each group forms a balanced tree and
+    the hierarchy stays shallow however large the group.
+
+    Args:
+        groups (list): Lists of leaf indices.
+        total (int): Total number of leaves.
+    Returns:
+        Linkage matrix rows, and the (node, size) of the root of each group.
+    """
+    rows, roots = [], []
+    for members in groups:
+        nodes = [(member, 1) for member in members]
+        while len(nodes) > 1:
+            merged = []
+            for (one, one_size), (two, two_size) in zip(nodes[::2], nodes[1::2]):
+                merged.append((total + len(rows), one_size + two_size))
+                rows.append([one, two, 0.0, one_size + two_size])
+            if len(nodes) % 2:
+                merged.append(nodes[-1])
+            nodes = merged
+        roots.append(nodes[0])
+    return rows, roots
+
+
+def kmeans(array, k, iterations=5, seed=0):
+    """Groups rows of an array using k-means clustering.
+
+    Returns:
+        Centroids of non-empty groups, and the group index of each row.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = array[rng.choice(len(array), k, replace=False)]
+    for _ in range(iterations):
+        codes, _ = vq(array, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, codes, array)
+        sizes = np.bincount(codes, minlength=k)
+        filled = sizes > 0
+        centroids[filled] = sums[filled] / sizes[filled, None]
+    codes, _ = vq(array, centroids)
+    used, codes = np.unique(codes, return_inverse=True)
+    return centroids[used], codes
+
+
+def generate_linkage_matrix(array, limit=LINKAGE_LIMIT, groups=LINKAGE_GROUPS):
+    """Generate a normalised linkage matrix from a given array.
+
+    Identical rows are linked at distance 0, and Ward linkage is only run on the
+    distinct rows. If there are more than `limit` distinct rows, they are first
+    grouped by k-means clustering; group members are then treated as identical,
+    and Ward linkage is run on the group centroids. This keeps memory and time
+    bounded for sessions with many clusters, while producing a linkage matrix over
+    every row, i.e. the same hierarchy structure.
+
+    Args:
+        array (list): Heatmap cells of each cluster (see get_cell()).
+        limit (int): Maximum number of distinct rows to run Ward linkage on.
+        groups (int): Number of k-means groups, if there are more than `limit`.
+    Returns:
+        Linkage matrix, with distances normalised to [0, 1].
+    """
+    array = np.array(
+        [[cell["value"] for cell in cells] for cells in array], dtype=float
+    ).reshape(len(array), -1)
+    total = len(array)
+    # Distinct rows, in order of first appearance
+    points, first, codes = np.unique(
+        array, axis=0, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    points, codes = points[order], ranks[codes.reshape(-1)]
+    if len(points) > limit:
+        LOG.info("Grouping %i distinct clusters for linkage", len(points))
+        points, labels = kmeans(points, min(groups, limit))
+        codes = labels[codes]
+
+    # Link each group of rows, then link the groups with Ward linkage
+    order = np.argsort(codes, kind="stable")
+    members = np.split(order, np.cumsum(np.bincount(codes))[:-1])
+    rows, roots = link_groups([group.tolist() for group in members], total)
+    if len(roots) > 1:
+        offset = total + len(rows)
+        nodes = list(roots)
+        for one, two, distance, count in linkage(points, "ward"):
+            one, two = nodes[int(one)], nodes[int(two)]
+            rows.append([one[0], two[0], distance, one[1] + two[1]])
+            nodes.append((offset + len(nodes) - len(roots), one[1] + two[1]))
+
+    matrix = np.array(rows, dtype=float).reshape(-1, 4)
+    if len(matrix) and matrix[:, 2].max() > 0:
+        matrix[:, 2] /= matrix[:, 2].max()
     return matrix
 
 
@@ -160,22 +270,141 @@ def get_data(session):
     }
 
 
+def leaf_order(hierarchy):
+    """Lists the leaf names of a D3 hierarchy, in the order they are drawn."""
+    order, stack = [], [hierarchy]
+    while stack:
+        node = stack.pop()
+        if "children" in node:
+            stack.extend(reversed(node["children"]))
+        else:
+            order.append(node["name"])
+    return order
+
+
+def paginate(data, page_size=PAGE_SIZE):
+    """Splits heatmap data into a summary and pages of heatmap rows.
+
+    Pages follow the order of clusters in the dendrogram, so the rows in view can
+    be loaded together. The summary is the data without the matrix, plus the
+    cluster order and page size so that the page of any cluster can be found. It
+    also has the largest shared hit flag of any cell (see flag_duplicate_cells()),
+    so cell borders are coloured on the same scale whichever pages are loaded.
+
+    Args:
+        data (dict): Heatmap data (see get_data()).
+        page_size (int): Total rows (clusters) per page.
+    Returns:
+        Summary dict, and a list of pages, i.e. lists of matrix rows.
+    """
+    order = leaf_order(data["hierarchy"])
+    summary = {key: value for key, value in data.items() if key != "matrix"}
+    summary["order"] = order
+    summary["max_flag"] = max(
+        (cell["flag"] for row in data["matrix"] for cell in row), default=-1
+    )
+    summary["pages"] = {
+        "size": page_size,
+        "total": math.ceil(len(order) / page_size),
+    }
+    pages = [
+        [data["matrix"][cluster] for cluster in order[start : start + page_size]]
+        for start in range(0, len(order), page_size)
+    ]
+    return summary, pages
+
+
+def payload_path(path):
+    """Gets the path of the cached plot data of a session file."""
+    return f"{path}.plot.gz"
+
+
+def load_data(path, session=None):
+    """Gets the plot data of a session file, reusing cached data if possible.
+
+    Plot data is cached next to the session file (see payload_path()), keyed by
+    the SHA256 hash of the session file. If the session file has not changed since
+    the data was cached, it is read from the cache instead of being computed. As in
+    HitCache.checksum(), the session file is only rehashed if its size or
+    modification time differ from those stored with the cached data.
+
+    Args:
+        path (str): Path to session file
+        session (Session): The Session in the file, if already loaded
+    Returns:
+        Plot data dict (see get_data())
+    """
+    cache = payload_path(path)
+    stat = os.stat(path)
+    digest, data = None, None
+    try:
+        with gzip.open(cache, "rt") as handle:
+            payload = json.load(handle)
+        if payload["version"] == PAYLOAD_VERSION:
+            if payload["size"] == stat.st_size and payload["mtime"] == stat.st_mtime_ns:
+                LOG.info("Using cached plot data: %s", cache)
+                return payload["data"]
+            digest = file_hash(path)
+            if payload["hash"] == digest:
+                # Contents are unchanged, so only the stored size and time are updated
+                LOG.info("Using cached plot data: %s", cache)
+                data = payload["data"]
+    except (OSError, EOFError, KeyError, ValueError):
+        pass
+
+    if not digest:
+        digest = file_hash(path)
+    if data is None:
+        if not session:
+            session = Session.from_file(path)
+        data = get_data(session)
+    payload = {
+        "hash": digest,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "version": PAYLOAD_VERSION,
+        "data": data,
+    }
+    try:
+        with gzip.open(f"{cache}.tmp", "wt", compresslevel=6) as handle:
+            json.dump(payload, handle)
+        os.replace(f"{cache}.tmp", cache)
+        LOG.info("Cached plot data: %s", cache)
+    except OSError as error:
+        LOG.warning("Could not cache plot data: %s", error)
+    return data
+
+
 class CustomHandler(http.server.BaseHTTPRequestHandler):
-    """Handler for serving cblaster plots."""
+    """Handler for serving cblaster plots.
+
+    Besides the plot files, this serves:
+        /data.json: all plot data
+        /summary.json: heatmap data without the matrix (see paginate())
+        /matrix.json?page=N: one page of heatmap matrix rows
+    Responses are gzip compressed if the client accepts it.
+    """
 
-    def __init__(self, data, chart, *args, **kwargs):
+    def __init__(self, data, chart, *args, pages=None, **kwargs):
         self._data = data
         self._chart = chart
+        self._pages = pages
         self._dir = get_project_root() / "plot"
         super().__init__(*args, **kwargs)
 
-    def copy_file(self, source):
-        shutil.copyfileobj(source, self.wfile)
-
-    def send_headers(self, mime):
+    def send_payload(self, payload, mime):
+        """Sends a response body, gzip compressed if the client accepts it."""
         self.send_response(200)
         self.send_header("Content-Type", mime)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload, compresslevel=6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
         self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, data):
+        self.send_payload(json.dumps(data).encode(), "application/json")
 
     def log_message(self, format, *args):
         """Suppresses logging messages on every request."""
@@ -183,29 +412,46 @@ class CustomHandler(http.server.BaseHTTPRequestHandler):
 
     def do_GET(self):
         """Serves each component of the cblaster plot."""
-        if self.path == "/data.json":
-            self.send_headers("text/json")
-            self.wfile.write(json.dumps(self._data).encode())
+        url = urlsplit(self.path)
+        if url.path == "/data.json":
+            self.send_json(self._data)
+            return
+        if self._pages and url.path == "/summary.json":
+            self.send_json(self._pages[0])
+            return
+        if self._pages and url.path == "/matrix.json":
+            try:
+                page = int(parse_qs(url.query)["page"][0])
+                rows = self._pages[1][page]
+            except (KeyError, ValueError, IndexError):
+                self.send_error(404, "Invalid page")
+                return
+            self.send_json({"page": page, "matrix": rows})
             return
         path, mime = None, None
-        if self.path == "/":
+        if url.path == "/":
             if self._chart == "heatmap":
                 path, mime = self._dir / "cblaster.html", "text/html"
             elif self._chart == "gne":
                 path, mime = self._dir / "gne.html", "text/html"
-        elif self.path == "/index.css":
+        elif url.path == "/index.css":
             path, mime = self._dir / "index.css", "text/css"
-        elif self.path == "/d3.min.js":
+        elif url.path == "/d3.min.js":
             path, mime = self._dir / "d3.min.js", "text/javascript"
-        elif self.path == "/cblaster.js":
+        elif url.path == "/cblaster.js":
             path, mime = self._dir / "cblaster.js", "text/javascript"
-        elif self.path == "/gne.js":
+        elif url.path == "/gne.js":
             path, mime = self._dir / "gne.js", "text/javascript"
         if not path:
+            self.send_error(404)
             return
-        with path.open("rb") as fp:
-            self.send_headers(mime)
-            self.copy_file(fp)
+        self.send_payload(path.read_bytes(), mime)
+
+
+class PlotServer(socketserver.ThreadingTCPServer):
+    """Serves plot requests on separate threads, so pages load concurrently."""
+
+    daemon_threads = True
 
 
 def save_html(data, output, chart="heatmap"):
@@ -244,10 +490,11 @@ def save_html(data, output, chart="heatmap"):
 
 
 def serve_html(data, chart="heatmap"):
-    handler = partial(CustomHandler, data, chart)
+    pages = paginate(data) if chart == "heatmap" else None
+    handler = partial(CustomHandler, data, chart, pages=pages)
 
     # Instantiate a new server, bind to any open port
-    with socketserver.TCPServer(("localhost", 0), handler) as httpd:
+    with PlotServer(("localhost", 0), handler) as httpd:
 
         # Automatically open web browser to bound address
         address, port = httpd.server_address
@@ -262,9 +509,23 @@ def serve_html(data, chart="heatmap"):
             httpd.shutdown()
 
 
-def plot_session(session, output=None):
-    data = get_data(session)
+def plot_session(session, output=None, session_file=None):
+    """Plots a Session as a heatmap.
+
+    If the Session was loaded from or saved to session_file, its plot data is
+    cached next to it and reused while the file is unchanged (see load_data()).
+    """
+    if session_file:
+        data = load_data(session_file, session=session)
+    else:
+        data = get_data(session)
     if output:
+        if data["counts"]["clusters"] > STATIC_LIMIT:
+            LOG.warning(
+                "Saving %i clusters to HTML; omit the output file to view large"
+                " sessions with the plot server instead",
+                data["counts"]["clusters"],
+            )
         LOG.info(f"Saving cblaster plot HTML to: {output}")
         save_html(data, output)
         webbrowser.open(output)
@@ -282,6 +543,4 @@ def plot_gne(data, output=None):
 
 
 def plot_session_file(path, output=None):
-    with open(path) as fp:
-        session = Session.from_json(fp)
-    plot_session(session, output=output)
+    plot_session(None, output=output, session_file=path)
@@ -14,8 +14,9 @@ const constants = {
 }
 
 if (typeof data === 'undefined') {
-	// Load from HTTP server
-	const data = d3.json("data.json").then(data => plot(data));
+	// Load from HTTP server. The summary has everything but the heatmap matrix,
+	// whose rows are loaded in pages as they come into view.
+	d3.json("summary.json").then(summary => plot(summary, pageLoader(summary)));
 } else {
 	plot(data);
 }
@@ -144,6 +145,29 @@ function flattenArray(array) {
 	return array.reduce((flat, next) => flat.concat(next), []);
 }
 
+function pageLoader(summary) {
+	/* Creates a function to load heatmap rows from the plot server.
+	 * The server splits matrix rows into pages following the cluster order in
+	 * summary.order. The returned function takes a list of cluster IDs, requests
+	 * each page containing them that has not been requested before, and resolves
+	 * to the flattened cells of those pages.
+	 */
+	const pageOf = {}
+	summary.order.forEach((cluster, index) => {
+		pageOf[cluster] = Math.floor(index / summary.pages.size)
+	})
+	const requested = new Set()
+	return clusters => {
+		const pages = [...new Set(clusters.map(cluster => pageOf[cluster]))]
+			.filter(page => page !== undefined && !requested.has(page))
+		pages.forEach(page => requested.add(page))
+		return Promise.all(pages.map(page => d3.json(`matrix.json?page=${page}`)))
+			.then(responses => flattenArray(
+				responses.map(response => flattenArray(response.matrix))
+			))
+	}
+}
+
 function getTooltipHTML(d, data) {
 	/* Generates the HTML content for a cell hovering tooltip.
 	 * It provides the name of the query, as well as a table of each hit.
@@ -236,16 +260,25 @@ function getScaffoldString(data) {
 	return constants.cellHeight < 24 ? `    ${scaffold}` : scaffold
 }
 
-function plot(data) {
-	data.matrix = flattenArray(data.matrix);
+function plot(data, loadPage = null) {
+	/* Draws the cblaster heatmap.
+	 * If loadPage is given (see pageLoader), data.matrix starts empty and rows are
+	 * loaded as they are scrolled into view.
+	 */
+	data.matrix = data.matrix ? flattenArray(data.matrix) : [];
 
   const originalData = JSON.parse(JSON.stringify(data))
 
+	// Cells loaded from the plot server so far, and the data currently drawn
+	const loadedCells = []
+	let current = data
+
 	// Reset to the original data. Have to make a deep copy here, since update
 	// will mutate data
 	d3.select("#btn-reset-filters")
 		.on("click", () => {
 			const copy = JSON.parse(JSON.stringify(originalData))
+			copy.matrix = copy.matrix.concat(loadedCells)
 			update(copy)
 		});
 
@@ -259,10 +292,43 @@ function plot(data) {
 		.attr("xmlns", "http://www.w3.org/2000/svg");
 	const g = svg.append("g").attr("transform", "translate(2,0)");
 
+	// Vertical offset of the heatmap within <g>, set in update()
+	let heatmapOffset = 0
+
+	// Loads pages of rows currently in view, then redraws with the new cells.
+	// Only cells of queries and clusters that have not been filtered are drawn.
+	const loadVisible = () => {
+		if (!loadPage || y.domain().length === 0)
+			return
+		const transform = d3.zoomTransform(svg.node())
+		const height = svg.node().getBoundingClientRect().height
+		const top = -transform.y / transform.k - heatmapOffset
+		const bottom = (height - transform.y) / transform.k - heatmapOffset
+		const first = Math.max(0, Math.floor(top / y.step()))
+		const last = Math.max(first, Math.ceil(bottom / y.step()) + 1)
+		loadPage(y.domain().slice(first, last)).then(cells => {
+			if (cells.length === 0)
+				return
+			loadedCells.push(...cells)
+			current.matrix = current.matrix.concat(cells.filter(
+				cell => current.queries.includes(cell.query) && cell.cluster in current.labels
+			))
+			update(current)
+		})
+	}
+	let loadTimeout = null
+	const scheduleLoad = () => {
+		clearTimeout(loadTimeout)
+		loadTimeout = setTimeout(loadVisible, 100)
+	}
+
 	// Set up pan/zoom behaviour, and set default pan/zoom position
 	const zoom = d3.zoom()
 		.scaleExtent([0, 8])
-		.on("zoom", () => g.attr("transform", d3.event.transform))
+		.on("zoom", () => {
+			g.attr("transform", d3.event.transform)
+			scheduleLoad()
+		})
 		.on("start", () => svg.attr("cursor", "grabbing"))
 		.on("end", () => svg.attr("cursor", "grab"))
 	const transform = d3.zoomIdentity
@@ -359,6 +425,7 @@ function plot(data) {
 
 	function update(data) {
 		let t = d3.transition().duration(400)
+		current = data
 
 		// Update x-axis domain/range based on current query sequences.
 		x.domain(data.queries)
@@ -391,8 +458,9 @@ function plot(data) {
 		// corresponding query/cluster number.
 		const translate = (d) => `translate(${x(d.query)}, ${y(d.cluster)})`
 
-		// Generate the border colour scale for cells that contain shared hits
-		let groupMax = d3.max(data.matrix, d => d.flag)
+		// Generate the border colour scale for cells that contain shared hits. When
+		// rows are loaded in pages, the maximum over all pages is given by the server
+		let groupMax = ("max_flag" in data) ? data.max_flag : d3.max(data.matrix, d => d.flag)
 		let borderColors = d3.scaleSequential(d3.interpolateLab("orange", "red"))
 			.domain([0, groupMax])
 
@@ -636,7 +704,11 @@ function plot(data) {
 			const offset = d3.max([40, heatmapX.node().getBBox().height]);
 			heatmap.attr("transform", `translate(${constants.dendroWidth + 10}, ${offset})`)
 			dendro.attr("transform", `translate(0, ${offset})`);
+			heatmapOffset = offset
 		}, 0)
+
+		// Load any rows brought into view, e.g. by changing the cell height
+		scheduleLoad()
 	}
 
 	update(data)
@@ -73,6 +73,8 @@ def start(
         word_size (int): Size of word for initial matches
         comp_based_stats (int): Composition based statistics algorithm
         entrez_query (str): NCBI Entrez search term for pre-filtering the BLAST database
+    Raises:
+        requests.HTTPError: Received bad status code from NCBI.
     Returns:
         rid (str): Request Identifier (RID) assigned to the search
         rtoe (int): Request Time Of Execution (RTOE), estimated run time of the search
@@ -114,7 +116,15 @@ def start(
         # Does not apply to blastn
         parameters["THRESHOLD"] = threshold
 
-    response = requests.post(BLAST_API_URL, files={"QUERY": query}, params=parameters)
+    # Submissions are not retried once they may have reached the NCBI, since that
+    # could queue duplicate searches
+    response = helpers.get_client().post(
+        helpers.ncbi_url(BLAST_API_URL),
+        files={"QUERY": query},
+        params=parameters,
+        idempotent=False,
+    )
+    response.raise_for_status()
 
     LOG.debug("Search parameters: %s", parameters)
     LOG.debug("Search URL: %s", response.url)
@@ -140,7 +150,9 @@ def check(rid):
     """
     parameters = {"CMD": "Get", "RID": rid, "FORMAT_OBJECT": "SearchInfo"}
 
-    response = requests.get(BLAST_API_URL, params=parameters)
+    response = helpers.get_client().get(
+        helpers.ncbi_url(BLAST_API_URL), params=parameters
+    )
 
     LOG.debug(response.url)
 
@@ -182,7 +194,9 @@ def retrieve(rid, hitlist_size=5000):
 
     LOG.debug(parameters)
 
-    response = requests.get(BLAST_API_URL, params=parameters)
+    response = helpers.get_client().get(
+        helpers.ncbi_url(BLAST_API_URL), params=parameters
+    )
 
     LOG.debug(response.url)
 
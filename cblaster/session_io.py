@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+"""
+This module reads and writes cblaster sessions in a binary, compressed format.
+
+JSON sessions have to be parsed in full before any organism can be used. Binary
+sessions instead store each organism as a separately compressed chunk, so they can
+be written one organism at a time and read back lazily:
+
+>>> with SessionWriter("session.cbs", queries, sequences, params) as writer:
+...     for organism in organisms:
+...         writer.write(organism.to_dict())
+>>> with SessionReader("session.cbs") as reader:
+...     for organism in reader:
+...         ...
+
+The file layout is:
+
+    magic (8 bytes)
+    header chunk: {"queries": [...], "sequences": {...}, "params": {...}}
+    organism chunks, in session order
+    index chunk: {"organisms": [{"offset", "name", "strain", "scaffolds"}, ...]}
+    index offset (8 bytes)
+    magic (8 bytes)
+
+Every chunk is a zlib compressed JSON document, prefixed by its compressed size (8
+bytes). The index lists the offset, name, strain and scaffold accessions of every
+organism, so readers can find organisms without decompressing them. JSON remains
+the interchange format; see Session.from_file() and Session.to_file().
+
+JSON sessions written with write_json() get a sidecar index (session.json.index)
+holding the same information, plus the byte offsets of every organism and scaffold
+in the JSON file. open_indexed() returns a reader for either kind of indexed
+session, so a few organisms or scaffolds can be loaded without parsing the rest:
+
+>>> with open_indexed("session.json") as reader:
+...     for i, entry in enumerate(reader.index):
+...         if entry["name"].startswith("Aspergillus"):
+...             organism = reader.read_organism(i, accessions={"scaffold_1"})
+"""
+
+import json
+import logging
+import os
+import struct
+import zlib
+
+from pathlib import Path
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b"CBLSES\x00\x01"
+EXTENSION = ".cbs"
+SIZE = struct.Struct(">Q")
+
+
+def is_binary(path):
+    """Tests if a file is a binary session by its magic bytes."""
+    with open(path, "rb") as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def write_chunk(handle, data, level=6):
+    """Writes an object as a compressed JSON chunk, returning its offset."""
+    offset = handle.tell()
+    compressed = zlib.compress(json.dumps(data).encode(), level)
+    handle.write(SIZE.pack(len(compressed)))
+    handle.write(compressed)
+    return offset
+
+
+def read_chunk(handle, offset=None):
+    """Reads a compressed JSON chunk, either at an offset or the current position."""
+    if offset is not None:
+        handle.seek(offset)
+    (size,) = SIZE.unpack(handle.read(SIZE.size))
+    return json.loads(zlib.decompress(handle.read(size)))
+
+
+class SessionWriter:
+    """Writes a binary session file one organism at a time.
+
+    Attributes:
+        path (Path): Path to the session file.
+        level (int): zlib compression level.
+        index (list): Index entries of organisms written so far.
+    """
+
+    def __init__(self, path, queries=None, sequences=None, params=None, level=6):
+        self.path = Path(path)
+        self.level = level
+        self.index = []
+        self.handle = open(self.path, "wb")
+        self.handle.write(MAGIC)
+        write_chunk(
+            self.handle,
+            {
+                "queries": queries or [],
+                "sequences": sequences or {},
+                "params": params or {},
+            },
+            level,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, organism):
+        """Writes an organism, given as a dict (i.e. from Organism.to_dict())."""
+        offset = write_chunk(self.handle, organism, self.level)
+        self.index.append(
+            {
+                "offset": offset,
+                "name": organism["name"],
+                "strain": organism["strain"],
+                "scaffolds": [
+                    scaffold["accession"] for scaffold in organism["scaffolds"]
+                ],
+            }
+        )
+
+    def close(self):
+        """Writes the index and footer, then closes the file."""
+        if self.handle.closed:
+            return
+        offset = write_chunk(self.handle, {"organisms": self.index}, self.level)
+        self.handle.write(SIZE.pack(offset))
+        self.handle.write(MAGIC)
+        self.handle.close()
+
+
+class SessionReader:
+    """Reads a binary session file, decompressing organisms only when accessed.
+
+    Attributes:
+        path (Path): Path to the session file.
+        queries (list): Names of query sequences.
+        sequences (dict): Query sequences.
+        params (dict): Search parameters.
+        index (list): Index entries of every organism, i.e. dicts with offset,
+            name, strain and scaffolds keys.
+    Raises:
+        ValueError: File is not a complete binary session.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.handle = open(self.path, "rb")
+        if self.handle.read(len(MAGIC)) != MAGIC:
+            self.handle.close()
+            raise ValueError(f"{path} is not a binary cblaster session")
+        header = read_chunk(self.handle)
+        self.queries = header["queries"]
+        self.sequences = header["sequences"]
+        self.params = header["params"]
+
+        self.handle.seek(-(SIZE.size + len(MAGIC)), 2)
+        (offset,) = SIZE.unpack(self.handle.read(SIZE.size))
+        if self.handle.read(len(MAGIC)) != MAGIC:
+            self.handle.close()
+            raise ValueError(f"{path} is incomplete (missing index)")
+        self.index = read_chunk(self.handle, offset)["organisms"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for entry in self.index:
+            yield read_chunk(self.handle, entry["offset"])
+
+    def __getitem__(self, index):
+        return read_chunk(self.handle, self.index[index]["offset"])
+
+    def read_organism(self, index, accessions=None):
+        """Reads an organism, optionally keeping only the given scaffolds."""
+        organism = self[index]
+        if accessions is not None:
+            organism["scaffolds"] = [
+                scaffold
+                for scaffold in organism["scaffolds"]
+                if scaffold["accession"] in accessions
+            ]
+        return organism
+
+    def close(self):
+        self.handle.close()
+
+
+def index_path(path):
+    """Gets the path of the sidecar index of a JSON session file."""
+    return Path(f"{path}.index")
+
+
+def write_json(
+    path, queries=None, sequences=None, params=None, organisms=(), indent=None
+):
+    """Writes a JSON session file one organism at a time, with a sidecar index.
+
+    The JSON is identical to Session.to_json() when indent is None. With indent,
+    each organism and scaffold is indented separately, which is still valid JSON.
+    Byte offsets of every organism and scaffold are written to the sidecar index
+    (see index_path()), along with the file size and modification time so a stale
+    index is ignored.
+
+    Args:
+        path (str): Path to the session file.
+        queries (list): Names of query sequences.
+        sequences (dict): Query sequences.
+        params (dict): Search parameters.
+        organisms (iterable): Organisms, as dicts (i.e. from Organism.to_dict()).
+        indent (int): Total spaces to indent the JSON.
+    """
+    dumps = lambda value: json.dumps(value, indent=indent).encode()
+    index = []
+    with open(path, "wb") as handle:
+        handle.write(b'{"queries": ' + dumps(queries or []))
+        handle.write(b', "sequences": ' + dumps(sequences or {}))
+        handle.write(b', "params": ' + dumps(params or {}))
+        handle.write(b', "organisms": [')
+        for i, organism in enumerate(organisms):
+            if i > 0:
+                handle.write(b", ")
+            entry = {
+                "name": organism["name"],
+                "strain": organism["strain"],
+                "offset": handle.tell(),
+                "scaffolds": [],
+                "scaffold_offsets": [],
+            }
+            handle.write(b'{"name": ' + dumps(organism["name"]))
+            handle.write(b', "strain": ' + dumps(organism["strain"]))
+            handle.write(b', "scaffolds": [')
+            for j, scaffold in enumerate(organism["scaffolds"]):
+                if j > 0:
+                    handle.write(b", ")
+                text = dumps(scaffold)
+                entry["scaffolds"].append(scaffold["accession"])
+                entry["scaffold_offsets"].append([handle.tell(), len(text)])
+                handle.write(text)
+            handle.write(b"]}")
+            entry["length"] = handle.tell() - entry["offset"]
+            index.append(entry)
+        handle.write(b"]}")
+    stat = os.stat(path)
+    with open(index_path(path), "w") as handle:
+        json.dump(
+            {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "queries": queries or [],
+                "sequences": sequences or {},
+                "params": params or {},
+                "organisms": index,
+            },
+            handle,
+        )
+
+
+class JSONSessionReader:
+    """Reads organisms and scaffolds from a JSON session file using its index.
+
+    Attributes:
+        path (Path): Path to the session file.
+        queries (list): Names of query sequences.
+        sequences (dict): Query sequences.
+        params (dict): Search parameters.
+        index (list): Index entries of every organism (see write_json()).
+    Raises:
+        ValueError: The session has no index, or it is out of date.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(index_path(path)) as handle:
+                index = json.load(handle)
+        except FileNotFoundError:
+            raise ValueError(f"{path} has no index")
+        stat = os.stat(path)
+        if (index["size"], index["mtime"]) != (stat.st_size, stat.st_mtime_ns):
+            raise ValueError(f"Index of {path} is out of date")
+        self.queries = index["queries"]
+        self.sequences = index["sequences"]
+        self.params = index["params"]
+        self.index = index["organisms"]
+        self.handle = open(self.path, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read(self, offset, length):
+        self.handle.seek(offset)
+        return json.loads(self.handle.read(length))
+
+    def read_organism(self, index, accessions=None):
+        """Reads an organism, optionally reading only the given scaffolds."""
+        entry = self.index[index]
+        if accessions is None:
+            return self._read(entry["offset"], entry["length"])
+        return {
+            "name": entry["name"],
+            "strain": entry["strain"],
+            "scaffolds": [
+                self._read(offset, length)
+                for accession, (offset, length) in zip(
+                    entry["scaffolds"], entry["scaffold_offsets"]
+                )
+                if accession in accessions
+            ],
+        }
+
+    def close(self):
+        self.handle.close()
+
+
+def open_indexed(path):
+    """Opens a session file for random access to its organisms and scaffolds.
+
+    Returns:
+        A SessionReader for binary sessions, a JSONSessionReader for JSON sessions
+        with an up to date index, or None if the session has no usable index.
+    """
+    if is_binary(path):
+        return SessionReader(path)
+    try:
+        return JSONSessionReader(path)
+    except ValueError as error:
+        LOG.debug("Cannot use session index: %s", error)
+        return None
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Shared fixtures of the test suite
+"""
+
+import random
+
+import pytest
+
+from cblaster import classes
+
+
+def make_random_session(
+    seed,
+    organisms=3,
+    scaffolds=4,
+    subjects=30,
+    queries=("q1", "q2", "q3", "q4"),
+    max_queries=3,
+    weak=None,
+):
+    """Builds a random Session, reproducibly from seed.
+
+    Subjects are placed at increasing, sometimes overlapping, positions along each
+    scaffold, and are hit by 1 to max_queries queries. Hit scores are random, so
+    some hits fall below the default thresholds. If weak is given, hits instead
+    pass the default thresholds, except for a fraction (weak) with identity 10.
+    """
+    rng = random.Random(seed)
+    session = classes.Session(queries=list(queries))
+    for i in range(organisms):
+        organism = classes.Organism(f"org{i % 3}", rng.choice(["", f"strain {i}"]))
+        for j in range(scaffolds):
+            scaffold = classes.Scaffold(f"scaf{i}_{j}")
+            position = 0
+            for k in range(rng.randint(0, subjects)):
+                position += rng.randint(-500, 8000)
+                start = max(0, position)
+                name = f"s{i}_{j}_{k}"
+                hits = []
+                for query in rng.sample(session.queries, rng.randint(1, max_queries)):
+                    if weak is None:
+                        scores = (
+                            rng.uniform(20, 100),
+                            rng.uniform(40, 100),
+                            rng.choice([1e-50, 1e-10, 0.001, 0.1]),
+                            rng.uniform(50, 800),
+                        )
+                    else:
+                        scores = (10 if rng.random() < weak else 80, 90, 1e-10, 100)
+                    hits.append(classes.Hit(query, name, *scores))
+                scaffold.subjects.append(
+                    classes.Subject(
+                        hits=hits,
+                        name=name,
+                        ipg=rng.choice([None, "1", "2", "3"]),
+                        start=start,
+                        end=start + rng.randint(100, 3000),
+                        strand=rng.choice(["+", "-"]),
+                    )
+                )
+            organism.scaffolds[scaffold.accession] = scaffold
+        session.organisms.append(organism)
+    return session
+
+
+@pytest.fixture()
+def random_session():
+    """Factory of random Sessions (see make_random_session())."""
+    return make_random_session
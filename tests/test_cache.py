@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for cache.py
+"""
+
+import pytest
+
+from pathlib import Path
+
+import requests_mock
+
+from cblaster import cache, context, local
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+@pytest.fixture()
+def ipg_table():
+    with (TEST_DIR / "ipg_results.txt").open() as fp:
+        table = fp.read()
+    return table.split("\n")
+
+
+@pytest.fixture()
+def ipg_cache(tmp_path):
+    with cache.IPGCache(tmp_path / "ipg.sqlite3") as ipg_cache:
+        yield ipg_cache
+
+
+def test_get_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert cache.get_cache_dir() == tmp_path / "cblaster"
+
+
+def test_ipg_cache_lookup(ipg_cache, ipg_table):
+    ipg_cache.update(ipg_table)
+    rows, misses = ipg_cache.lookup(["s4", "s1", "missing"])
+    assert misses == ["missing"]
+    groups = context.parse_IP_groups(rows)
+    assert sorted(groups) == ["1", "4"]
+    assert groups == {
+        ipg: group
+        for ipg, group in context.parse_IP_groups(ipg_table).items()
+        if ipg in ("1", "4")
+    }
+
+
+def test_ipg_cache_evict(ipg_cache, ipg_table, mocker):
+    ipg_cache.update(ipg_table)
+    mocker.patch("time.time", return_value=10 ** 12)
+    ipg_cache.evict()
+    rows, misses = ipg_cache.lookup(["s1"])
+    assert rows == []
+    assert misses == ["s1"]
+
+
+def test_efetch_IPGs_cache(ipg_cache, ipg_table):
+    ipg_cache.update(row for row in ipg_table if not row.startswith("1\t"))
+    with requests_mock.Mocker() as mock:
+        mock.post(context.EFETCH_URL, text="1\tINSDC\tscaf\t1\t9\t+\ts1\tP\tOrg\tST\t\n")
+        rows = list(context.efetch_IPGs(["s1", "s2", "s5"], cache=ipg_cache))
+        assert mock.call_count == 1
+        assert mock.request_history[0].text == "id=s1"
+    groups = context.parse_IP_groups(rows)
+    assert sorted(groups) == ["1", "2", "4"]
+    assert ipg_cache.lookup(["s1"])[1] == []
+
+
+@pytest.fixture()
+def hit_cache(tmp_path):
+    with cache.HitCache(tmp_path / "hits.sqlite3") as hit_cache:
+        yield hit_cache
+
+
+def test_hit_cache_key(hit_cache, tmp_path, mocker):
+    database = tmp_path / "db.dmnd"
+    database.write_text("database")
+    key = hit_cache.key(">Q\nMAGIC\n", [str(tmp_path / "db")])
+    assert key == hit_cache.key(">Q\nMAGIC\n", [str(database)])
+    assert key != hit_cache.key(">Q\nMAGICAL\n", [str(database)])
+    assert hit_cache.key(">Q\nMAGIC\n", [str(tmp_path / "missing")]) is None
+
+    # Checksums are only recomputed when the file changes
+    spy = mocker.spy(cache, "file_hash")
+    hit_cache.key(">Q\nMAGIC\n", [str(database)])
+    spy.assert_not_called()
+    database.write_text("changed database")
+    assert hit_cache.key(">Q\nMAGIC\n", [str(database)]) != key
+    spy.assert_called_once()
+
+
+def test_hit_cache_lookup(hit_cache):
+    key = ("query", "database")
+    lookup = lambda **kwargs: (
+        None if (rows := hit_cache.lookup(key, **kwargs)) is None else list(rows)
+    )
+    assert lookup() is None
+    assert hit_cache.update(key, iter(["row1", "row2"]), min_identity=50) == 2
+    assert lookup(min_identity=50) == ["row1", "row2"]
+    assert lookup(min_identity=50, max_targets=10) is None
+    assert lookup(min_identity=90) is None
+    assert hit_cache.lookup(("query", "other"), min_identity=50) is None
+
+    # Tables without a target limit serve any stricter search
+    hit_cache.update(key, ["row1", "row2", "row3"], min_identity=50, max_targets=0)
+    assert lookup(min_identity=90, max_evalue=1e-10) == ["row1", "row2", "row3"]
+    assert lookup(min_identity=50, max_targets=10) == ["row1", "row2", "row3"]
+    assert lookup(min_identity=40, max_targets=0) is None
+    assert lookup(max_evalue=0.1, max_targets=0) is None
+
+    # Looser unlimited tables replace stricter ones
+    hit_cache.update(key, [], min_identity=30, max_targets=0)
+    assert lookup(min_identity=50) == []
+    count = hit_cache.connection.execute("SELECT COUNT(*) FROM hit_tables")
+    assert count.fetchone() == (1,)
+    count = hit_cache.connection.execute("SELECT COUNT(*) FROM hit_rows")
+    assert count.fetchone() == (0,)
+
+
+def test_search_hit_cache(hit_cache, tmp_path, mocker):
+    rows = [
+        "Q\tHIT1\t100.000\t100.000\t1.38e-127\t365",
+        "Q\tHIT2\t40.000\t100.000\t1.38e-127\t365",
+        "Q\tHIT3\t90.000\t100.000\t1.38e-127\t300",
+    ]
+    database = tmp_path / "db.dmnd"
+    database.write_text("database")
+    mocker.patch("cblaster.local.diamond", side_effect=lambda *a, **k: iter(rows))
+
+    hits = list(
+        local.search(
+            str(database), sequences={"Q": "MAGIC"}, cache=hit_cache, max_targets=0
+        )
+    )
+    assert [hit.subject for hit in hits] == ["HIT1", "HIT2", "HIT3"]
+    local.diamond.assert_called_once()
+
+    blast_file = tmp_path / "blast.tsv"
+    with blast_file.open("w") as handle:
+        hits = local.search(
+            str(database),
+            sequences={"Q": "MAGIC"},
+            min_identity=50,
+            cache=hit_cache,
+            blast_file=handle,
+            max_targets=1,
+        )
+        assert [hit.subject for hit in hits] == ["HIT1"]
+    assert blast_file.read_text() == rows[0] + "\n" + rows[2] + "\n"
+    local.diamond.assert_called_once()
+
+    # Searches with a target limit are only reused by the exact same search
+    sequences = {"Q": "MAGICAL"}
+    list(local.search(str(database), sequences=sequences, cache=hit_cache))
+    list(local.search(str(database), sequences=sequences, cache=hit_cache))
+    assert local.diamond.call_count == 2
+    list(
+        local.search(
+            str(database), sequences=sequences, min_identity=50, cache=hit_cache
+        )
+    )
+    assert local.diamond.call_count == 3
@@ -167,3 +167,62 @@ def test_organism_summary(organism, org_with_clusters):
     assert org_with_clusters.summary() == (
         "test_organism TEST 123\n======================\n" + SCAFFOLD_SUMMARY
     )
+
+
+def test_hit_copy():
+    hit = classes.Hit("q1", "s1", "70.90", "54.60", "0.0", "500.30")
+    copy = hit.copy(subject="s2")
+    assert copy.to_dict() == {**hit.to_dict(), "subject": "s2"}
+    assert not hasattr(copy, "__dict__")
+    with pytest.raises(AttributeError):
+        copy.start = 100
+
+
+def test_session_from_files_merge(tmp_path):
+    def make_session(queries, organisms):
+        session = classes.Session(queries=["q1", "q2"])
+        for name, accession, starts in organisms:
+            subjects = [
+                classes.Subject(
+                    hits=[
+                        classes.Hit(query, f"s{start}", 90, 90, 1e-10, 100)
+                        for query in queries
+                    ],
+                    name=f"s{start}",
+                    start=start,
+                    end=start + 900,
+                    strand="+",
+                )
+                for start in starts
+            ]
+            scaffold = classes.Scaffold(accession, subjects=subjects)
+            scaffold.add_cluster_indices([list(range(len(subjects)))])
+            organism = classes.Organism(name, "")
+            organism.scaffolds[accession] = scaffold
+            session.organisms.append(organism)
+        return session
+
+    one = make_session(["q1"], [("A", "scaf_a", [0, 1000]), ("B", "scaf_b", [0])])
+    two = make_session(["q2"], [("A", "scaf_a", [1000, 2000]), ("C", "scaf_c", [0])])
+    paths = [tmp_path / "one.json", tmp_path / "two.json"]
+    one.to_file(paths[0])
+    two.to_file(paths[1])
+
+    session = classes.Session.from_files(paths)
+    assert [o.name for o in session.organisms] == ["A", "B", "C"]
+    scaffold = session.organisms[0].scaffolds["scaf_a"]
+    assert [s.start for s in scaffold.subjects] == [0, 1000, 2000]
+    assert [h.query for h in scaffold.subjects[1].hits] == ["q1", "q2"]
+    assert sorted(c.indices for c in scaffold.clusters) == [[0, 1], [1, 2]]
+
+    recomputed = classes.Session.from_files(
+        paths,
+        recompute=dict(min_identity=0, min_coverage=0, max_evalue=1, unique=1),
+    )
+    scaffold = recomputed.organisms[0].scaffolds["scaf_a"]
+    assert [c.indices for c in scaffold.clusters] == [[0, 1, 2]]
+
+    other = classes.Session(queries=["q3"])
+    other.to_file(tmp_path / "other.json")
+    with pytest.raises(ValueError):
+        classes.Session.from_files(paths + [tmp_path / "other.json"])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for columnar.py
+"""
+
+import pytest
+
+from cblaster import classes, columnar, context
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_columnar_round_trip(seed, random_session):
+    session = random_session(seed, organisms=4, scaffolds=5, subjects=40)
+    for organism in session.organisms:
+        context.find_clusters_in_organism(organism, unique=2, min_hits=2)
+    columns = columnar.ColumnarSession.from_session(session)
+    assert columns.to_session().to_dict() == session.to_dict()
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(min_identity=0, min_coverage=0, max_evalue=1, unique=2, min_hits=2),
+        dict(min_identity=0, min_coverage=0, max_evalue=1, gap=5000, require=["q1"]),
+        dict(min_identity=0, min_coverage=0, max_evalue=1, deduplicate_organisms=True),
+        dict(min_identity=0, min_coverage=0, max_evalue=1, unique=1, min_hits=1),
+        # Sub-threshold hits leave subjects without hits inside candidate clusters
+        dict(min_identity=50, min_coverage=70, max_evalue=0.01, unique=2, min_hits=2),
+        dict(min_identity=60, min_coverage=50, max_evalue=1e-5, gap=5000, unique=1),
+    ],
+)
+def test_columnar_filter_matches_filter_session(seed, kwargs, random_session):
+    session = random_session(seed, organisms=4, scaffolds=5, subjects=40)
+    expected = classes.Session.from_dict(session.to_dict())
+    context.filter_session(expected, **kwargs)
+    filtered = columnar.ColumnarSession.from_session(session).filter(**kwargs)
+    assert filtered.to_session().to_dict() == expected.to_dict()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(unique=3, min_hits=2),
+        dict(unique=2, min_hits=2),
+        dict(unique=1, min_hits=1),
+        dict(unique=2, min_hits=1),
+        dict(unique=0, min_hits=2),
+        dict(unique=2, min_hits=2, require=["q4"]),
+    ],
+)
+def test_columnar_filter_matches_filter_session_hitless(kwargs):
+    # Multi-query subjects next to subjects left without hits by the identity
+    # threshold, on scaffolds with too few subjects with hits to be clustered
+    scaffolds = {
+        "scaf1": [(["q1", "q2"], 80), (["q3"], 10), (["q2", "q3"], 80), (["q1"], 10)],
+        "scaf2": [(["q1"], 10), (["q2", "q3"], 80), (["q4"], 10)],
+        "scaf3": [(["q1", "q2"], 80), (["q3", "q4"], 80), (["q2"], 10)],
+    }
+    organism = classes.Organism("org", "")
+    for accession, subjects in scaffolds.items():
+        scaffold = classes.Scaffold(accession)
+        for i, (queries, identity) in enumerate(subjects):
+            name = f"{accession}_{i}"
+            scaffold.subjects.append(
+                classes.Subject(
+                    hits=[
+                        classes.Hit(query, name, identity, 90, 1e-10, 100)
+                        for query in queries
+                    ],
+                    name=name,
+                    start=i * 1000,
+                    end=i * 1000 + 900,
+                    strand="+",
+                )
+            )
+        organism.scaffolds[accession] = scaffold
+    session = classes.Session(queries=["q1", "q2", "q3", "q4"], organisms=[organism])
+    kwargs = dict(min_identity=30, min_coverage=50, max_evalue=0.01, **kwargs)
+
+    expected = classes.Session.from_dict(session.to_dict())
+    context.filter_session(expected, **kwargs)
+    filtered = columnar.ColumnarSession.from_session(session).filter(**kwargs)
+    assert filtered.to_session().to_dict() == expected.to_dict()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_columnar_filter_thresholds(seed, random_session):
+    session = random_session(seed, organisms=4, scaffolds=5, subjects=40)
+    columns = columnar.ColumnarSession.from_session(session)
+    filtered = columns.filter(min_identity=50, min_coverage=70, max_evalue=0.01)
+    result = filtered.to_session()
+    for organism, original in zip(result.organisms, session.organisms):
+        for scaffold, other in zip(
+            organism.scaffolds.values(), original.scaffolds.values()
+        ):
+            for subject, reference in zip(scaffold.subjects, other.subjects):
+                assert subject.hits == [
+                    hit
+                    for hit in reference.hits
+                    if hit.identity > 50 and hit.coverage > 70 and hit.evalue < 0.01
+                ]
+            for cluster in scaffold.clusters:
+                assert all(scaffold.subjects[i].hits for i in cluster.indices)
+                assert cluster.indices == sorted(
+                    cluster.indices, key=lambda i: scaffold.subjects[i].start
+                )
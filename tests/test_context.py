@@ -91,6 +91,24 @@ def test_find_clusters(subjects_clustering, unique, gap, results):
     groups = list(context.find_clusters(subjects_clustering, unique=unique, gap=gap))
     for group, result in zip(groups, results):
         assert group == [subjects_clustering[i] for i in result]
+    indices = context.find_cluster_indices(subjects_clustering, unique=unique, gap=gap)
+    for group, result in zip(indices, results):
+        assert group == result
+
+
+def test_add_cluster_indices(random_session):
+    session = random_session(1)
+    for organism in session.organisms:
+        for scaffold in organism.scaffolds.values():
+            clusters = list(
+                context.find_cluster_indices(scaffold.subjects, unique=1, min_hits=1)
+            )
+            reference = classes.Scaffold(scaffold.accession, subjects=scaffold.subjects)
+            reference.add_clusters(
+                [[scaffold.subjects[i] for i in cluster] for cluster in clusters]
+            )
+            scaffold.add_cluster_indices(clusters)
+            assert scaffold.to_dict() == reference.to_dict()
 
 
 @pytest.mark.parametrize("unique, gap", [(-1, 100), (1, -1)])
@@ -132,6 +150,22 @@ def test_efetch_IPGs_output(hits, tmp_path):
         assert test_out.read_text() == "test"
 
 
+def test_efetch_IPGs_chunks(mocker):
+    mocker.patch("cblaster.helpers.RateLimiter.wait")
+
+    def callback(request, context):
+        ids = request.text[3:].split("%2C")
+        return f"{ids[0]}\t{len(ids)}\n"
+
+    ids = [f"id{i}" for i in range(25000)]
+    with requests_mock.Mocker() as mock:
+        mock.post(context.EFETCH_URL, text=callback)
+        rows = list(context.efetch_IPGs(ids, api_key="KEY", max_workers=3))
+        assert mock.call_count == 3
+        assert all("api_key=KEY" in r.url for r in mock.request_history)
+    assert rows == ["id0\t10000", "", "id10000\t10000", "", "id20000\t5000", ""]
+
+
 def test_parse_IPG_table(hits, subjects):
     results = TEST_DIR / "ipg_results.txt"
 
@@ -158,6 +192,29 @@ def test_parse_IPG_table(hits, subjects):
     assert two.scaffolds["scaffold_7"].subjects == [subjects[4]]
 
 
+def test_parse_IPG_table_shares_hits():
+    hits = [classes.Hit(q, "WP_1", "90", "90", "0", "100") for q in ("q1", "q2")]
+    rows = [
+        f"1\tRefSeq\tscaf_{i}\t1\t100\t+\tWP_1\tProt\tGenus species\tst{i}\t"
+        for i in range(3)
+    ]
+    organisms = context.parse_IPG_table(rows, hits)
+    subjects = [
+        subject
+        for organism in organisms
+        for scaffold in organism.scaffolds.values()
+        for subject in scaffold.subjects
+    ]
+    assert len(subjects) == 3
+    assert all(subject.hits == subjects[0].hits for subject in subjects)
+    assert all(
+        a is b for subject in subjects for a, b in zip(subject.hits, subjects[0].hits)
+    )
+    assert [hit.to_dict() for hit in subjects[0].hits] == [
+        hit.to_dict() for hit in hits
+    ]
+
+
 def test_parse_IP_groups(ipg_table):
     x = context.parse_IP_groups(ipg_table)
     assert len(x) == 4, "Expected 4 groups"
@@ -171,3 +228,190 @@ def test_parse_IP_groups(ipg_table):
 def test_find_IPG_hits(groups, hits, hit_dict, group, length):
     x = context.find_IPG_hits(groups[group], hit_dict)
     assert len(x) == length, "Hit group length mismatch"
+
+
+def test_query_local_DB_streams_hits():
+    from cblaster.database import Protein
+
+    class MockDatabase:
+        lookups = []
+
+        def lookup(self, i, j, k):
+            self.lookups.append((i, j, k))
+            identifier = f"P{k}" if k else None
+            return Protein(
+                f"org{i}", "", f"scaf{j}", identifier, k * 100, k * 100 + 90, "+"
+            )
+
+    database = MockDatabase()
+    consumed = []
+
+    def hits():
+        for query, header in [
+            ("q1", "0_0_1"),
+            ("q1", "0_1_2"),
+            ("q1", "malformed"),
+            ("q2", "0_0_1"),
+            ("q2", "1_0_0"),
+            ("q3", "0_0_1"),
+        ]:
+            # Proteins are looked up as hits arrive, not after the last hit
+            assert len(database.lookups) == len(set(consumed) - {"malformed"})
+            consumed.append(header)
+            yield classes.Hit(query, header, 90, 90, 1e-10, 100)
+
+    organisms = context.query_local_DB(hits(), database)
+    assert database.lookups == [(0, 0, 1), (0, 1, 2), (1, 0, 0)]
+    assert [organism.full_name for organism in organisms] == ["org0", "org1"]
+    scaffolds = organisms[0].scaffolds
+    assert [subject.name for subject in scaffolds["scaf0"].subjects] == ["P1"]
+    subject = scaffolds["scaf0"].subjects[0]
+    assert [(hit.query, hit.subject) for hit in subject.hits] == [
+        ("q1", "P1"), ("q2", "P1"), ("q3", "P1")
+    ]
+    assert [subject.name for subject in scaffolds["scaf1"].subjects] == ["P2"]
+    assert organisms[1].scaffolds["scaf0"].subjects == []
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_estimate_neighbourhood_matches_filter_session(seed, random_session):
+    session = random_session(seed)
+    results = context.estimate_neighbourhood(
+        classes.Session.from_dict(session.to_dict()), max_gap=20000, samples=25
+    )
+    for result in results:
+        context.filter_session(session, gap=result["gap"])
+        clusters, means, medians = context.calculate_gne(session)
+        assert result["clusters"] == clusters
+        assert result["means"] == means
+        assert result["medians"] == medians
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_estimate_neighbourhood_weak_hits(seed, random_session):
+    # Subjects with only sub-threshold hits sit inside candidate clusters, and must
+    # neither count towards clusters nor bridge gaps between other subjects
+    session = random_session(seed, subjects=40, weak=0.4)
+    results = context.estimate_neighbourhood(
+        classes.Session.from_dict(session.to_dict()), max_gap=20000, samples=25
+    )
+    assert any(result["clusters"] for result in results)
+    for result in results:
+        filtered = classes.Session.from_dict(session.to_dict())
+        context.filter_session(filtered, gap=result["gap"], unique=2, min_hits=2)
+        expected = context.sweep_neighbourhood(
+            session, [result["gap"]], unique=2, min_hits=2
+        )
+        assert expected == [context.calculate_gne(filtered)]
+        context.filter_session(filtered, gap=result["gap"])
+        clusters, means, medians = context.calculate_gne(filtered)
+        assert result["clusters"] == clusters
+        assert result["means"] == means
+        assert result["medians"] == medians
+        for organism in filtered.organisms:
+            for scaffold in organism.scaffolds.values():
+                for cluster in scaffold.clusters:
+                    assert all(scaffold.subjects[i].hits for i in cluster.indices)
+
+
+def test_filter_session_skips_subjects_without_hits():
+    session = classes.Session(queries=["q1", "q2", "q3"])
+    organism = classes.Organism("org", "")
+    scaffold = classes.Scaffold("scaf")
+    for k, (query, identity) in enumerate(
+        [("q1", 80), ("q2", 10), ("q2", 80), ("q3", 80)]
+    ):
+        scaffold.subjects.append(
+            classes.Subject(
+                hits=[classes.Hit(query, f"s{k}", identity, 90, 1e-10, 100)],
+                start=k * 15000,
+                end=k * 15000 + 1000,
+                strand="+",
+            )
+        )
+    organism.scaffolds["scaf"] = scaffold
+    session.organisms.append(organism)
+
+    # The sub-threshold subject would bridge s0 and s2 with a 20kb gap
+    context.filter_session(session, gap=20000, unique=2, min_hits=2)
+    assert [cluster.indices for cluster in scaffold.clusters] == [[2, 3]]
+    assert scaffold.subjects[1].hits == []
+
+
+def pairwise_deduplicate(organism):
+    """Reference implementation comparing every pair of clusters."""
+    from itertools import combinations, product
+    remove = []
+    for scafA, scafB in combinations(organism.scaffolds.values(), 2):
+        for one, two in product(scafA.clusters, scafB.clusters):
+            if context.clusters_are_identical(one, two):
+                remove.append(two)
+    for scaffold in organism.scaffolds.values():
+        scaffold.clusters = [c for c in scaffold.clusters if c not in remove]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_deduplicate_matches_pairwise(seed, random_session):
+    session = random_session(seed, scaffolds=8)
+    for organism in session.organisms:
+        context.find_clusters_in_organism(organism, unique=1, min_hits=1, remote=False)
+    expected = classes.Session.from_dict(session.to_dict())
+    for organism, reference in zip(session.organisms, expected.organisms):
+        context.deduplicate(organism)
+        pairwise_deduplicate(reference)
+        assert organism.to_dict() == reference.to_dict()
+
+
+def test_deduplicate_organisms(random_session):
+    session = random_session(0, organisms=2, scaffolds=2)
+    for scaffold in session.organisms[0].scaffolds.values():
+        for k, subject in enumerate(scaffold.subjects):
+            subject.ipg = str(k)
+    session.organisms[1].scaffolds = session.organisms[0].scaffolds
+    session = classes.Session.from_dict(session.to_dict())
+    one, two = session.organisms
+    for organism in session.organisms:
+        context.find_clusters_in_organism(organism, unique=1, min_hits=1, remote=False)
+    seen = set()
+    context.deduplicate(one, seen=seen)
+    context.deduplicate(two, seen=seen)
+    assert one.clusters
+    assert two.clusters == []
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_find_clusters_in_organisms_parallel(seed, monkeypatch, random_session):
+    monkeypatch.setattr(context, "POOL_MIN_SUBJECTS", 0)
+    session = random_session(seed, organisms=6)
+    expected = classes.Session.from_dict(session.to_dict())
+    subjects = [
+        subject
+        for organism in session.organisms
+        for scaffold in organism.scaffolds.values()
+        for subject in scaffold.subjects
+    ]
+    organisms = context.find_clusters_in_organisms(
+        session.organisms, cpus=2, unique=1, min_hits=1
+    )
+    for organism in expected.organisms:
+        context.find_clusters_in_organism(organism, unique=1, min_hits=1)
+    assert [o.to_dict() for o in organisms] == [o.to_dict() for o in expected.organisms]
+
+    # Clusters are added to the given organisms, using their own subjects
+    assert organisms == session.organisms
+    clustered = {
+        id(subject)
+        for organism in organisms
+        for scaffold in organism.scaffolds.values()
+        for cluster in scaffold.clusters
+        for subject in cluster.subjects
+    }
+    assert clustered and clustered <= {id(subject) for subject in subjects}
+
+
+def test_find_clusters_in_organisms_small(mocker, random_session):
+    pool = mocker.patch("cblaster.context.Pool")
+    session = random_session(0, organisms=6)
+    context.find_clusters_in_organisms(session.organisms, cpus=4, unique=1, min_hits=1)
+    pool.assert_not_called()
+    assert any(organism.clusters for organism in session.organisms)
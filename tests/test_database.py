@@ -2,6 +2,7 @@
 Test suite for database.py
 """
 
+import json
 import subprocess
 
 from pathlib import Path
@@ -22,4 +23,215 @@ def test_diamond_makedb(mocker):
         ["test_path", "makedb", "--in", "fasta", "--db", "name"],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
+        check=True,
     )
+
+
+def mock_diamond_makedb(mocker):
+    """Mocks diamond_makedb(), copying the FASTA file to the DIAMOND database."""
+    def makedb(fasta, name):
+        Path(f"{name}.dmnd").write_text(Path(fasta).read_text())
+
+    return mocker.patch("cblaster.database.diamond_makedb", side_effect=makedb)
+
+
+@pytest.fixture()
+def db():
+    from g2j import classes
+    features = [
+        classes.Feature(
+            "CDS",
+            qualifiers={"protein_id": f"PROT_{i}", "translation": "MAGIC"},
+            location=classes.Location(
+                intervals=[classes.Interval(i * 100, i * 100 + 90)],
+                strand="+" if i % 2 else "-",
+            ),
+        )
+        for i in range(3)
+    ]
+    features.append(classes.Feature("CDS", qualifiers={"locus_tag": "NOSEQ"}))
+    organism = classes.Organism(
+        "Organism",
+        "Strain",
+        scaffolds=[
+            classes.Scaffold("scaf_1", features=features[:2]),
+            classes.Scaffold("scaf_2", features=features[2:]),
+        ],
+    )
+    return database.Database([organism])
+
+
+def test_database_index_lookup(db, tmp_path):
+    path = tmp_path / "db.sqlite3"
+    db.to_index(path)
+    with database.load(tmp_path / "db.json") as index:
+        assert isinstance(index, database.DatabaseIndex)
+        for i, j, k in [(0, 0, 0), (0, 0, 1), (0, 1, 0)]:
+            assert index.lookup(i, j, k) == db.lookup(i, j, k)
+        assert index.lookup(0, 1, 0) == database.Protein(
+            "Organism", "Strain", "scaf_2", "PROT_2", 200, 290, "-"
+        )
+        with pytest.raises(KeyError):
+            index.lookup(0, 1, 1)
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+def test_parse_files(cpus, tmp_path):
+    gff = tmp_path / "skipped.txt"
+    gff.write_text("")
+    files = [TEST_DIR / "sample.gbk", gff, TEST_DIR / "sample.gbk"]
+    (file1, one), (file2, two) = database.parse_files(files, cpus=cpus)
+    assert file1 == file2 == files[0]
+    assert one.to_dict() == two.to_dict()
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+def test_makedb_streaming(cpus, tmp_path, mocker):
+    mock_diamond_makedb(mocker)
+    files = [TEST_DIR / "sample.gbk"] * 3
+    name = str(tmp_path / "db")
+    database.makedb(files, name, cpus=cpus)
+    database.diamond_makedb.assert_called_once_with(name + ".faa.tmp", name + ".tmp")
+    assert (tmp_path / "db.dmnd").read_text() == (tmp_path / "db.faa").read_text()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "db.dmnd", "db.faa", "db.json", "db.manifest.json", "db.sqlite3"
+    ]
+
+    db = database.Database.from_files(files)
+    with open(tmp_path / "expected.faa", "w") as fp:
+        db.write_fasta(fp)
+    assert (tmp_path / "db.faa").read_text() == (tmp_path / "expected.faa").read_text()
+    assert (tmp_path / "db.json").read_text() == json.dumps(db.to_list())
+    with database.load(name + ".json") as index:
+        assert index.lookup(2, 0, 1) == db.lookup(2, 0, 1)
+
+
+def test_makedb_append(tmp_path, mocker):
+    mock_diamond_makedb(mocker)
+    one, two, three = [tmp_path / f"{i}.gbk" for i in range(3)]
+    sample = (TEST_DIR / "sample.gbk").read_text()
+    for path in (one, two, three):
+        path.write_text(sample)
+    name = str(tmp_path / "db")
+
+    database.makedb([one, two], name)
+    two.write_text(sample.replace("TCP1-beta", "TCP1-alpha"))
+    database.makedb([one, two, three], name, append=True)
+
+    manifest = database.read_manifest(name)
+    assert manifest["organisms"] == 4
+    assert manifest["stale"] == [1]
+    assert [(e["path"], e["index"]) for e in manifest["files"]] == [
+        (str(one), 0),
+        (str(two), 2),
+        (str(three), 3),
+    ]
+
+    headers = [
+        line for line in (tmp_path / "db.faa").read_text().split("\n")
+        if line.startswith(">")
+    ]
+    assert sorted({h[1:].split("_")[0] for h in headers}) == ["0", "2", "3"]
+
+    db = database.Database.from_json(name + ".json")
+    assert len(db.organisms) == 4
+    assert db.organisms[1] is None
+    assert "TCP1-alpha" in json.dumps(db.organisms[2].to_dict())
+    with database.load(name + ".sqlite3") as index:
+        assert index.lookup(3, 0, 1) == db.lookup(3, 0, 1)
+        with pytest.raises(KeyError):
+            index.lookup(1, 0, 1)
+
+    database.diamond_makedb.reset_mock()
+    database.makedb([one, two, three], name, append=True)
+    database.diamond_makedb.assert_not_called()
+
+
+def test_makedb_shards(tmp_path, mocker):
+    mock_diamond_makedb(mocker)
+    files = [TEST_DIR / "sample.gbk"] * 5
+    name = str(tmp_path / "db")
+    database.makedb(files, name, shards=2)
+
+    manifest = database.read_manifest(name)
+    assert manifest["shards"] == [
+        {"shard": 0, "start": 0, "end": 3},
+        {"shard": 1, "start": 3, "end": 5},
+    ]
+    residues = sum(
+        len(line)
+        for shard in range(2)
+        for line in (tmp_path / f"db.shard{shard}.faa").read_text().split("\n")
+        if line and not line.startswith(">")
+    )
+    assert residues > 0
+    assert database.get_dbsize(name + ".dmnd") == residues
+    assert not (tmp_path / "db.faa").exists()
+    for shard, indices in [(0, {"0", "1", "2"}), (1, {"3", "4"})]:
+        headers = (tmp_path / f"db.shard{shard}.faa").read_text().split("\n")
+        assert {h[1:].split("_")[0] for h in headers if h.startswith(">")} == indices
+    assert sorted(c.args for c in database.diamond_makedb.call_args_list) == [
+        (f"{name}.shard0.faa.tmp", f"{name}.shard0.tmp"),
+        (f"{name}.shard1.faa.tmp", f"{name}.shard1.tmp"),
+    ]
+    assert database.get_shards(name + ".dmnd") == [
+        f"{name}.shard0.dmnd",
+        f"{name}.shard1.dmnd",
+    ]
+    assert database.get_shards(str(tmp_path / "other.dmnd")) == [
+        str(tmp_path / "other.dmnd")
+    ]
+
+    # Appending only builds new shards
+    extra = tmp_path / "extra.gbk"
+    extra.write_text((TEST_DIR / "sample.gbk").read_text())
+    database.diamond_makedb.reset_mock()
+    database.makedb(files + [extra], name, append=True)
+    database.diamond_makedb.assert_called_once_with(
+        f"{name}.shard2.faa.tmp", f"{name}.shard2.tmp"
+    )
+    assert database.read_manifest(name)["shards"][-1] == {
+        "shard": 2, "start": 5, "end": 6
+    }
+
+
+def test_makedb_append_failure(tmp_path, mocker):
+    mock_diamond_makedb(mocker)
+    one, two = tmp_path / "1.gbk", tmp_path / "2.gbk"
+    sample = (TEST_DIR / "sample.gbk").read_text()
+    one.write_text(sample)
+    name = str(tmp_path / "db")
+    database.makedb([one], name)
+    files = {path.name: path.read_bytes() for path in tmp_path.glob("db.*")}
+
+    # Changed and new files are parsed, then DIAMOND fails
+    one.write_text(sample.replace("TCP1-beta", "TCP1-alpha"))
+    two.write_text(sample)
+    database.diamond_makedb.side_effect = subprocess.CalledProcessError(1, "diamond")
+    with pytest.raises(subprocess.CalledProcessError):
+        database.makedb([one, two], name, append=True)
+    assert {path.name: path.read_bytes() for path in tmp_path.glob("db.*")} == files
+
+    # Malformed genome files fail before DIAMOND
+    mocker.patch("cblaster.database.parse_file", side_effect=ValueError("malformed"))
+    with pytest.raises(ValueError):
+        database.makedb([one, two], name, append=True)
+    assert {path.name: path.read_bytes() for path in tmp_path.glob("db.*")} == files
+
+
+def test_makedb_append_without_manifest(tmp_path):
+    with pytest.raises(FileNotFoundError, match="rebuilt"):
+        database.makedb([], str(tmp_path / "db"), append=True)
+
+
+def test_iter_json_array(tmp_path):
+    path = tmp_path / "array.json"
+    values = [{"name": "a" * 100, "list": [1, 2, {"x": "]"}]}, None, {"b": ", ["}]
+    path.write_text(json.dumps(values, indent=2))
+    texts = list(database.iter_json_array(path, chunk_size=7))
+    assert [json.loads(text) for text in texts] == values
+    path.write_text("[]")
+    assert list(database.iter_json_array(path)) == []
+    path.write_text('[{"a": 1}, {"b"')
+    with pytest.raises(ValueError):
+        list(database.iter_json_array(path))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for formatters.py
+"""
+
+import io
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from cblaster import classes, context, formatters
+
+
+@pytest.fixture()
+def session(random_session):
+    session = random_session(
+        0, organisms=4, scaffolds=3, subjects=12, queries=["q1", "query_2", "q3"]
+    )
+    for organism in session.organisms:
+        context.find_clusters_in_organism(organism, unique=1, min_hits=1)
+    return session
+
+
+@pytest.mark.parametrize("hide_headers", [True, False])
+@pytest.mark.parametrize("delimiter", [None, ","])
+def test_write_summary(session, hide_headers, delimiter):
+    handle = io.StringIO()
+    formatters.write_summary(
+        session, handle, hide_headers=hide_headers, delimiter=delimiter
+    )
+    expected = formatters.summary(
+        session, hide_headers=hide_headers, delimiter=delimiter
+    )
+    assert handle.getvalue() == expected + "\n"
+
+
+@pytest.mark.parametrize("hide_headers", [True, False])
+@pytest.mark.parametrize("delimiter", [None, ","])
+@pytest.mark.parametrize(
+    "key, attr", [(len, "identity"), (sum, "identity"), (sum, "bitscore")]
+)
+def test_write_binary(session, hide_headers, delimiter, key, attr):
+    handle = io.StringIO()
+    kwargs = dict(hide_headers=hide_headers, delimiter=delimiter, key=key, attr=attr)
+    formatters.write_binary(session, handle, **kwargs)
+    text = handle.getvalue()
+
+    clusters = [c for o in session.organisms for c in o.clusters]
+    rows = [
+        [
+            formatters.set_decimals(value)
+            for value in formatters.get_cell_values(
+                session.queries, cluster.subjects, key=key, attr=attr
+            )
+        ]
+        for cluster in clusters
+    ]
+    lines = text.splitlines()[0 if hide_headers else 1:]
+    assert len(lines) == len(clusters)
+    if delimiter:
+        assert [line.split(",")[4:] for line in lines] == rows
+    else:
+        assert [line.split()[-3:] for line in lines] == rows
+        assert len({len(line) for line in lines}) == 1
+
+
+@pytest.fixture()
+def small_session():
+    session = classes.Session(queries=["q1", "query_2", "q3"])
+    organisms = [
+        (
+            "Streptomyces sp.",
+            "CNB091",
+            {
+                "NZ_1": [
+                    (0, 900, [("q1", 98.5, 812.25), ("q3", 31.2, 90.0)]),
+                    (1200, 2400, [("query_2", 100.0, 1050.5)]),
+                ],
+                "NZ_22": [
+                    (150000, 151000, [("q3", 45.0, 201.0), ("q3", 7.25, 60.125)]),
+                ],
+            },
+        ),
+        (
+            "Aspergillus niger",
+            "",
+            {
+                "contig_3": [
+                    (5, 80, [("q1", 60.0, 120.0)]),
+                    (90, 100, [("q1", 70.5, 80.0), ("query_2", 55.0, 99.9)]),
+                ],
+            },
+        ),
+    ]
+    for name, strain, scaffolds in organisms:
+        organism = classes.Organism(name, strain)
+        for accession, subjects in scaffolds.items():
+            scaffold = classes.Scaffold(accession)
+            for start, end, hits in subjects:
+                subject = f"{accession}_{start}"
+                scaffold.subjects.append(
+                    classes.Subject(
+                        hits=[
+                            classes.Hit(query, subject, identity, 90.0, 1e-10, score)
+                            for query, identity, score in hits
+                        ],
+                        name=subject,
+                        start=start,
+                        end=end,
+                        strand="+",
+                    )
+                )
+            scaffold.add_clusters([scaffold.subjects])
+            organism.scaffolds[accession] = scaffold
+        session.organisms.append(organism)
+    return session
+
+
+# Expected output of the humanise()-based binary() preceding write_binary()
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        (
+            dict(),
+            [
+                "Organism                 Scaffold  Start   End     q1  query_2  q3",
+                "Streptomyces sp. CNB091  NZ_1      0       2400    1   1        1 ",
+                "Streptomyces sp. CNB091  NZ_22     150000  151000  0   0        2 ",
+                "Aspergillus niger        contig_3  5       100     2   1        0 ",
+            ],
+        ),
+        (
+            dict(key=sum, attr="identity"),
+            [
+                "Organism                 Scaffold  Start   End     q1        query_2"
+                "   q3     ",
+                "Streptomyces sp. CNB091  NZ_1      0       2400    98.5000   100.0000"
+                "  31.2000",
+                "Streptomyces sp. CNB091  NZ_22     150000  151000  0         0       "
+                "  52.2500",
+                "Aspergillus niger        contig_3  5       100     130.5000  55.0000 "
+                "  0      ",
+            ],
+        ),
+        (
+            dict(hide_headers=True, delimiter=",", key=sum, attr="bitscore"),
+            [
+                "Streptomyces sp. CNB091,NZ_1,0,2400,812.2500,1050.5000,90.0000",
+                "Streptomyces sp. CNB091,NZ_22,150000,151000,0,0,261.1250",
+                "Aspergillus niger,contig_3,5,100,200.0000,99.9000,0",
+            ],
+        ),
+    ],
+)
+def test_write_binary_output(small_session, kwargs, expected):
+    handle = io.StringIO()
+    formatters.write_binary(small_session, handle, **kwargs)
+    assert handle.getvalue() == "\n".join(expected) + "\n"
+    assert formatters.binary(small_session, **kwargs) == "\n".join(expected)
+
+
+@pytest.mark.parametrize("delimiter", [None, ","])
+@pytest.mark.parametrize("key, attr", [(len, "identity"), (sum, "bitscore")])
+def test_write_binary_blocks(session, monkeypatch, delimiter, key, attr):
+    handle = io.StringIO()
+    formatters.write_binary(session, handle, delimiter=delimiter, key=key, attr=attr)
+    monkeypatch.setattr(formatters, "BINARY_BLOCK_ROWS", 2)
+    blocks = io.StringIO()
+    formatters.write_binary(session, blocks, delimiter=delimiter, key=key, attr=attr)
+    assert blocks.getvalue() == handle.getvalue()
+
+
+@pytest.mark.parametrize("key", [len, max, sum, lambda values: len(set(values))])
+@pytest.mark.parametrize("attr", ["identity", "bitscore"])
+def test_binary_matrix(session, key, attr):
+    clusters = [c for o in session.organisms for c in o.clusters]
+    matrix = formatters.binary_matrix(session.queries, clusters, key=key, attr=attr)
+    assert matrix.shape == (len(clusters), 3)
+    for row, cluster in zip(matrix.tolist(), clusters):
+        subjects = cluster.subjects
+        buckets = [
+            [getattr(h, attr) for s in subjects for h in s.hits if h.query == query]
+            for query in session.queries
+        ]
+        expected = [key(bucket) if bucket else 0 for bucket in buckets]
+        assert row == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_write_matrix(session, tmp_path, sparse):
+    path = tmp_path / "matrix.npz"
+    formatters.write_matrix(session, path, key=max, sparse=sparse)
+    clusters = [c for o in session.organisms for c in o.clusters]
+    expected = formatters.binary_matrix(session.queries, clusters, key=max)
+    with np.load(path) as data:
+        assert list(data["queries"]) == session.queries
+        assert len(data["organisms"]) == len(clusters)
+        assert list(data["starts"]) == [c.start for c in clusters]
+        if sparse:
+            matrix = scipy.sparse.load_npz(path).toarray()
+        else:
+            matrix = data["matrix"]
+    assert np.array_equal(matrix, expected)
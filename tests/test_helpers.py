@@ -89,3 +89,90 @@ def test_get_program_path(monkeypatch):
     monkeypatch.setattr(shutil, "which", return_path)
 
     assert helpers.get_program_path(["alias"]) == "test_path"
+
+
+def test_rate_limiter(mocker):
+    mocker.patch("time.monotonic", return_value=100)
+    sleep = mocker.patch("time.sleep")
+    limiter = helpers.RateLimiter(4)
+    limiter.wait()
+    limiter.wait()
+    limiter.wait()
+    assert [c.args[0] for c in sleep.call_args_list] == [0.25, 0.5]
+
+
+def test_ncbi_url(monkeypatch):
+    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?"
+    monkeypatch.setattr(helpers, "NCBI_URL", None)
+    assert helpers.ncbi_url(url) == url
+
+    helpers.set_ncbi_url("http://localhost:8000/")
+    assert helpers.ncbi_url(url) == "http://localhost:8000/entrez/eutils/efetch.fcgi"
+    assert helpers.ncbi_url("https://blast.ncbi.nlm.nih.gov/Blast.cgi?CMD=Get") == (
+        "http://localhost:8000/Blast.cgi?CMD=Get"
+    )
+    with requests_mock.Mocker() as mock:
+        mock.post("http://localhost:8000/entrez/eutils/efetch.fcgi", text=">seq\nMAG")
+        assert helpers.efetch_sequences(["seq"]) == {"seq": "MAG"}
+
+
+def test_http_client_retries(mocker):
+    sleep = mocker.patch("cblaster.helpers.time.sleep")
+    client = helpers.HTTPClient(retries=3, backoff=1, max_backoff=10)
+    url = "https://blast.ncbi.nlm.nih.gov/Blast.cgi"
+    with requests_mock.Mocker() as mock:
+        mock.get(
+            url,
+            [
+                {"status_code": 429, "headers": {"Retry-After": "2"}},
+                {"status_code": 503},
+                {"status_code": 200, "text": "done"},
+            ],
+        )
+        assert client.get(url).text == "done"
+        assert mock.call_count == 3
+
+    assert sleep.call_args_list[0] == mocker.call(2.0)
+    assert 0 <= sleep.call_args_list[1].args[0] <= 2
+    stats = client.stats()["/Blast.cgi"]
+    assert (stats["requests"], stats["retries"], stats["failures"]) == (3, 2, 2)
+
+
+def test_http_client_rate_limits_retries(mocker):
+    mocker.patch("cblaster.helpers.time.sleep")
+    limiter = mocker.Mock(spec=helpers.RateLimiter)
+    client = helpers.HTTPClient(retries=3)
+    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+    with requests_mock.Mocker() as mock:
+        mock.post(
+            url,
+            [{"status_code": 429}, {"status_code": 503}, {"status_code": 200}],
+        )
+        assert client.post(url, limiter=limiter).status_code == 200
+        assert mock.call_count == 3
+    assert limiter.wait.call_count == 3
+
+
+def test_http_client_gives_up(mocker):
+    mocker.patch("cblaster.helpers.time.sleep")
+    client = helpers.HTTPClient(retries=2)
+    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+    with requests_mock.Mocker() as mock:
+        mock.post(url, status_code=500)
+        assert client.post(url).status_code == 500
+        assert mock.call_count == 3
+
+        mock.post(url, exc=requests.ConnectionError)
+        with pytest.raises(requests.ConnectionError):
+            client.post(url)
+
+
+def test_http_client_delay():
+    client = helpers.HTTPClient(backoff=1, max_backoff=5)
+    for attempt in range(6):
+        assert 0 <= client.delay(attempt) <= min(5, 2 ** attempt)
+    response = requests.Response()
+    response.headers["Retry-After"] = "100"
+    assert client.delay(0, response) == 5
+    response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert client.delay(0, response) == 0
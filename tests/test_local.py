@@ -5,12 +5,14 @@ Test suite for local.py
 """
 
 
+import random
 import subprocess
 import pytest
 
 from pathlib import Path
 
 from cblaster import local, helpers
+from cblaster.classes import Hit
 
 
 TEST_DIR = Path(__file__).resolve().parent
@@ -45,10 +47,12 @@ def test_parse_no_hits():
 
 
 def test_diamond(monkeypatch):
+    popen = subprocess.Popen
+
     def mock_path(aliases):
         return "diamond"
 
-    def mock_run(command, **kwargs):
+    def mock_popen(command, **kwargs):
         assert command == [
             "diamond",
             "blastp",
@@ -74,15 +78,157 @@ def test_diamond(monkeypatch):
             "50",
             "--max-hsps",
             "1",
+            "--max-target-seqs",
+            "25",
         ]
-        return subprocess.CompletedProcess(
-            args=command, stdout=b"line1\nline2\nline3", returncode=1
-        )
+        return popen(["printf", "line1\\nline2\\nline3"], **kwargs)
 
     monkeypatch.setattr(helpers, "get_program_path", mock_path)
-    monkeypatch.setattr(subprocess, "run", mock_run)
+    monkeypatch.setattr(local.subprocess, "Popen", mock_popen)
+
+    assert list(local.diamond("fasta", "database")) == ["line1", "line2", "line3"]
+
+
+def test_diamond_error(monkeypatch):
+    monkeypatch.setattr(helpers, "form_command", lambda parameters: ["false"])
+    monkeypatch.setattr(helpers, "get_program_path", lambda aliases: "diamond")
+    with pytest.raises(subprocess.CalledProcessError):
+        list(local.diamond("fasta", "database"))
+
+
+def test_search_streams_rows(mocker, tmp_path):
+    rows = [
+        "QBE85648.1\tHIT1\t100.000\t100.000\t1.38e-127\t365",
+        "QBE85648.1\tHIT2\t20.000\t100.000\t1.38e-127\t365",
+    ]
+    mocker.patch("cblaster.local.diamond", return_value=iter(rows))
+    blast_file = tmp_path / "blast.tsv"
+    with blast_file.open("w") as handle:
+        hits = local.search("database", sequences={"QBE85648.1": "MAGIC"}, blast_file=handle)
+        assert [hit.subject for hit in hits] == ["HIT1"]
+    assert blast_file.read_text() == "\n".join(rows) + "\n"
+
+
+def test_search_yields_hits_during_search(mocker):
+    produced = []
 
-    assert local.diamond("fasta", "database") == ["line1", "line2", "line3"]
+    def mock_diamond(*args, **kwargs):
+        for i in range(3):
+            produced.append(i)
+            yield f"Q\tHIT{i}\t100.000\t100.000\t1.38e-127\t365"
+
+    mocker.patch("cblaster.local.diamond", side_effect=mock_diamond)
+    hits = local.search("database", sequences={"Q": "MAGIC"})
+    assert next(hits).subject == "HIT0"
+    assert produced == [0]
+    assert [hit.subject for hit in hits] == ["HIT1", "HIT2"]
+
+
+def test_search_no_hits(mocker):
+    mocker.patch("cblaster.local.diamond", return_value=iter([]))
+    hits = local.search("database", sequences={"Q": "MAGIC"})
+    with pytest.raises(SystemExit):
+        list(hits)
+
+
+def test_limit_targets():
+    hits = [
+        Hit("Q1", "A", 90, 90, 1e-10, 100),
+        Hit("Q1", "B", 90, 90, 1e-10, 300),
+        Hit("Q1", "C", 90, 90, 1e-10, 200),
+        Hit("Q2", "A", 90, 90, 1e-10, 50),
+        Hit("Q1", "D", 90, 90, 1e-10, 400),
+    ]
+    grouped = local.group_queries(hits)
+    assert [(h.query, h.subject) for h in grouped] == [
+        ("Q1", "A"), ("Q1", "B"), ("Q1", "C"), ("Q1", "D"), ("Q2", "A")
+    ]
+    limited = local.limit_targets(grouped, max_targets=2)
+    assert [(h.query, h.subject) for h in limited] == [
+        ("Q1", "B"), ("Q1", "D"), ("Q2", "A")
+    ]
+    assert list(local.limit_targets(hits, max_targets=0)) == hits
+
+
+def test_search_shards(mocker, tmp_path):
+    tables = {
+        "db.shard0.dmnd": ["Q\tHIT1\t100.000\t100.000\t1.38e-127\t365"],
+        "db.shard1.dmnd": ["Q\tHIT2\t100.000\t100.000\t1.38e-127\t365"],
+    }
+    mocker.patch("cblaster.local.get_shards", return_value=list(tables))
+    mocker.patch(
+        "cblaster.local.diamond",
+        side_effect=lambda query, shard, **kwargs: iter(tables[shard]),
+    )
+    blast_file = tmp_path / "blast.tsv"
+    with blast_file.open("w") as handle:
+        hits = local.search(
+            "db.dmnd", sequences={"Q": "MAGIC"}, blast_file=handle, cpus=4
+        )
+        assert [hit.subject for hit in hits] == ["HIT1", "HIT2"]
+    assert sorted(blast_file.read_text().split("\n")[:-1]) == [
+        tables["db.shard0.dmnd"][0],
+        tables["db.shard1.dmnd"][0],
+    ]
+    assert all(c.kwargs["cpus"] == 2 for c in local.diamond.call_args_list)
+
+
+@pytest.mark.parametrize("max_targets", [0, 10, 25])
+def test_search_shards_match_unsharded(mocker, max_targets):
+    rng = random.Random(0)
+    # Residues and bitscore of each target
+    targets = {
+        f"HIT{i}": (rng.randint(100, 1000), rng.uniform(20, 60)) for i in range(100)
+    }
+    names = list(targets)
+    databases = {
+        "db.dmnd": ["db.dmnd"],
+        "sharded.dmnd": ["sharded.shard0.dmnd", "sharded.shard1.dmnd"],
+    }
+    contents = {
+        "db.dmnd": names,
+        "sharded.shard0.dmnd": names[:50],
+        "sharded.shard1.dmnd": names[50:],
+    }
+    total = sum(residues for residues, _ in targets.values())
+
+    def mock_diamond(
+        query, shard, max_evalue=0.01, max_targets=25, dbsize=None, **kwargs
+    ):
+        # E-values depend on the database size, as in DIAMOND
+        size = dbsize or sum(targets[name][0] for name in contents[shard])
+        rows = []
+        for name in contents[shard]:
+            bitscore = targets[name][1]
+            evalue = 100 * size * 2 ** -bitscore
+            if evalue <= max_evalue:
+                row = f"Q\t{name}\t100\t100\t{evalue:.4g}\t{bitscore}"
+                rows.append((bitscore, row))
+        rows.sort(reverse=True)
+        return iter([row for _, row in rows[: max_targets or None]])
+
+    mocker.patch("cblaster.local.diamond", side_effect=mock_diamond)
+    mocker.patch("cblaster.local.get_shards", side_effect=databases.get)
+    mocker.patch(
+        "cblaster.local.get_dbsize",
+        side_effect=lambda database: total if database == "sharded.dmnd" else None,
+    )
+    results = [
+        sorted(
+            (hit.subject, hit.evalue)
+            for hit in local.search(
+                database, sequences={"Q": "MAGIC"}, max_targets=max_targets, cpus=2
+            )
+        )
+        for database in databases
+    ]
+    assert results[0] == results[1]
+    assert len(results[0]) == max_targets or max_targets == 0
+    assert all(
+        c.kwargs["dbsize"] == total
+        for c in local.diamond.call_args_list
+        if "shard" in c.args[1]
+    )
 
 
 def test_search_ids(monkeypatch):
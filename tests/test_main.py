@@ -95,3 +95,22 @@ def test_get_arguments_local_invalid_arg():
     with pytest.raises(ValueError):
         main.get_arguments(["search", "-qf", "test", "-m", "local", "-eq", "entrez"])
         main.get_arguments(["search", "-qf", "test", "-m", "local", "--rid", "rid"])
+
+
+@pytest.mark.parametrize("mode", ["local", "remote"])
+def test_cblaster_closes_caches(mocker, tmp_path, mode):
+    mocker.patch("cblaster.helpers.get_sequences", return_value={"seq1": "MAG"})
+    mocker.patch("cblaster.local.search", return_value=iter([]))
+    mocker.patch("cblaster.remote.search", return_value=("RID", []))
+    mocker.patch("cblaster.context.search", side_effect=RuntimeError)
+    hit_cache = mocker.patch("cblaster.cache.HitCache")
+    ipg_cache = mocker.patch("cblaster.cache.IPGCache")
+    with pytest.raises(RuntimeError):
+        main.cblaster(
+            query_file="query.faa",
+            mode=mode,
+            hit_cache=str(tmp_path / "hits.sqlite3"),
+            ipg_cache=str(tmp_path / "ipg.sqlite3"),
+        )
+    opened = hit_cache if mode == "local" else ipg_cache
+    opened.return_value.close.assert_called_once()
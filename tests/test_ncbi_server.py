@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for benchmarks/ncbi_server.py
+"""
+
+import importlib.util
+
+from pathlib import Path
+
+import pytest
+import requests
+
+
+SERVER_PATH = Path(__file__).resolve().parent.parent / "benchmarks" / "ncbi_server.py"
+
+
+@pytest.fixture(scope="module")
+def ncbi_server():
+    spec = importlib.util.spec_from_file_location("ncbi_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def prepare(**kwargs):
+    request = requests.Request("POST", "http://localhost/Blast.cgi", **kwargs)
+    prepared = request.prepare()
+    return prepared.headers["Content-Type"], prepared.body
+
+
+def test_parse_form_urlencoded(ncbi_server):
+    content_type, body = prepare(data={"CMD": "Put", "QUERY": ">q\nMAG\n"})
+    assert ncbi_server.parse_form(content_type, body.encode()) == [
+        ("CMD", "Put"),
+        ("QUERY", ">q\nMAG\n"),
+    ]
+
+
+def test_parse_form_multipart(ncbi_server):
+    content_type, body = prepare(
+        files={
+            "CMD": (None, "Put"),
+            "QUERY": (None, ">q\r\nMAG\n"),
+            "EMPTY": (None, ""),
+        }
+    )
+    assert "boundary=" in content_type
+    assert ncbi_server.parse_form(content_type, body) == [
+        ("CMD", "Put"),
+        ("QUERY", ">q\r\nMAG\n"),
+        ("EMPTY", ""),
+    ]
+
+    # Quoted boundaries, followed by other parameters
+    boundary = content_type.split("boundary=")[1]
+    quoted = f'multipart/form-data; boundary="{boundary}"; charset=utf-8'
+    assert ncbi_server.parse_form(quoted, body) == ncbi_server.parse_form(
+        content_type, body
+    )
+
+
+def test_request_key(ncbi_server):
+    key = ncbi_server.request_key
+    content_type, body = prepare(data={"CMD": "Put", "QUERY": "MAG"})
+    reference = key("POST", "/Blast.cgi", "", content_type, body.encode())
+
+    # Parameter order, location and ignored parameters do not change the key
+    assert key("POST", "/Blast.cgi", "QUERY=MAG&CMD=Put", None, b"") == reference
+    assert key(
+        "POST",
+        "/Blast.cgi",
+        "api_key=secret&tool=cblaster",
+        *prepare(files={"QUERY": (None, "MAG"), "CMD": (None, "Put")}),
+    ) == reference
+
+    # Method, path and parameter values do
+    assert key("GET", "/Blast.cgi", "CMD=Put&QUERY=MAG", None, b"") != reference
+    assert key("POST", "/entrez/", "CMD=Put&QUERY=MAG", None, b"") != reference
+    assert key("POST", "/Blast.cgi", "CMD=Put&QUERY=MAGIC", None, b"") != reference
+
+
+def test_throttle(ncbi_server, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ncbi_server.time, "monotonic", lambda: now[0])
+    throttle = ncbi_server.Throttle(2)
+    assert [throttle.allow() for _ in range(3)] == [True, True, False]
+
+    # Requests are counted in a sliding one second window
+    now[0] = 100.5
+    assert not throttle.allow()
+    now[0] = 101.0
+    assert throttle.allow()
+    assert throttle.allow()
+    assert not throttle.allow()
+
+    unlimited = ncbi_server.Throttle()
+    assert all(unlimited.allow() for _ in range(100))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for plot.py
+"""
+
+import gzip
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+from functools import partial
+
+import numpy as np
+import pytest
+
+from scipy.cluster.hierarchy import is_valid_linkage, linkage
+
+from cblaster import plot
+
+
+def make_array(values):
+    return [[{"value": value} for value in row] for row in values]
+
+
+def leaves(node):
+    if "children" not in node:
+        return [node["name"]]
+    return [leaf for child in node["children"] for leaf in leaves(child)]
+
+
+def test_generate_linkage_matrix_distinct_rows():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(0, 100, size=(50, 6))
+    expected = linkage(values, "ward")
+    expected[:, 2] /= expected[:, 2].max()
+    matrix = plot.generate_linkage_matrix(make_array(values))
+    assert np.allclose(matrix, expected)
+
+
+@pytest.mark.parametrize("limit", [1000, 20])
+def test_generate_linkage_matrix_duplicates(limit):
+    rng = np.random.default_rng(1)
+    values = rng.choice([0, 50, 80, 100], size=(600, 4))
+    matrix = plot.generate_linkage_matrix(make_array(values), limit=limit)
+    assert matrix.shape == (599, 4)
+    assert is_valid_linkage(matrix)
+    assert matrix[:, 2].max() == 1
+
+    # Identical rows are merged before anything else
+    duplicates = len(values) - len(np.unique(values, axis=0))
+    assert (matrix[:duplicates, 2] == 0).all()
+
+    hierarchy = plot.transform_linkage_matrix(matrix)
+    assert sorted(leaves(hierarchy)) == list(range(600))
+    json.dumps(hierarchy)
+
+
+def test_generate_linkage_matrix_single_row():
+    matrix = plot.generate_linkage_matrix(make_array([[1, 2], [1, 2]]))
+    assert matrix.tolist() == [[0, 1, 0, 2]]
+    assert plot.transform_linkage_matrix(
+        plot.generate_linkage_matrix(make_array([[1, 2]]))
+    ) == {"name": 0}
+
+
+@pytest.fixture()
+def data():
+    values = np.random.default_rng(2).choice([0, 50, 100], size=(25, 3))
+    matrix = [
+        [
+            dict(query=f"q{j}", cluster=i, value=int(value), hits=[], flag=-1)
+            for j, value in enumerate(row)
+        ]
+        for i, row in enumerate(values)
+    ]
+    hierarchy = plot.transform_linkage_matrix(plot.generate_linkage_matrix(matrix))
+    return {
+        "queries": ["q0", "q1", "q2"],
+        "labels": {i: {"id": i} for i in range(25)},
+        "counts": {"clusters": 25},
+        "matrix": matrix,
+        "hierarchy": hierarchy,
+    }
+
+
+def test_paginate(data):
+    data["matrix"][7][1]["flag"] = 3
+    summary, pages = plot.paginate(data, page_size=10)
+    assert "matrix" not in summary
+    assert summary["order"] == leaves(data["hierarchy"])
+    assert summary["pages"] == {"size": 10, "total": 3}
+    assert summary["max_flag"] == 3
+    assert [len(page) for page in pages] == [10, 10, 5]
+    rows = [row for page in pages for row in page]
+    assert [row[0]["cluster"] for row in rows] == summary["order"]
+
+
+def test_plot_server(data):
+    pages = plot.paginate(data, page_size=10)
+    handler = partial(plot.CustomHandler, data, "heatmap", pages=pages)
+    with plot.PlotServer(("localhost", 0), handler) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        url = "http://{}:{}".format(*httpd.server_address)
+
+        def get(path, **headers):
+            request = urllib.request.Request(url + path, headers=headers)
+            with urllib.request.urlopen(request) as response:
+                body = response.read()
+                if response.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return json.loads(body)
+
+        try:
+            summary = get("/summary.json", **{"Accept-Encoding": "gzip"})
+            assert summary["order"] == pages[0]["order"]
+            page = get("/matrix.json?page=2")
+            assert page == {"page": 2, "matrix": pages[1][2]}
+            assert len(get("/data.json")["matrix"]) == 25
+            with pytest.raises(urllib.error.HTTPError):
+                get("/matrix.json?page=3")
+        finally:
+            httpd.shutdown()
+            thread.join()
+
+
+def test_load_data_cache(tmp_path, mocker):
+    from cblaster import classes
+
+    def make_session(identity):
+        subjects = [
+            classes.Subject(
+                hits=[classes.Hit(query, f"s{i}", identity, 90, 1e-10, 100)],
+                name=f"s{i}",
+                start=i * 1000,
+                end=i * 1000 + 900,
+                strand="+",
+            )
+            for i, query in enumerate(["q1", "q2", "q1"])
+        ]
+        scaffold = classes.Scaffold("scaf", subjects=subjects)
+        scaffold.add_cluster_indices([[0, 1], [2]])
+        organism = classes.Organism("Organism", "", scaffolds={"scaf": scaffold})
+        return classes.Session(queries=["q1", "q2"], organisms=[organism])
+
+    path = tmp_path / "session.json"
+    make_session(90).to_file(path)
+    spy = mocker.spy(plot, "get_data")
+    hash_spy = mocker.spy(plot, "file_hash")
+
+    data = plot.load_data(path)
+    assert spy.call_count == 1
+    assert hash_spy.call_count == 1
+    assert (tmp_path / "session.json.plot.gz").exists()
+    assert plot.load_data(path) == json.loads(json.dumps(data))
+    assert spy.call_count == 1
+    assert hash_spy.call_count == 1
+
+    # Touched sessions are rehashed once, but not recomputed
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert plot.load_data(path) == json.loads(json.dumps(data))
+    assert plot.load_data(path) == json.loads(json.dumps(data))
+    assert spy.call_count == 1
+    assert hash_spy.call_count == 2
+
+    # Changed sessions are recomputed
+    make_session(80).to_file(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert plot.load_data(path)["matrix"][0][0]["value"] == 80
+    assert spy.call_count == 2
@@ -8,8 +8,11 @@ import pytest
 
 from pathlib import Path
 
+import requests
 import requests_mock
 
+from urllib3.exceptions import NewConnectionError
+
 from cblaster import remote
 
 
@@ -72,6 +75,31 @@ def test_start(start_response):
         )
 
 
+def test_start_retries(start_response, mocker):
+    mocker.patch("cblaster.helpers.time.sleep")
+    query_file = str(TEST_DIR / "test.faa")
+    with requests_mock.Mocker() as mock:
+        # Rejected submissions (429) and failed connections are resubmitted
+        mock.post(
+            remote.BLAST_API_URL,
+            [
+                {"status_code": 429},
+                {"exc": requests.ConnectionError(NewConnectionError(None, "refused"))},
+                {"text": start_response},
+            ],
+        )
+        assert remote.start(query_file=query_file) == ("VCZM3MWB014", 18)
+        assert mock.call_count == 3
+
+    # Submissions that may have been accepted are not, to avoid duplicate searches
+    for response in [{"status_code": 502}, {"exc": requests.ReadTimeout}]:
+        with requests_mock.Mocker() as mock:
+            mock.post(remote.BLAST_API_URL, [response, {"text": start_response}])
+            with pytest.raises((requests.HTTPError, requests.ReadTimeout)):
+                remote.start(query_file=query_file)
+            assert mock.call_count == 1
+
+
 def test_start_blastn_options(start_response):
     with requests_mock.Mocker() as mock:
         mock.post(remote.BLAST_API_URL, text=start_response)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Test suite for session_io.py
+"""
+
+import pytest
+
+from cblaster import classes, session_io
+
+
+@pytest.fixture()
+def session():
+    organisms = []
+    for i in range(3):
+        organism = classes.Organism(f"Organism {i}", f"Strain {i}")
+        for j in range(2):
+            subjects = [
+                classes.Subject(
+                    hits=[classes.Hit("q1", f"s{i}{j}{k}", 90, 90, 1e-10, 100 + k)],
+                    name=f"s{i}{j}{k}",
+                    ipg=str(k),
+                    start=k * 1000,
+                    end=k * 1000 + 900,
+                    strand="+",
+                )
+                for k in range(3)
+            ]
+            scaffold = classes.Scaffold(f"scaf_{i}_{j}", subjects=subjects)
+            scaffold.add_cluster_indices([[0, 1, 2]])
+            organism.scaffolds[scaffold.accession] = scaffold
+        organisms.append(organism)
+    return classes.Session(
+        queries=["q1"],
+        sequences={"q1": "MAGIC"},
+        params={"mode": "remote"},
+        organisms=organisms,
+    )
+
+
+def test_binary_session_round_trip(session, tmp_path):
+    path = tmp_path / "session.cbs"
+    session.to_file(path)
+    assert session_io.is_binary(path)
+    assert classes.Session.from_file(path).to_dict() == session.to_dict()
+
+    json_path = tmp_path / "session.json"
+    session.to_file(json_path)
+    assert not session_io.is_binary(json_path)
+    assert classes.Session.from_file(json_path).to_dict() == session.to_dict()
+
+
+def test_session_reader_lazy(session, tmp_path, mocker):
+    path = tmp_path / "session.cbs"
+    session.to_file(path)
+    with session_io.SessionReader(path) as reader:
+        assert reader.queries == ["q1"]
+        assert len(reader) == 3
+        assert [entry["scaffolds"] for entry in reader.index][1] == [
+            "scaf_1_0",
+            "scaf_1_1",
+        ]
+        spy = mocker.spy(session_io, "read_chunk")
+        assert reader[2] == session.organisms[2].to_dict()
+        spy.assert_called_once()
+
+
+def test_session_reader_incomplete(session, tmp_path):
+    path = tmp_path / "session.cbs"
+    session.to_file(path)
+    data = path.read_bytes()
+    path.write_bytes(data[:-4])
+    with pytest.raises(ValueError):
+        session_io.SessionReader(path)
+    path.write_text("{}")
+    with pytest.raises(ValueError):
+        session_io.SessionReader(path)
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_json_session_index(session, tmp_path, indent):
+    path = tmp_path / "session.json"
+    session.to_file(path, indent=indent)
+    if indent is None:
+        assert path.read_text() == session.to_json()
+    with session_io.open_indexed(path) as reader:
+        assert isinstance(reader, session_io.JSONSessionReader)
+        assert reader.params == {"mode": "remote"}
+        assert reader.read_organism(1) == session.organisms[1].to_dict()
+        organism = reader.read_organism(2, accessions={"scaf_2_1"})
+        assert organism["scaffolds"] == [
+            session.organisms[2].scaffolds["scaf_2_1"].to_dict()
+        ]
+
+    # Stale or missing indexes are ignored
+    path.write_text(session.to_json() + " ")
+    assert session_io.open_indexed(path) is None
+    session_io.index_path(path).unlink()
+    assert session_io.open_indexed(path) is None
+
+
+@pytest.mark.parametrize("suffix", [".json", ".cbs"])
+def test_extract_load_session(session, tmp_path, suffix):
+    from cblaster import extract
+
+    path = tmp_path / f"session{suffix}"
+    session.to_file(path)
+    subset = extract.load_session(
+        path, organisms=["Organism [12]"], scaffolds=["scaf_1_1", "scaf_0_0"]
+    )
+    assert [organism.name for organism in subset.organisms] == ["Organism 1"]
+    assert list(subset.organisms[0].scaffolds) == ["scaf_1_1"]
+    assert extract.extract_records(subset) == extract.extract_records(
+        session, organisms=["Organism [12]"], scaffolds=["scaf_1_1", "scaf_0_0"]
+    )
+    assert extract.load_session(path).to_dict() == session.to_dict()